@@ -0,0 +1,91 @@
+"""
+Arrays handed between ChargeAPI and the model workers as .npy files rather than inside the JSON messages.
+
+Large grids are written once as raw float64 .npy files, in shared memory (/dev/shm) where there is one, and the worker
+memory maps them by name, so the points are never formatted as text or parsed back one float at a time. The worker
+writes the ESP evaluated on such a grid next to it in the same way, and ChargeAPI maps it back and removes both files.
+
+This module only needs numpy so it can also be imported by the model worker inside the model environments.
+"""
+from typing import Optional
+import tempfile
+import os
+import numpy as np
+
+#grids of at least this many points are sent as .npy files, smaller ones are cheaper to send in the message
+ARRAY_FILE_POINTS = int(os.environ.get('CHARGEAPI_ARRAY_FILE_POINTS', 4096))
+#shared memory, so the files never reach the disk
+_SHARED_MEMORY = '/dev/shm'
+
+
+def array_directory() -> str:
+    """
+    Directory the array files are written to, shared memory if it is available and the temporary directory otherwise
+    """
+    if os.path.isdir(_SHARED_MEMORY) and os.access(_SHARED_MEMORY, os.W_OK):
+        return _SHARED_MEMORY
+    return tempfile.gettempdir()
+
+
+def write_array(array: np.ndarray, directory: Optional[str] = None) -> str:
+    """
+    Write an array to a new .npy file
+
+    Parameters
+    ----------
+    array: np.ndarray
+        array to write, stored as float64
+    directory: str, optional
+        directory of the file, by default array_directory()
+
+    Returns
+    -------
+    str
+        path of the file
+    """
+    descriptor, file_path = tempfile.mkstemp(
+        prefix='chargeapi_', suffix='.npy', dir=directory or array_directory()
+    )
+    with os.fdopen(descriptor, 'wb') as array_file:
+        np.save(array_file, np.ascontiguousarray(array, dtype=np.float64))
+    return file_path
+
+
+def read_array(file_path: str, remove: bool = False) -> np.ndarray:
+    """
+    Memory map a .npy file
+
+    Parameters
+    ----------
+    file_path: str
+        .npy file written by write_array
+    remove: bool
+        whether to remove the file once it is read, the mapped array stays valid
+
+    Returns
+    -------
+    np.ndarray
+        read only array
+    """
+    array = np.load(file_path, mmap_mode='r')
+    if remove:
+        if os.name != 'posix':
+            #files which are mapped cannot be removed on windows, so the array is read into memory
+            loaded = np.array(array)
+            del array
+            array = loaded
+            array.setflags(write=False)
+        os.unlink(file_path)
+    return array
+
+
+def remove_array(file_path: Optional[str]) -> None:
+    """
+    Remove an array file if it is still there
+    """
+    if file_path is None:
+        return
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
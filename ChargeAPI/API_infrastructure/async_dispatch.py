@@ -0,0 +1,87 @@
+import subprocess
+import asyncio
+import weakref
+import logging
+from ChargeAPI.API_infrastructure.worker_pool import worker_command
+from ChargeAPI.API_infrastructure.environments import is_resolved, resolve_environment
+from ChargeAPI.API_infrastructure.protocol import encode_message
+
+#maximum number of requests in flight per conda environment, unless set with set_concurrency_limit
+DEFAULT_CONCURRENCY = 4
+
+_concurrency_limits = {}
+#semaphores belong to the event loop they are first used in
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def set_concurrency_limit(env: str, limit: int) -> None:
+    """
+    Set the maximum number of requests in flight at once for the models in a conda environment.
+    The limit applies to requests made after it is set.
+
+    Parameters
+    ----------
+    env: str
+        conda environment, e.g. naglmbis, openbabel or riniker
+    limit: int
+        maximum number of worker processes running at once in the environment
+    """
+    if limit < 1:
+        raise ValueError('concurrency limit must be at least 1')
+    _concurrency_limits[env] = limit
+    for loop_semaphores in _semaphores.values():
+        loop_semaphores.pop(env, None)
+
+
+def get_concurrency_limit(env: str) -> int:
+    """
+    maximum number of requests in flight at once for the models in a conda environment
+    """
+    return _concurrency_limits.get(env, DEFAULT_CONCURRENCY)
+
+
+def _semaphore(env: str) -> asyncio.Semaphore:
+    loop_semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    if env not in loop_semaphores:
+        loop_semaphores[env] = asyncio.Semaphore(get_concurrency_limit(env))
+    return loop_semaphores[env]
+
+
+async def run_worker_request(env: str, script_path: str, payload: dict) -> subprocess.CompletedProcess:
+    """
+    Run a request on a one-off model worker without blocking the event loop.
+
+    Parameters
+    ----------
+    env: str
+        conda environment the model runs in
+    script_path: str
+        absolute path to the model script
+    payload: dict
+        request to send to the worker
+
+    Returns
+    -------
+    subprocess.CompletedProcess
+        the worker's exit code and captured stdout (framed messages) and stderr
+    """
+    if not is_resolved(env):
+        #the first request for an environment probes it with conda run, keep that off the event loop
+        await asyncio.to_thread(resolve_environment, env)
+    cmd, variables = worker_command(env, script_path)
+    async with _semaphore(env):
+        logging.info("Executing async request with %s in %s", script_path, env)
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            env=variables,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await process.communicate(encode_message(payload))
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
@@ -0,0 +1,314 @@
+"""
+Readers and writers of batched charge files, and of the grid and ESP files of batched ESP runs.
+
+Batched charge runs can write their charges as JSON (the default), as an NPZ of flat arrays or, with pyarrow installed,
+as Parquet or Arrow IPC tables. The binary files hold the molecule ids in input order, the charges of all molecules
+concatenated into one float64 array and the offsets of each molecule's charges into it, so a molecule's charges are a
+slice which can be read from a memory map without loading or parsing the rest of the file.
+
+Grid and ESP files of batched ESP runs are NPZ files in the same layout: the grids of all molecules concatenated into
+one (n_points, 3) array with the offsets of each molecule's points, and the ESP on them likewise, with the multipoles
+of broken up runs concatenated over atoms with their own offsets.
+
+This module only needs numpy (and optionally pyarrow) so it can also be imported by the model worker inside the model
+environments.
+"""
+from collections.abc import Mapping
+from typing import Iterator
+import zipfile
+import struct
+import json
+import numpy as np
+
+#file types batched charge runs can write
+FILE_TYPES = ('json', 'npz', 'parquet', 'arrow')
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('pyarrow is needed for parquet and arrow charge files, install it or use npz') from e
+    return pyarrow
+
+
+def _flatten(charges: dict[str, list[float]]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    ids = list(charges)
+    lengths = np.fromiter((len(charges[name]) for name in ids), dtype=np.int64, count=len(ids))
+    offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.fromiter(
+        (charge for name in ids for charge in charges[name]), dtype=np.float64, count=int(offsets[-1])
+    )
+    return ids, values, offsets
+
+
+def write_charge_file(charges: dict[str, list[float]], file_path: str, file_type: str = 'json') -> str:
+    """
+    Write the charges of a batch of molecules
+
+    Parameters
+    ----------
+    charges: dict
+        molecule names and their charges, in the order to write them
+    file_path: str
+        file to write
+    file_type: str
+        one of json, npz, parquet or arrow
+
+    Returns
+    -------
+    str
+        the file path
+    """
+    if file_type not in FILE_TYPES:
+        raise ValueError(f'unknown charge file type {file_type}, expected one of {FILE_TYPES}')
+    if file_type == 'json':
+        with open(file_path, 'w+') as outfile:
+            json.dump(charges, outfile, indent=2)
+        return file_path
+
+    ids, values, offsets = _flatten(charges)
+    if file_type == 'npz':
+        #stored uncompressed so the arrays can be memory mapped in place
+        with open(file_path, 'wb') as outfile:
+            np.savez(outfile, ids=np.array(ids, dtype=str), charges=values, offsets=offsets)
+        return file_path
+
+    pyarrow = _import_pyarrow()
+    if offsets[-1] < 2**31:
+        charge_column = pyarrow.ListArray.from_arrays(pyarrow.array(offsets, pyarrow.int32()), pyarrow.array(values))
+    else:
+        charge_column = pyarrow.LargeListArray.from_arrays(pyarrow.array(offsets), pyarrow.array(values))
+    table = pyarrow.table({'molecule': pyarrow.array(ids, pyarrow.string()), 'charges': charge_column})
+    if file_type == 'parquet':
+        pyarrow.parquet.write_table(table, file_path)
+    else:
+        with pyarrow.OSFile(file_path, 'wb') as sink, pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return file_path
+
+
+def _memmap_npz(file_path: str) -> dict[str, np.ndarray]:
+    """
+    Memory map the arrays of an uncompressed NPZ, np.load can only memory map single .npy files
+    """
+    arrays = {}
+    with zipfile.ZipFile(file_path) as archive, open(file_path, 'rb') as npz_file:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+            #the array data follows the local file header, its name and extra field, and the .npy header
+            npz_file.seek(info.header_offset)
+            name_length, extra_length = struct.unpack('<HH', npz_file.read(30)[26:30])
+            npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(npz_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file)
+            arrays[name] = np.memmap(
+                file_path,
+                dtype=dtype,
+                mode='r',
+                offset=npz_file.tell(),
+                shape=shape,
+                order='F' if fortran_order else 'C',
+            )
+    return arrays
+
+
+class ChargeFile(Mapping):
+    """Read only view of a batched charge file, mapping molecule names to their charges.
+
+    NPZ and Arrow files are memory mapped and Parquet files are read once into Arrow buffers, so looking up a molecule
+    only slices the flat charge array. JSON files are parsed in full.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        Parameters
+        ----------
+        file_path: str
+            charge file written by a batched charge run, its type is taken from the extension
+        """
+        self.file_path = file_path
+        file_type = file_path.rsplit('.', 1)[-1]
+        if file_type == 'npz':
+            arrays = _memmap_npz(file_path)
+            self.ids, self.charges, self.offsets = arrays['ids'], arrays['charges'], arrays['offsets']
+        elif file_type in ('parquet', 'arrow'):
+            pyarrow = _import_pyarrow()
+            if file_type == 'parquet':
+                table = pyarrow.parquet.read_table(file_path, memory_map=True)
+            else:
+                table = pyarrow.ipc.open_file(pyarrow.memory_map(file_path)).read_all()
+            charge_column = table.column('charges').combine_chunks()
+            self.ids = table.column('molecule').to_pylist()
+            self.charges = charge_column.flatten().to_numpy(zero_copy_only=False)
+            self.offsets = charge_column.offsets.to_numpy() - charge_column.offsets[0].as_py()
+        else:
+            with open(file_path, 'r') as infile:
+                ids, self.charges, self.offsets = _flatten(json.load(infile))
+            self.ids = np.array(ids, dtype=str)
+        self._index = None
+
+    def molecule(self, index: int) -> np.ndarray:
+        """
+        Charges of the molecule at a position in the file
+        """
+        return np.asarray(self.charges[self.offsets[index]:self.offsets[index + 1]])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if self._index is None:
+            self._index = {str(molecule): i for i, molecule in enumerate(self.ids)}
+        return self.molecule(self._index[name])
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(molecule) for molecule in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def read_charge_file(file_path: str) -> ChargeFile:
+    """
+    Open a batched charge file of any of the FILE_TYPES for random access by molecule name or position
+
+    Parameters
+    ----------
+    file_path: str
+        charge file written by a batched charge run
+
+    Returns
+    -------
+    ChargeFile
+    """
+    return ChargeFile(file_path)
+
+
+#fields of the ESP files with a row per grid point, and with a row per atom
+ESP_POINT_FIELDS = ('esp', 'grid')
+ESP_ATOM_FIELDS = ('monopoles', 'dipoles', 'quadrupoles', 'coordinates', 'elements')
+
+
+def _offsets(lengths: list[int]) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def write_grid_file(grids: dict[str, np.ndarray], file_path: str) -> str:
+    """
+    Write the grids of a batch of molecules, for a batched ESP run on them
+
+    Parameters
+    ----------
+    grids: dict
+        molecule names and their (n_points, 3) grids in angstrom
+    file_path: str
+        NPZ file to write
+
+    Returns
+    -------
+    str
+        the file path
+    """
+    return write_esp_file({name: {'grid': grid} for name, grid in grids.items()}, file_path)
+
+
+def write_esp_file(results: dict[str, dict[str, np.ndarray]], file_path: str) -> str:
+    """
+    Write the ESP, or the multipoles, of a batch of molecules
+
+    Parameters
+    ----------
+    results: dict
+        molecule names and their arrays, any of ESP_POINT_FIELDS and ESP_ATOM_FIELDS. A field is written if every
+        molecule has it
+    file_path: str
+        NPZ file to write
+
+    Returns
+    -------
+    str
+        the file path
+    """
+    ids = list(results)
+    arrays = {'ids': np.array(ids, dtype=str)}
+    for fields, offsets_name in ((ESP_POINT_FIELDS, 'offsets'), (ESP_ATOM_FIELDS, 'atom_offsets')):
+        present = [field for field in fields if ids and all(field in results[name] for name in ids)]
+        if not present:
+            continue
+        values = {field: [np.asarray(results[name][field]) for name in ids] for field in present}
+        arrays[offsets_name] = _offsets([len(molecule_values) for molecule_values in values[present[0]]])
+        for field in present:
+            arrays[field] = np.concatenate(values[field])
+            if arrays[field].dtype.kind in 'iuf':
+                arrays[field] = arrays[field].astype(np.float64)
+    #stored uncompressed so the arrays can be memory mapped in place
+    with open(file_path, 'wb') as outfile:
+        np.savez(outfile, **arrays)
+    return file_path
+
+
+class ESPFile(Mapping):
+    """Read only view of a grid or ESP file of a batched ESP run, mapping molecule names to a dictionary of their
+    arrays (grid, esp, multipoles, ...), which are slices of the memory mapped file.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        Parameters
+        ----------
+        file_path: str
+            NPZ file written by write_grid_file or write_esp_file
+        """
+        self.file_path = file_path
+        self.arrays = _memmap_npz(file_path)
+        self.ids = self.arrays['ids']
+        self._index = None
+
+    def molecule(self, index: int) -> dict[str, np.ndarray]:
+        """
+        Arrays of the molecule at a position in the file
+        """
+        arrays = {}
+        for fields, offsets_name in ((ESP_POINT_FIELDS, 'offsets'), (ESP_ATOM_FIELDS, 'atom_offsets')):
+            if offsets_name not in self.arrays:
+                continue
+            start, stop = self.arrays[offsets_name][index:index + 2]
+            for field in fields:
+                if field in self.arrays:
+                    arrays[field] = self.arrays[field][start:stop]
+        return arrays
+
+    def __getitem__(self, name: str) -> dict[str, np.ndarray]:
+        if self._index is None:
+            self._index = {str(molecule): i for i, molecule in enumerate(self.ids)}
+        return self.molecule(self._index[name])
+
+    def __iter__(self) -> Iterator[str]:
+        return (str(molecule) for molecule in self.ids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def read_esp_file(file_path: str) -> ESPFile:
+    """
+    Open a grid or ESP file of a batched ESP run for random access by molecule name or position
+
+    Parameters
+    ----------
+    file_path: str
+        NPZ file written by write_grid_file or write_esp_file
+
+    Returns
+    -------
+    ESPFile
+    """
+    return ESPFile(file_path)
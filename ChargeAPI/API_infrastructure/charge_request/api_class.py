@@ -1,103 +1,340 @@
-import subprocess
-import requests
-import tempfile
-from flask import Flask, request, jsonify
-from multiprocessing import Process
+"""
+HTTP server for the charge and ESP models.
+
+Every request is run on the resident model workers of ChargeAPI's worker pool (see worker_pool.py), which are shared by
+all clients: only the first request for a model pays for starting its conda environment and loading the model, and
+later requests from any client reuse the warm workers. Alternatively the requests are routed to model microservices,
+one or more per conda environment and possibly on other machines, see microservices/router.py. The server is served
+by waitress with a thread per request in flight, the request threads only wait on the workers, and with micro
+batching concurrent single molecule requests are run together as one batch. The threads block, so a streamed batch
+holds one of them until its last line is sent: --threads bounds the streams and other requests in flight together.
+
+Endpoints
+---------
+POST /charge/<charge_model>
+    ``{"conformer_mol": molblock, "protein": false}`` for one molecule, answered as ``{"charge_result", "error"}``
+    like handle_charge_request, or ``{"molecules": {name: molblock}}`` for a batch, answered as
+    ``{"charges": {name: charges}, "errors": {name: message}}``
+POST /esp/<esp_model>
+    ``{"conformer_mol": molblock, "grid": [[x, y, z], ...], "broken_up": false, "theta": null, "multipoles_only": false}``
+    for one molecule, or ``{"molecules": {name: molblock or [molblock, grid]}}`` for a batch, answered with the arrays
+    of each ESPResult
+GET /models, GET /health
+
+Batches are streamed as NDJSON, a line per molecule as it finishes, with ``"stream": true`` in the body or an
+``Accept: application/x-ndjson`` header.
+"""
+import argparse
 import json
-import os
-#import logging
-import ChargeAPI
+import logging
+from typing import Iterator
+from flask import Flask, Response, request, jsonify, stream_with_context
+from ChargeAPI.API_infrastructure.charge_request import module_version
+from ChargeAPI.API_infrastructure.results import ChargeResult, ESPResult
 
 app = Flask(__name__)
 #logging.basicConfig(filename='charge_api.log', level=logging.DEBUG)
 
-@app.route('/charge/<charge_model>', methods = ['GET','POST'])
-def handle_charge_request(charge_model: str, batched: bool = False) -> dict[str,any]:
+NDJSON = 'application/x-ndjson'
+
+
+class RequestError(Exception):
+    """A request the server cannot run, answered with its status code"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+@app.errorhandler(RequestError)
+def request_error(error: RequestError):
+    return jsonify({'error': str(error)}), error.status
+
+
+def _esp_module():
+    """
+    the ESP request module, imported with the first ESP request as it needs openff-units
+    """
+    from ChargeAPI.API_infrastructure.esp_request import module_version_esp
+    return module_version_esp
+
+
+def _request_json() -> dict:
+    """
+    body of the request, older clients post the JSON document as a JSON string
+    """
+    json_data = request.get_json(force=True, silent=True)
+    if isinstance(json_data, str):
+        json_data = json.loads(json_data)
+    if not isinstance(json_data, dict):
+        raise RequestError('the request body must be a JSON object')
+    return json_data
+
+
+def _streamed(json_data: dict) -> bool:
+    return json_data.get('stream', False) or request.accept_mimetypes.best == NDJSON
+
+
+def _errors(result: ChargeResult | ESPResult) -> str:
+    return ''.join(error.message for error in result.errors)
+
+
+def _charge_json(result: ChargeResult) -> dict:
+    """
+    lists of a ChargeResult's arrays
+    """
+    charge_json = {'charges': None if result.charges is None else result.charges.tolist(), 'error': _errors(result)}
+    if result.dipoles is not None:
+        charge_json['dipoles'] = result.dipoles.tolist()
+    return charge_json
+
+
+def _esp_json(result: ESPResult) -> dict:
+    """
+    lists of the arrays an ESPResult holds
     """
-    handle the charge request and run the correct charge model
+    esp_json = {'error': _errors(result)}
+    for name in ('esp', 'grid', 'monopoles', 'dipoles', 'quadrupoles', 'coordinates'):
+        values = getattr(result, name)
+        if values is not None:
+            esp_json[name] = values.tolist()
+    if result.elements is not None:
+        esp_json['elements'] = result.elements
+    return esp_json
+
+
+def _ndjson(results: Iterator[tuple[str, ChargeResult | ESPResult]], to_json) -> Response:
+    """
+    stream a line of JSON for each molecule as it finishes
+    """
+    def lines():
+        try:
+            for name, result in results:
+                yield json.dumps(dict(to_json(result), molecule=name)) + '\n'
+        except Exception as e:
+            #the status has already been sent, so the failure is the last line
+            yield json.dumps({'error': str(e)}) + '\n'
+    return Response(stream_with_context(lines()), mimetype=NDJSON)
+
+
+@app.route('/charge/<charge_model>', methods=['GET', 'POST'])
+def handle_charge_request(charge_model: str):
+    """
+    handle the charge request of one molecule, or of a batch of molecules, and run the charge model on its workers
     Parameters
     ---------
     charge_model: str
-        Charge model to chose from the switch statement
+        Charge model to run, one of module_version.model_locations
 
     Returns
     -------
     json: json
-        Json dictionary of calculation results, including errors.
+        Json dictionary of calculation results, including errors, or NDJSON lines for a streamed batch.
     """
-    json_data = request.get_json()
-    json_data = json.loads(json_data)
-    #extract the data from the json
-    conformer_mol = json_data['conformer_mol']
+    if charge_model not in module_version.model_locations:
+        raise RequestError(f'charge model {charge_model} does not exist', 404)
+    json_data = _request_json()
+
+    if 'molecules' in json_data:
+        molecules = json_data['molecules']
+        if _streamed(json_data):
+            return _ndjson(module_version.handle_charge_batch(charge_model, molecules, stream=True), _charge_json)
+        results = module_version.handle_charge_batch(charge_model, molecules)
+        return jsonify({
+            'charges': {name: _charge_json(result)['charges'] for name, result in results.items() if result.ok},
+            'errors': {name: _errors(result) for name, result in results.items() if not result.ok},
+        })
+
+    if 'conformer_mol' not in json_data:
+        raise RequestError('the request needs a conformer_mol or molecules')
+    return jsonify(module_version.handle_charge_request(
+        charge_model=charge_model,
+        conformer_mol=json_data['conformer_mol'],
+        protein=json_data.get('protein', False),
+    ))
+
+
+@app.route('/esp/<esp_model>', methods=['POST'])
+def handle_esp_request(esp_model: str):
+    """
+    handle the ESP request of one molecule, or of a batch of molecules, and run the ESP model on its workers
+    Parameters
+    ---------
+    esp_model: str
+        ESP model to run, one of module_version_esp.model_locations
+
+    Returns
+    -------
+    json: json
+        Json dictionary of the ESP result, or of each molecule's results for a batch, or NDJSON lines for a streamed
+        batch.
+    """
+    module_version_esp = _esp_module()
+    if esp_model not in module_version_esp.model_locations:
+        raise RequestError(f'ESP model {esp_model} does not exist', 404)
+    json_data = _request_json()
+    options = {
+        'broken_up': json_data.get('broken_up', False),
+        'theta': json_data.get('theta'),
+        'multipoles_only': json_data.get('multipoles_only', False),
+    }
+
+    if 'molecules' in json_data:
+        molecules = json_data['molecules']
+        if _streamed(json_data):
+            return _ndjson(module_version_esp.handle_esp_batch(esp_model, molecules, stream=True, **options), _esp_json)
+        results = module_version_esp.handle_esp_batch(esp_model, molecules, **options)
+        return jsonify({'results': {name: _esp_json(result) for name, result in results.items()}})
+
+    if 'conformer_mol' not in json_data:
+        raise RequestError('the request needs a conformer_mol or molecules')
+    grid = json_data.get('grid')
+    if grid is not None:
+        from openff.units import unit
+        import numpy as np
+        grid = np.asarray(grid, dtype=float).reshape(-1, 3) * unit.angstrom
+    result = module_version_esp.handle_esp_request(
+        charge_model=esp_model,
+        conformer_mol=json_data['conformer_mol'],
+        grid=grid,
+        protein=json_data.get('protein', False),
+        typed=True,
+        **options,
+    )
+    return jsonify(_esp_json(result))
+
+
+@app.route('/models', methods=['GET'])
+def models():
+    """
+    Charge and ESP models the server can run
+    """
+    return jsonify({
+        'charge': list(module_version.model_locations),
+        'esp': list(_esp_module().model_locations),
+    })
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Status of the server and the workers started for each model
+    """
+    pools = {'charge': module_version._DISPATCHER.pool}
+    try:
+        pools['esp'] = _esp_module()._DISPATCHER.pool
+    except ImportError:
+        pools['esp'] = None
+    return jsonify({
+        'status': 'ok',
+        'workers': {kind: {} if pool is None else pool.stats() for kind, pool in pools.items()},
+    })
 
-    batched = json_data.get('batched', False)  # Defaults to False if not provided
-    
-    if batched:
-        batched = '--batched'
-    else:
-        batched = '--not_batched'
-
-    match charge_model:
-            case 'EEM':
-                script_path = f'{os.path.dirname(ChargeAPI.__file__)}/charge_models/eem_model.py'
-                #replace with requests json_charges = requests.post('http://127.0.0.1:5001/charge/EEM', json = json_data)
-
-                cmd = (
-                    f"conda run -n openbabel python {script_path} --conformer '{conformer_mol}' {batched}"
-                )
-                charge_result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-                return prepare_json_outs(charge_result)
-            case 'MBIS':
-                script_path = f'{os.path.dirname(ChargeAPI.__file__)}/charge_models/mbis_model.py'
-                cmd = (
-                        f"conda run -n nagl-mbis python -m {script_path}  --conformer '{conformer_mol}' --batched {batched}"
-                       )
-                charge_result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-
-                return prepare_json_outs(charge_result)
-            case _:
-                raise NameError
-         
 
 @app.route('/shutdown', methods=['POST'])
 def shutdown() -> str:
     """
-    Shut down the API
+    Stop the model workers, the server itself is stopped by its process manager
     """
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
-    return 'Server shutting down...'
+    module_version.stop_worker_pool()
+    try:
+        _esp_module().stop_worker_pool()
+    except ImportError:
+        pass
+    return 'Model workers stopped'
+
 
-def prepare_json_outs(charge_result: subprocess.CompletedProcess) -> json:
+def _start_workers(workers_per_model: int, preload: list[str]):
     """
-    grabs data from subprocess and produces a json of the output
-    Paramters
-    --------
-    charge_result:  subprocess.CompletedProcess
-        Result of the subprocess run command in/out/error info
+    start the charge and ESP worker pools, each preloading its own models
     """
-    charge_result_list = charge_result.stdout.decode()  # Convert the output to a list if it's a string
-    # Create JSON response
-    json_response = {
-        'charge_result': charge_result_list,
-        'error': charge_result.stderr.decode()  # Include the error message if any
-    }
-    # Return the charge result as a list and the JSON response   
-     
-    return jsonify(json_response)
+    module_version.start_worker_pool(
+        workers_per_model=workers_per_model,
+        preload=[model for model in preload if model in module_version.model_locations],
+    )
+    esp_preload = [model for model in preload if model not in module_version.model_locations]
+    try:
+        _esp_module().start_worker_pool(workers_per_model=workers_per_model, preload=esp_preload)
+    except ImportError:
+        if esp_preload:
+            raise
+        logging.warning('openff-units is not installed, ESP requests will fail')
+
+
+def create_app(
+    workers_per_model: int = 1,
+    preload: list[str] = None,
+    micro_batching: bool = False,
+    cache: bool = False,
+    microservices: list[str] = None,
+    shared_filesystem: bool = False,
+    ) -> Flask:
+    """
+    Start the resident workers, or connect to the microservices, the server runs its requests on
+    Parameters
+    ----------
+    workers_per_model: int
+        most resident workers for each model, and so most requests running at once for it
+    preload: list[str]
+        charge or ESP models to start workers for before the first request
+    micro_batching: bool
+        whether to run concurrent single molecule charge requests together as batches
+    cache: bool
+        whether to answer repeated single molecule charge requests from the result cache
+    microservices: list[str]
+        base URLs of model microservices to route the requests to instead of starting workers, the models are
+        loaded when the microservices start so workers_per_model and preload are not used
+    shared_filesystem: bool
+        whether the microservices share this machine's file system, see microservices/router.py
+
+    Returns
+    -------
+    Flask
+        the app
+    """
+    if microservices:
+        module_version.connect_microservices(microservices, shared_filesystem=shared_filesystem)
+        try:
+            _esp_module().connect_microservices(microservices, shared_filesystem=shared_filesystem)
+        except ImportError:
+            logging.warning('openff-units is not installed, ESP requests will fail')
+    else:
+        _start_workers(workers_per_model, preload or [])
+    if micro_batching:
+        module_version.enable_micro_batching()
+    if cache:
+        module_version.enable_cache()
+    return app
+
 
 def main():
+    parser = argparse.ArgumentParser(description='ChargeAPI HTTP server')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16, help='requests handled at once')
+    parser.add_argument('--workers_per_model', type=int, default=1, help='resident workers for each model')
+    parser.add_argument('--preload', nargs='*', default=[], help='models to start workers for straight away')
+    parser.add_argument('--micro_batching', action='store_true', help='batch concurrent single molecule requests')
+    parser.add_argument('--cache', action='store_true', help='cache single molecule charge results')
+    parser.add_argument('--microservices', nargs='*', default=[], help='model microservice URLs to route requests to')
+    parser.add_argument('--shared_filesystem', action='store_true', help='the microservices share this file system')
+    args = parser.parse_args()
+
     #run the app
     from waitress import serve
-    from microservices import eem_microservice, mbis_microservice
-    ip = 5000
-    serve(app, host="0.0.0.0", port=ip)
-    eem_microservice.main(ip)
-   # mbis_microservice.main(ip)
+    create_app(
+        args.workers_per_model,
+        args.preload,
+        args.micro_batching,
+        args.cache,
+        args.microservices,
+        args.shared_filesystem,
+    )
+    try:
+        serve(app, host=args.host, port=args.port, threads=args.threads)
+    finally:
+        shutdown()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,12 +1,18 @@
 import subprocess
-import tempfile
+import asyncio
 from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
 import json
 import numpy as np
-from typing import Literal
+from typing import Iterator, Literal
 import os
+import time
 import logging
-import ChargeAPI
+from ChargeAPI.API_infrastructure.model_dispatch import ModelDispatcher, decode_worker_output
+from ChargeAPI.API_infrastructure.result_cache import cache_key, model_version
+from ChargeAPI.API_infrastructure.coalescer import RequestCoalescer
+from ChargeAPI.API_infrastructure.charge_files import FILE_TYPES, write_charge_file
+from ChargeAPI.API_infrastructure.results import ChargeResult, charge_result_from_response, batch_charge_results_from_response
 
 CHARGE_MODELS = Literal[
     'EEM',
@@ -36,62 +42,396 @@ model_locations = {
     'MBIS_WB_GAS_ESP_DEFAULT':['naglmbis','/charge_models/mbis_wb_gas_charges_dipole_esp_default.py'],
 }
 
-def _charge_requester(
+#the worker pool, result cache and timing of the charge requests, see ModelDispatcher
+_DISPATCHER = ModelDispatcher(model_locations, 'charge model')
+
+start_worker_pool = _DISPATCHER.start_worker_pool
+stop_worker_pool = _DISPATCHER.stop_worker_pool
+connect_microservices = _DISPATCHER.connect_microservices
+enable_cache = _DISPATCHER.enable_cache
+disable_cache = _DISPATCHER.disable_cache
+cache_stats = _DISPATCHER.cache_stats
+enable_timing = _DISPATCHER.enable_timing
+disable_timing = _DISPATCHER.disable_timing
+timing_summary = _DISPATCHER.timing_summary
+dump_timings = _DISPATCHER.dump_timings
+
+
+_COALESCER = None
+
+def enable_micro_batching(window_ms: float = 5, max_batch_size: int = 64, max_concurrent_batches: int = 4) -> RequestCoalescer:
+    """
+    Coalesce concurrent single molecule requests for the same charge model into batches. Requests arriving
+    within window_ms of each other, up to max_batch_size requests, are run as one batch on one worker and each
+    caller gets the charges of its own molecule. Protein and batched requests are not coalesced.
+    Parameters
+    ----------
+    window_ms: float
+        Milliseconds to wait for more requests after the first request of a batch
+    max_batch_size: int
+        Number of requests which are run straight away as a full batch
+    max_concurrent_batches: int
+        Number of batches which can run at once, e.g. the number of pool workers per model
+    """
+    global _COALESCER
+    if _COALESCER is None:
+        _COALESCER = RequestCoalescer(
+            _run_charge_batch,
+            window=window_ms / 1000,
+            max_batch_size=max_batch_size,
+            max_concurrent_batches=max_concurrent_batches
+        )
+    return _COALESCER
+
+
+def disable_micro_batching() -> None:
+    """
+    Stop coalescing requests, the requests already queued are run first
+    """
+    global _COALESCER
+    if _COALESCER is not None:
+        _COALESCER.close()
+        _COALESCER = None
+
+
+def _run_charge_batch(charge_model: CHARGE_MODELS, molecules: dict[str,str]) -> dict[str,dict[str,any]]:
+    """
+    run a batch of molblocks in memory on one worker and split the response into the output of each molecule
+    """
+    response = _DISPATCHER.run_worker(charge_model, {'molecules': molecules})
+    result = response.get('result') or {}
+    charges = result.get('charges', {})
+    errors = result.get('errors', {})
+    outputs = {}
+    for name in molecules:
+        if name in charges and name not in errors:
+            outputs[name] = {'charge_result': str(charges[name]), 'error': ''}
+        else:
+            #the molecule failed, or the whole batch did
+            outputs[name] = {'charge_result': '', 'error': errors.get(name, response.get('error', ''))}
+    return outputs
+
+
+def _charge_cache_key(charge_model: CHARGE_MODELS, conformer_mol: str, protein: bool) -> str:
+    """
+    key of a single molecule charge request in the result cache
+    """
+    _, script_path = _DISPATCHER.model_paths(charge_model)
+    return cache_key('charge', charge_model, model_version(script_path), conformer_mol, {'protein': protein})
+
+
+def _charge_request_payload(batched: bool, protein: bool, conformer_mol: str, file_type: str = 'json') -> dict[str,any]:
+    """
+    request message for a model worker, the molecule travels in the message rather than on the command line
+    """
+    payload = {'conformer': conformer_mol, 'batched': batched, 'protein': protein}
+    if batched and file_type != 'json':
+        payload['file_type'] = file_type
+    return payload
+
+
+def _typed_charge_requester(
     charge_model: CHARGE_MODELS,
-    batched: Literal['--batched','--not_batched'],
+    conformer_mol: str,
+    batched: bool,
     protein: bool,
+    n_workers: int,
+    dtype: type,
+    ) -> ChargeResult | dict[str,ChargeResult]:
+    """
+    run the charge request and return the charges as arrays, without going through the printed or json text forms.
+    A batch is read from its JSON file and run in memory, split over n_workers workers.
+    """
+    if not batched:
+        response = _DISPATCHER.run_worker(charge_model, {'conformer': conformer_mol, 'protein': protein, 'typed': True})
+        return charge_result_from_response(response, dtype)
+
+    with open(conformer_mol, 'r') as conformer_file:
+        mol_dictionary = json.load(conformer_file)
+    return _molecules_charge_requester(charge_model, mol_dictionary, n_workers, dtype)
+
+
+def _molecules_charge_requester(
+    charge_model: CHARGE_MODELS,
+    mol_dictionary: dict[str,str],
+    n_workers: int,
+    dtype: type,
+    ) -> dict[str,ChargeResult]:
+    """
+    run a batch of molblocks in memory, split over n_workers workers, and return the ChargeResult of each molecule
+    """
+    shards = _split_shards(mol_dictionary, n_workers)
+    responses = _run_shards(charge_model, shards)
+    results = {}
+    for shard, response in zip(shards, responses):
+        results.update(batch_charge_results_from_response(response, list(shard), dtype))
+    return results
+
+
+def _stream_charge_requester(
+    charge_model: CHARGE_MODELS,
+    conformer_mol: str,
+    dtype: type,
+    molecules: dict[str,str] = None,
+    ) -> Iterator[tuple[str,ChargeResult]]:
+    """
+    run a batch on a worker which answers molecule by molecule, yielding each molecule's ChargeResult as it arrives.
+    The batch is the JSON file conformer_mol, or the molecules held in memory
+    """
+    payload = _DISPATCHER.timed_payload(
+        {'molecules': molecules} if molecules is not None else {'conformer': conformer_mol}
+    )
+    start = time.perf_counter()
+    responses = _DISPATCHER.stream(charge_model, payload)
+    try:
+        for response in responses:
+            if response.get('done', False):
+                _DISPATCHER.record_timings(charge_model, response, start)
+                if response['error']:
+                    raise RuntimeError(f"streamed batch failed: {response['error']}")
+                return
+            yield response['molecule'], charge_result_from_response(response, dtype, response['molecule'])
+    finally:
+        #stops the worker if the caller stops early
+        responses.close()
+
+
+def _split_shards(mol_dictionary: dict[str,str], n_shards: int) -> list[dict[str,str]]:
+    """
+    split the molecules into at most n_shards contiguous shards of near equal size, keeping the input order
+    """
+    names = list(mol_dictionary)
+    n_shards = max(1, min(n_shards, len(names)))
+    shard_size, remainder = divmod(len(names), n_shards)
+    shards = []
+    start = 0
+    for i in range(n_shards):
+        stop = start + shard_size + (1 if i < remainder else 0)
+        shards.append({name: mol_dictionary[name] for name in names[start:stop]})
+        start = stop
+    return shards
+
+
+def _run_shards(charge_model: CHARGE_MODELS, shards: list[dict[str,str]]) -> list[dict[str,any]]:
+    """
+    run each shard of molblocks on its own worker at once and return the worker responses in the shard order. If the
+    pool is started it is extended to a worker per shard for the call, rather than the shards queueing for its
+    workers_per_model workers
+    """
+    def run_shards():
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            return list(executor.map(lambda shard: _DISPATCHER.run_worker(charge_model, {'molecules': shard}), shards))
+
+    if _DISPATCHER.pool is None:
+        return run_shards()
+    with _DISPATCHER.pool.extended(charge_model, len(shards)):
+        return run_shards()
+
+
+def _sharded_charge_requester(
+    charge_model: CHARGE_MODELS,
     conformer_mol: str,
+    n_workers: int,
+    file_type: str = 'json',
     ) -> dict[str,any]:
-    
-    if protein:
-        print('protein mode')
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.pdb') as tmp_file:
-            tmp_file.write(conformer_mol)
-            input = tmp_file.name  
-        protein_option = '--protein'
-    else:
-        print('ligand mode')
-        input = conformer_mol
-        protein_option = '--not_protein'
-
-    script_path = f'{os.path.dirname(ChargeAPI.__file__)}'+ model_locations[charge_model][1]
-    # Build the command, passing the temporary file name as the argument.
-    cmd = [
-        "conda", "run", "--no-capture-output", "-n", model_locations[charge_model][0], "python", script_path,
-        "--conformer", input, batched, protein_option  # Now passing the tmp file instead of '-'
-    ]
+    """
+    run a batched charge request as n_workers shards in parallel and write the charges to one charge file in input order
+    Parameters
+    ----------
+    charge_model: CHARGE_MODELS
+        charge model to run
+    conformer_mol: str
+        path to the JSON of molecule names and molblocks
+    n_workers: int
+        number of worker processes to split the molecules over
+    file_type: str
+        type of the charge file
+    """
+    with open(conformer_mol, 'r') as conformer_file:
+        mol_dictionary = json.load(conformer_file)
 
-    # Run the subprocess (note: we no longer use 'input=' since the script will read the file).
-    charge_result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    #the shards are sent in the requests, so no shard files are written
+    responses = _run_shards(charge_model, _split_shards(mol_dictionary, n_workers))
+    charges = {}
+    errors = ''
+    for response in responses:
+        result = response.get('result')
+        if result is None:
+            return {'charge_result': '', 'error': errors + response.get('error', '')}
+        charges.update(result['charges'])
+        #as the unsharded run writes them to stderr
+        errors += ''.join(f'{message}\n' for message in result['errors'].values())
 
-    # Optionally, delete the temporary file after use.
-    if protein:
-            os.remove(input)
-            
-    return prepare_json_outs(charge_result)
+    #same file the unsharded batched run writes
+    charge_file = write_charge_file(charges, f"{os.path.splitext(conformer_mol)[0]}_charges.{file_type}", file_type)
+    json_response = {'charge_result': charge_file, 'error': errors}
+    logging.info(json_response)
+    return json_response
 
 
-def handle_charge_request(charge_model: CHARGE_MODELS, conformer_mol: str, batched: bool = False, protein = False) -> dict[str,any, None]:
+def handle_charge_request(
+    charge_model: CHARGE_MODELS,
+    conformer_mol: str,
+    batched: bool = False,
+    protein = False,
+    n_workers: int = 1,
+    typed: bool = False,
+    dtype: type = np.float64,
+    file_type: str = 'json',
+    stream: bool = False,
+    ) -> dict[str,any, None]:
     """
     handle the charge request and run the correct charge model. Batched option accepts a JSON of molecule names and their
-    corresponding forms in molblocks. 
+    corresponding forms in molblocks. If a worker pool has been started with start_worker_pool the request
+    is run on a resident worker, and if the cache has been enabled with enable_cache single molecule results
+    are reused. With enable_micro_batching, concurrent single molecule requests are run together as batches.
+    In batched mode, n_workers > 1 splits the molecules into n_workers shards which are run in parallel, one
+    worker process each (the pool is extended to n_workers workers for the call), and the charges are merged back into
+    a single charge file in the input order. protein is only available for single molecules.
+    With typed=True the result is a ChargeResult of dtype arrays rather than the JSON output, or in batched mode
+    a dictionary of molecule names and their ChargeResults (no charge file is written). Failed molecules are
+    given as MoleculeError records in the ChargeResult errors.
+    file_type picks the charge file batched runs write: json, or npz, parquet or arrow files of the molecule ids and a
+    flat charge array which can be memory mapped and read by molecule with ChargeAPI.API_infrastructure.charge_files.
+    With stream=True a batched request returns a generator of (molecule name, ChargeResult) pairs, yielded as each
+    molecule finishes rather than once the whole batch has been written to a charge file.
     """
-    if batched:
-        batched_choice = '--batched'
-    else:
-        batched_choice= '--not_batched'
-
-    try:
-        result = _charge_requester(
+    if file_type not in FILE_TYPES:
+        raise ValueError(f"file_type must be one of {FILE_TYPES}")
+    if stream and not batched:
+        raise ValueError("stream is only available for batched requests")
+    if batched and protein:
+        raise ValueError("protein is only available for single molecule requests")
+    #find the model now, so a KeyError from the cache or a worker is not mistaken for an unknown model
+    _DISPATCHER.model_paths(charge_model)
+    if stream:
+        return _stream_charge_requester(charge_model=charge_model, conformer_mol=conformer_mol, dtype=dtype)
+    if typed:
+        return _typed_charge_requester(
             charge_model=charge_model,
-            batched=batched_choice,
+            conformer_mol=conformer_mol,
+            batched=batched,
             protein=protein,
-            conformer_mol=conformer_mol
+            n_workers=n_workers,
+            dtype=dtype
         )
-        return result
-    except KeyError:
-        
-        raise Exception("charge model does not exist")
+    if batched and n_workers > 1:
+        return _sharded_charge_requester(
+            charge_model=charge_model,
+            conformer_mol=conformer_mol,
+            n_workers=n_workers,
+            file_type=file_type
+        )
+    key = None
+    if _DISPATCHER.cache is not None and not batched:
+        key = _charge_cache_key(charge_model, conformer_mol, protein)
+        cached = _DISPATCHER.cache.get(key)
+        if cached is not None:
+            return cached
+    if _COALESCER is not None and not batched and not protein:
+        result = _COALESCER.submit(charge_model, conformer_mol).result()
+    else:
+        #a resident worker if the pool is started, otherwise a one-off worker
+        response = _DISPATCHER.run_worker(
+            charge_model, _charge_request_payload(batched, protein, conformer_mol, file_type)
+        )
+        result = _format_response(response)
+    if key is not None and result['charge_result']:
+        _DISPATCHER.cache.put(key, result)
+    return result
+
+
+def handle_charge_batch(
+    charge_model: CHARGE_MODELS,
+    molecules: dict[str,str],
+    n_workers: int = 1,
+    dtype: type = np.float64,
+    stream: bool = False,
+    ) -> dict[str,ChargeResult] | Iterator[tuple[str,ChargeResult]]:
+    """
+    charges of a batch of molblocks held in memory, such as the molecules posted to the HTTP server, without writing a
+    batch JSON or charge file. The molecules are run on the resident workers if the pool is started.
+    Parameters
+    ----------
+    charge_model: CHARGE_MODELS
+        charge model to run
+    molecules: dict
+        molecule names and their molblocks
+    n_workers: int
+        number of workers to split the molecules over
+    dtype: type
+        float type of the charge arrays
+    stream: bool
+        whether to return a generator of (molecule name, ChargeResult) pairs, yielded as each molecule finishes
+    Returns
+    -------
+    dict or generator
+        molecule names and their ChargeResults in the input order, failed molecules have MoleculeError records
+    """
+    _DISPATCHER.model_paths(charge_model)
+    if not molecules:
+        return iter(()) if stream else {}
+    if stream:
+        return _stream_charge_requester(charge_model=charge_model, conformer_mol=None, dtype=dtype, molecules=molecules)
+    return _molecules_charge_requester(charge_model, molecules, n_workers, dtype)
+
+
+async def handle_charge_request_async(
+    charge_model: CHARGE_MODELS,
+    conformer_mol: str,
+    batched: bool = False,
+    protein = False,
+    typed: bool = False,
+    dtype: type = np.float64,
+    file_type: str = 'json',
+    ) -> dict[str,any, None]:
+    """
+    coroutine version of handle_charge_request, the request runs on a resident worker (or microservice) if the pool
+    is started, otherwise on a one-off worker process run with asyncio, so many requests can be in flight from one
+    event loop. The number of one-off workers running at once in each conda environment is limited,
+    see ChargeAPI.API_infrastructure.async_dispatch.set_concurrency_limit
+    """
+    _DISPATCHER.model_paths(charge_model)
+
+    if typed:
+        if batched:
+            with open(conformer_mol, 'r') as conformer_file:
+                mol_dictionary = json.load(conformer_file)
+            response = await _DISPATCHER.run_worker_async(charge_model, {'molecules': mol_dictionary})
+            return batch_charge_results_from_response(response, list(mol_dictionary), dtype)
+        response = await _DISPATCHER.run_worker_async(charge_model, {'conformer': conformer_mol, 'protein': protein, 'typed': True})
+        return charge_result_from_response(response, dtype)
+
+    key = None
+    if _DISPATCHER.cache is not None and not batched:
+        key = _charge_cache_key(charge_model, conformer_mol, protein)
+        cached = _DISPATCHER.cache.get(key)
+        if cached is not None:
+            return cached
+    if _COALESCER is not None and not batched and not protein:
+        result = await asyncio.wrap_future(_COALESCER.submit(charge_model, conformer_mol))
+    else:
+        response = await _DISPATCHER.run_worker_async(
+            charge_model,
+            _charge_request_payload(batched, protein, conformer_mol, file_type),
+        )
+        result = _format_response(response)
+    if key is not None and result['charge_result']:
+        _DISPATCHER.cache.put(key, result)
+    return result
+
+
+def _format_response(response: dict[str,any]) -> dict[str,any]:
+    """
+    json output of a worker response, the charges are given in the same form the model scripts print them
+    """
+    result = response.get('result')
+    json_response = {
+        'charge_result': '' if result is None else str(result),
+        'error': response.get('error', '')
+    }
+    logging.info(json_response)
+    return json_response
         
 
 def prepare_json_outs(charge_result: subprocess.CompletedProcess) -> json:
@@ -100,17 +440,10 @@ def prepare_json_outs(charge_result: subprocess.CompletedProcess) -> json:
     Paramters
     --------
     charge_result:  subprocess.CompletedProcess
-        Result of the subprocess run command in/out/error info
+        Result of the subprocess run command in/out/error info, the stdout holding the framed
+        messages written by the worker
     """
-    charge_result_list = charge_result.stdout.decode()  # Convert the output to a list of strings
-    # Create JSON response
-    json_response = {
-        'charge_result': charge_result_list.strip('\n\n'),
-        'error': charge_result.stderr.decode()  # Include the error message if any
-    }
-    logging.info(json_response)
-    # Return the charge result as a list and the JSON response    
-    return json_response    
+    return _format_response(decode_worker_output(charge_result))
 
 
 def main():
@@ -0,0 +1,236 @@
+"""
+Python client of the HTTP charge server (see charge_request/api_class.py).
+
+The client keeps a pool of keep-alive connections to the server, splits long lists of molecules into batch
+requests of ``batch_size`` molecules and keeps up to ``max_in_flight`` of them running at once, so bulk jobs pay
+for one connection per request in flight rather than a handshake per molecule. Results are decoded into the same
+ChargeResult and ESPResult arrays as the python module returns.
+
+    with ChargeAPI('http://charge-server:5000') as client:
+        results = client.charges('MBIS', molblocks)
+"""
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional, Union
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from ChargeAPI.API_infrastructure.results import (
+    ChargeResult,
+    ESPResult,
+    MoleculeError,
+    batch_charge_results_from_response,
+    esp_result_from_json,
+)
+
+Molecules = Union[dict[str, str], list[str]]
+
+
+def _esp_entry(entry: Union[str, tuple, list]) -> Union[str, list]:
+    """
+    a molblock, or a molblock and its grid as nested lists, as posted to the server
+    """
+    if isinstance(entry, str):
+        return entry
+    molblock, grid = entry
+    return [molblock, None if grid is None else np.asarray(grid, dtype=float).reshape(-1, 3).tolist()]
+
+
+class ChargeAPI:
+    """Client of a ChargeAPI HTTP server.
+    """
+
+    def __init__(
+        self,
+        url: str = 'http://127.0.0.1:5000',
+        batch_size: int = 64,
+        max_in_flight: int = 4,
+        timeout: Optional[float] = None,
+        dtype: type = np.float64,
+        ):
+        """Open a connection pool to the server
+
+        Parameters
+        ----------
+        url: str
+            base URL of the server
+        batch_size: int
+            most molecules sent in one request
+        max_in_flight: int
+            most requests running on the server at once, and so the size of the connection pool
+        timeout: float, optional
+            seconds to wait for each request, by default no limit
+        dtype: type
+            float type of the result arrays, np.float32 or np.float64
+        """
+        if batch_size < 1 or max_in_flight < 1:
+            raise ValueError('batch_size and max_in_flight must be at least 1')
+        self.url = url.rstrip('/')
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.dtype = dtype
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight, max_retries=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the connections"""
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    def _get(self, path: str) -> dict:
+        response = self.session.get(f'{self.url}{path}', timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _post(self, path: str, body: dict) -> dict:
+        response = self.session.post(f'{self.url}{path}', json=body, timeout=self.timeout)
+        if response.status_code == 404:
+            raise NameError(response.json().get('error', f'{path} does not exist'))
+        response.raise_for_status()
+        return response.json()
+
+    def models(self) -> dict[str, list[str]]:
+        """Charge and ESP models the server can run"""
+        return self._get('/models')
+
+    def health(self) -> dict:
+        """Status of the server and its workers"""
+        return self._get('/health')
+
+    def _run_chunks(
+        self,
+        molecules: Molecules,
+        run_chunk: Callable[[dict], dict],
+        failed: Callable[[str, str], Union[ChargeResult, ESPResult]],
+        ) -> Iterator[tuple[str, Union[ChargeResult, ESPResult]]]:
+        """
+        run the molecules a batch at a time with up to max_in_flight batches in flight, yielding each batch's results as
+        it finishes. A batch the server fails to answer is recorded as failed for each of its molecules
+        """
+        if not isinstance(molecules, dict):
+            molecules = {str(index): molecule for index, molecule in enumerate(molecules)}
+        entries = iter(molecules.items())
+        chunks = iter(lambda: dict(islice(entries, self.batch_size)), {})
+        in_flight = {}
+        for chunk in islice(chunks, self.max_in_flight):
+            in_flight[self._executor.submit(run_chunk, chunk)] = chunk
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except requests.RequestException as e:
+                    results = {name: failed(name, str(e)) for name in chunk}
+                yield from results.items()
+                #keep the same number of batches in flight
+                for next_chunk in islice(chunks, 1):
+                    in_flight[self._executor.submit(run_chunk, next_chunk)] = next_chunk
+
+    def _charge_chunk(self, charge_model: str, chunk: dict[str, str]) -> dict[str, ChargeResult]:
+        response = self._post(f'/charge/{charge_model}', {'molecules': chunk})
+        return batch_charge_results_from_response({'result': response}, list(chunk), self.dtype)
+
+    def iter_charges(self, charge_model: str, molecules: Molecules) -> Iterator[tuple[str, ChargeResult]]:
+        """
+        Charges of the molecules, yielded a batch at a time as the batches finish
+        Parameters
+        ----------
+        charge_model: str
+            charge model to run
+        molecules: dict or list
+            molecule names and their molblocks, or a list of molblocks named by their positions
+        Returns
+        -------
+        generator
+            (molecule name, ChargeResult) pairs, failed molecules have MoleculeError records
+        """
+        return self._run_chunks(
+            molecules,
+            lambda chunk: self._charge_chunk(charge_model, chunk),
+            lambda name, message: ChargeResult(errors=[MoleculeError(name, message)]),
+        )
+
+    def charges(self, charge_model: str, molecules: Molecules) -> dict[str, ChargeResult]:
+        """
+        Charges of the molecules, see iter_charges
+        Returns
+        -------
+        dict
+            molecule names and their ChargeResults in the input order
+        """
+        names = list(molecules) if isinstance(molecules, dict) else [str(index) for index in range(len(molecules))]
+        results = dict(self.iter_charges(charge_model, molecules))
+        return {name: results[name] for name in names}
+
+    def charge(self, charge_model: str, conformer_mol: str) -> ChargeResult:
+        """
+        Charges of one molecule
+        """
+        return self.charges(charge_model, {'molecule': conformer_mol})['molecule']
+
+    def _esp_chunk(self, esp_model: str, chunk: dict, options: dict) -> dict[str, ESPResult]:
+        response = self._post(f'/esp/{esp_model}', dict(options, molecules=chunk))
+        return {
+            name: esp_result_from_json(response['results'].get(name, {}), self.dtype, name) for name in chunk
+        }
+
+    def iter_esp(
+        self,
+        esp_model: str,
+        molecules: Union[dict, list],
+        broken_up: bool = False,
+        theta: Optional[float] = None,
+        multipoles_only: bool = False,
+        ) -> Iterator[tuple[str, ESPResult]]:
+        """
+        ESP of the molecules, yielded a batch at a time as the batches finish
+        Parameters
+        ----------
+        esp_model: str
+            ESP model to run
+        molecules: dict or list
+            molecule names and their molblocks, or their molblocks and (n_points, 3) grids in angstrom, or a list
+            of these named by their positions
+        broken_up: bool
+            whether to return the multipoles rather than the ESP
+        theta: float, optional
+            opening angle of the treecode ESP, by default the exact ESP
+        multipoles_only: bool
+            whether to return only the multipoles and the atoms they sit on
+        Returns
+        -------
+        generator
+            (molecule name, ESPResult) pairs, failed molecules have MoleculeError records
+        """
+        options = {'broken_up': broken_up, 'theta': theta, 'multipoles_only': multipoles_only}
+        if not isinstance(molecules, dict):
+            molecules = {str(index): molecule for index, molecule in enumerate(molecules)}
+        molecules = {name: _esp_entry(entry) for name, entry in molecules.items()}
+        return self._run_chunks(
+            molecules,
+            lambda chunk: self._esp_chunk(esp_model, chunk, options),
+            lambda name, message: ESPResult(errors=[MoleculeError(name, message)]),
+        )
+
+    def esp(self, esp_model: str, molecules: Union[dict, list], **options) -> dict[str, ESPResult]:
+        """
+        ESP of the molecules, see iter_esp
+        Returns
+        -------
+        dict
+            molecule names and their ESPResults in the input order
+        """
+        names = list(molecules) if isinstance(molecules, dict) else [str(index) for index in range(len(molecules))]
+        results = dict(self.iter_esp(esp_model, molecules, **options))
+        return {name: results[name] for name in names}
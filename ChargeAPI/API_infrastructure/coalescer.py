@@ -0,0 +1,124 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+import threading
+import time
+
+
+class RequestCoalescer:
+    """Gathers single molecule requests for the same model into batches.
+
+    Requests arriving within ``window`` seconds of the first request of a batch, up to
+    ``max_batch_size`` requests, are run as one batch with ``run_batch`` and each caller gets the
+    result for its own molecule. This trades up to ``window`` seconds of latency for running one
+    batch in place of many separate requests.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[str, dict[str, str]], dict[str, dict]],
+        window: float = 0.005,
+        max_batch_size: int = 64,
+        max_concurrent_batches: int = 4,
+    ):
+        """
+        Parameters
+        ----------
+        run_batch: callable
+            called with the model and a dictionary of request ids and molecules, returning a
+            dictionary of request ids and results
+        window: float
+            seconds to wait for more requests after the first request of a batch
+        max_batch_size: int
+            number of requests which are run straight away as a full batch
+        max_concurrent_batches: int
+            number of batches which can run at once
+        """
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1')
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._deadlines = {}
+        self._closed = False
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, model: str, conformer_mol: str) -> Future:
+        """
+        Queue a single molecule request
+
+        Parameters
+        ----------
+        model: str
+            model to run the molecule through
+        conformer_mol: str
+            molblock of the molecule
+
+        Returns
+        -------
+        Future
+            resolves to the result for the molecule
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('the request coalescer has been closed')
+            pending = self._pending.setdefault(model, [])
+            if not pending:
+                self._deadlines[model] = time.monotonic() + self.window
+            pending.append((conformer_mol, future))
+            self._condition.notify()
+        return future
+
+    def _ready_models(self, now: float) -> list[str]:
+        return [
+            model for model, pending in self._pending.items()
+            if pending and (len(pending) >= self.max_batch_size or self._deadlines[model] <= now or self._closed)
+        ]
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    ready = self._ready_models(now)
+                    if ready:
+                        break
+                    if self._closed:
+                        return
+                    deadlines = [self._deadlines[model] for model, pending in self._pending.items() if pending]
+                    self._condition.wait(min(deadlines) - now if deadlines else None)
+                batches = []
+                for model in ready:
+                    pending = self._pending[model]
+                    batches.append((model, pending[:self.max_batch_size]))
+                    self._pending[model] = pending[self.max_batch_size:]
+                    #requests left over from a full batch start a new window
+                    self._deadlines[model] = now + self.window
+            for model, batch in batches:
+                self._executor.submit(self._run, model, batch)
+
+    def _run(self, model: str, batch: list[tuple[str, Future]]):
+        molecules = {str(i): conformer_mol for i, (conformer_mol, _) in enumerate(batch)}
+        try:
+            results = self.run_batch(model, molecules)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for i, (_, future) in enumerate(batch):
+            if str(i) in results:
+                future.set_result(results[str(i)])
+            else:
+                future.set_exception(KeyError(f'no result for request {i} of the batch'))
+
+    def close(self):
+        """Run the requests already queued and stop accepting new ones"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
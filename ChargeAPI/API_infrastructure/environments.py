@@ -0,0 +1,202 @@
+import subprocess
+import threading
+import logging
+import time
+import json
+import os
+from typing import NamedTuple, Optional
+
+#set to 1 to always start the models with conda run rather than with the resolved interpreters
+USE_CONDA_RUN_VARIABLE = 'CHARGEAPI_USE_CONDA_RUN'
+#path of the file the conda environment listing is cached in across processes
+ENV_CACHE_VARIABLE = 'CHARGEAPI_ENV_CACHE'
+#seconds the cached listing is trusted for, even if conda's environment directories look unchanged
+ENV_CACHE_TTL = 24 * 60 * 60
+
+_environments = None
+_environments_lock = threading.Lock()
+
+_PROBE = "import json, os, sys; print(json.dumps({'python': sys.executable, 'environ': dict(os.environ)}))"
+
+_resolved = {}
+_resolve_lock = threading.Lock()
+
+
+class ResolvedEnvironment(NamedTuple):
+    """Python interpreter of a conda environment and the variables its activation sets"""
+    python: str
+    variables: dict[str, str]
+
+
+def is_resolved(env: str) -> bool:
+    """
+    Whether resolve_environment has already been run for a conda environment, so calling it will not block
+    """
+    return env in _resolved
+
+
+def resolve_environment(env: str) -> Optional[ResolvedEnvironment]:
+    """
+    Find the python interpreter of a conda environment and the environment variables its activation sets or
+    changes, by running a probe with conda run once. The result is cached for the life of the process.
+
+    Parameters
+    ----------
+    env: str
+        name of the conda environment
+
+    Returns
+    -------
+    ResolvedEnvironment or None
+        the interpreter and activation variables, or None if they could not be found
+    """
+    if env not in _resolved:
+        with _resolve_lock:
+            if env not in _resolved:
+                _resolved[env] = _probe_environment(env)
+    return _resolved[env]
+
+
+def _probe_environment(env: str) -> Optional[ResolvedEnvironment]:
+    try:
+        probe = subprocess.Popen(
+            ["conda", "run", "-n", env, "python", "-c", _PROBE],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = probe.communicate(timeout=300)
+        if probe.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='replace'))
+        #the probe is the last thing printed, after anything the activation scripts print
+        resolved = json.loads(stdout.decode().strip().splitlines()[-1])
+        python = resolved['python']
+        if not os.path.isfile(python):
+            raise FileNotFoundError(python)
+    except Exception as e:
+        logging.info('could not resolve the interpreter of conda environment %s, using conda run: %s', env, e)
+        return None
+
+    variables = {
+        name: value for name, value in resolved['environ'].items() if os.environ.get(name) != value
+    }
+    return ResolvedEnvironment(python=python, variables=variables)
+
+
+def python_command(env: str, *args: str) -> tuple[list[str], Optional[dict[str, str]]]:
+    """
+    Command to run python with arguments in a conda environment, using the environment's interpreter directly
+    when it can be resolved and conda run when it cannot.
+
+    Parameters
+    ----------
+    env: str
+        name of the conda environment
+    *args: str
+        arguments to python
+
+    Returns
+    -------
+    cmd, variables: tuple
+        command to pass to subprocess, and the environment variables to run it with (None to inherit them)
+    """
+    resolved = None if os.environ.get(USE_CONDA_RUN_VARIABLE) == '1' else resolve_environment(env)
+    if resolved is None:
+        return ["conda", "run", "--no-capture-output", "-n", env, "python", *args], None
+    variables = os.environ.copy()
+    variables.update(resolved.variables)
+    return [resolved.python, *args], variables
+
+
+def _env_cache_path() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.environ.get(ENV_CACHE_VARIABLE, os.path.join(cache_home, 'chargeapi', 'conda_envs.json'))
+
+
+def _env_directories() -> list[str]:
+    """
+    Files and directories conda changes when an environment is created or removed
+    """
+    paths = [os.path.join(os.path.expanduser('~'), '.conda', 'environments.txt')]
+    conda_exe = os.environ.get('CONDA_EXE')
+    if conda_exe:
+        paths.append(os.path.join(os.path.dirname(os.path.dirname(conda_exe)), 'envs'))
+    paths.extend(path for path in os.environ.get('CONDA_ENVS_PATH', '').split(os.pathsep) if path)
+    return paths
+
+
+def _env_signature() -> dict[str, Optional[float]]:
+    signature = {}
+    for path in _env_directories():
+        try:
+            signature[path] = os.path.getmtime(path)
+        except OSError:
+            signature[path] = None
+    return signature
+
+
+def _list_environments() -> list[str]:
+    output = subprocess.run(["conda", "info", "--envs"], capture_output=True)
+    return [
+        line.split()[0] for line in output.stdout.decode().split("\n")
+        if line.strip() and not line.startswith('#')
+    ]
+
+
+def _read_env_cache(signature: dict[str, Optional[float]], ttl: float) -> Optional[list[str]]:
+    try:
+        with open(_env_cache_path(), 'r') as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached.get('created', 0) > ttl or cached.get('signature') != signature:
+        return None
+    return cached['environments']
+
+
+def _write_env_cache(environments: list[str], signature: dict[str, Optional[float]]) -> None:
+    cache_path = _env_cache_path()
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        #written to a temporary file and moved into place, so other processes never read half a file
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as cache_file:
+            json.dump({'created': time.time(), 'signature': signature, 'environments': environments}, cache_file)
+        os.replace(temporary_path, cache_path)
+    except OSError as e:
+        logging.info('could not cache the conda environments in %s: %s', cache_path, e)
+
+
+def conda_environments(ttl: float = ENV_CACHE_TTL, refresh: bool = False) -> list[str]:
+    """
+    Names of the conda environments on this machine.
+
+    ``conda info --envs`` is run at most once per process, and its listing is cached on disk for other processes
+    until it is older than ttl seconds or conda's environment directories change.
+
+    Parameters
+    ----------
+    ttl: float
+        seconds the listing cached on disk is used for
+    refresh: bool
+        list the environments with conda again, e.g. after creating one
+
+    Returns
+    -------
+    list[str]
+        environment names, as the first column of ``conda info --envs``
+    """
+    global _environments
+    with _environments_lock:
+        if _environments is None or refresh:
+            signature = _env_signature()
+            environments = None if refresh else _read_env_cache(signature, ttl)
+            if environments is None:
+                environments = _list_environments()
+                _write_env_cache(environments, signature)
+            _environments = environments
+        return list(_environments)
+
+
+def is_env_available(env_name: str) -> bool:
+    """Check if a specific conda environment is available"""
+    return env_name in conda_environments()
@@ -0,0 +1,256 @@
+"""
+Grids to evaluate the ESP on, built from coordinates and elements with numpy.
+
+The grids follow openff-recharge's MSK and lattice grids: MSK grids are Connolly spheres of a given density of points
+per angstrom**2 around each atom at several multiples of its Bondi van der Waals radius, without the points inside the
+scaled sphere of any other atom. Lattice grids are the points of a cubic lattice between inner and outer multiples of
+the radii. Grids are cached by conformer and grid settings, so repeated requests on the same pose skip building them.
+
+This module only needs numpy so it can also be imported by the model worker inside the model environments.
+"""
+from collections import OrderedDict
+from typing import Optional
+import threading
+import hashlib
+import os
+import numpy as np
+
+#Bondi van der Waals radii in angstrom, as used by openff-recharge
+BONDI_RADII = {
+    'H': 1.20, 'He': 1.40, 'Li': 1.82, 'C': 1.70, 'N': 1.55, 'O': 1.52, 'F': 1.47, 'Ne': 1.54, 'Na': 2.27,
+    'Mg': 1.73, 'Si': 2.10, 'P': 1.80, 'S': 1.80, 'Cl': 1.75, 'Ar': 1.88, 'K': 2.75, 'Ga': 1.87, 'As': 1.85,
+    'Se': 1.90, 'Br': 1.85, 'Kr': 2.02, 'In': 1.93, 'Sn': 2.17, 'Sb': 2.06, 'Te': 2.06, 'I': 1.98, 'Xe': 2.16,
+}
+MSK_SHELL_FACTORS = (1.4, 1.6, 1.8, 2.0)
+#grid points per block when checking which points lie inside other atoms
+_BLOCK_POINTS = 1024
+
+
+def vdw_radii(elements: list[str]) -> np.ndarray:
+    """
+    Bondi radii of the elements, in angstrom
+    """
+    try:
+        return np.array([BONDI_RADII[element] for element in elements])
+    except KeyError as e:
+        raise ValueError(f'no van der Waals radius for element {e.args[0]}') from e
+
+
+def connolly_sphere(radius: float, density: float) -> np.ndarray:
+    """
+    Points on a sphere about the origin, spread over latitudes with about density points per angstrom**2
+
+    Parameters
+    ----------
+    radius: float
+        radius of the sphere in angstrom
+    density: float
+        points per angstrom**2
+
+    Returns
+    -------
+    np.ndarray
+        (n_points, 3) points in angstrom
+    """
+    n_points = int(4 * np.pi * radius * radius * density)
+    n_equatorial = int(np.sqrt(n_points * np.pi))
+    n_latitudinal = max(int(n_equatorial / 2), 1)
+
+    phi = np.pi * np.arange(n_latitudinal + 1) / n_latitudinal
+    n_longitudinal = np.maximum((n_equatorial * np.sin(phi)).astype(int), 1)
+    sin_phi = np.repeat(np.sin(phi), n_longitudinal)
+    cos_phi = np.repeat(np.cos(phi), n_longitudinal)
+    #the longitudes of each latitude, 2 pi k / n for k = 1..n
+    latitude_start = np.repeat(np.cumsum(n_longitudinal) - n_longitudinal, n_longitudinal)
+    k = np.arange(len(sin_phi)) - latitude_start + 1
+    theta = 2 * np.pi * k / np.repeat(n_longitudinal, n_longitudinal)
+
+    return radius * np.stack([np.cos(theta) * sin_phi, np.sin(theta) * sin_phi, cos_phi], axis=1)
+
+
+def _outside_atoms(points: np.ndarray, coordinates: np.ndarray, radii: np.ndarray, owners: Optional[np.ndarray]) -> np.ndarray:
+    """
+    Mask of the points outside the spheres of every atom (other than the atom each point was built around)
+    """
+    outside = np.ones(len(points), dtype=bool)
+    if not len(points):
+        return outside
+    reach = radii.max()
+    #blocks of points from the same region of space, so each block is only checked against the atoms around it
+    cells = np.floor((points - points.min(axis=0)) / reach).astype(np.int64)
+    order = np.lexsort((cells[:, 2], cells[:, 1], cells[:, 0]))
+    for start in range(0, len(points), _BLOCK_POINTS):
+        indices = order[start:start + _BLOCK_POINTS]
+        block = points[indices]
+        low, high = block.min(axis=0) - reach, block.max(axis=0) + reach
+        nearby = np.flatnonzero(np.all((coordinates >= low) & (coordinates <= high), axis=1))
+        displacement = block[:, None, :] - coordinates[None, nearby, :]
+        inside = np.einsum('pai,pai->pa', displacement, displacement) < radii[nearby]**2
+        if owners is not None:
+            inside &= owners[indices, None] != nearby[None, :]
+        outside[indices] = ~inside.any(axis=1)
+    return outside
+
+
+def msk_grid(
+    coordinates: np.ndarray,
+    elements: list[str],
+    density: float = 1.0,
+    shell_factors: tuple[float, ...] = MSK_SHELL_FACTORS,
+) -> np.ndarray:
+    """
+    Merz-Singh-Kollman grid around a conformer
+
+    Parameters
+    ----------
+    coordinates: np.ndarray
+        (n_atoms, 3) atom coordinates in angstrom
+    elements: list[str]
+        element symbols of the atoms
+    density: float
+        points per angstrom**2 on each shell
+    shell_factors: tuple
+        multiples of the van der Waals radii the shells are built at
+
+    Returns
+    -------
+    np.ndarray
+        (n_grid, 3) grid points in angstrom
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    radii = vdw_radii(elements)
+    shells = []
+    for scale in shell_factors:
+        spheres = [coordinate + connolly_sphere(radius * scale, density) for coordinate, radius in zip(coordinates, radii)]
+        owners = np.repeat(np.arange(len(spheres)), [len(sphere) for sphere in spheres])
+        shell = np.vstack(spheres)
+        shells.append(shell[_outside_atoms(shell, coordinates, radii * scale, owners)])
+    return np.vstack(shells)
+
+
+def lattice_grid(
+    coordinates: np.ndarray,
+    elements: list[str],
+    spacing: float = 0.5,
+    inner_vdw_scale: float = 1.4,
+    outer_vdw_scale: float = 2.0,
+) -> np.ndarray:
+    """
+    Points of a cubic lattice outside inner_vdw_scale and within outer_vdw_scale times the radius of an atom
+
+    Parameters
+    ----------
+    coordinates: np.ndarray
+        (n_atoms, 3) atom coordinates in angstrom
+    elements: list[str]
+        element symbols of the atoms
+    spacing: float
+        lattice spacing in angstrom
+    inner_vdw_scale, outer_vdw_scale: float
+        multiples of the van der Waals radii the points lie between
+
+    Returns
+    -------
+    np.ndarray
+        (n_grid, 3) grid points in angstrom
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    radii = vdw_radii(elements)
+    reach = outer_vdw_scale * radii.max()
+    axes = [
+        np.arange(low, high + spacing, spacing)
+        for low, high in zip(coordinates.min(axis=0) - reach, coordinates.max(axis=0) + reach)
+    ]
+    lattice = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    #within the outer shell of some atom, and outside the inner shell of every atom
+    within_outer = ~_outside_atoms(lattice, coordinates, radii * outer_vdw_scale, None)
+    lattice = lattice[within_outer]
+    return lattice[_outside_atoms(lattice, coordinates, radii * inner_vdw_scale, None)]
+
+
+GRID_BUILDERS = {'msk': msk_grid, 'lattice': lattice_grid}
+
+
+def grid_settings_from_environment(environ: Optional[dict] = None) -> dict:
+    """
+    Grid type and settings of the models' default grids, from CHARGEAPI_GRID_TYPE (msk by default, or lattice) and
+    CHARGEAPI_GRID_DENSITY (points per angstrom**2 of MSK grids, 1.0 by default) or CHARGEAPI_GRID_SPACING (angstrom
+    between lattice points, 0.5 by default)
+
+    Parameters
+    ----------
+    environ: dict, optional
+        environment variables, os.environ by default
+
+    Returns
+    -------
+    dict
+        the ``grid_type`` and the keyword arguments of its builder, as passed to GridCache.grid
+    """
+    environ = os.environ if environ is None else environ
+    grid_type = environ.get('CHARGEAPI_GRID_TYPE', 'msk')
+    if grid_type == 'msk':
+        return {'grid_type': 'msk', 'density': float(environ.get('CHARGEAPI_GRID_DENSITY', 1.0))}
+    if grid_type == 'lattice':
+        return {'grid_type': 'lattice', 'spacing': float(environ.get('CHARGEAPI_GRID_SPACING', 0.5))}
+    raise ValueError(f'unknown grid type {grid_type}, expected one of {tuple(GRID_BUILDERS)}')
+
+
+def grid_key(coordinates: np.ndarray, elements: list[str], grid_type: str, settings: dict) -> str:
+    """
+    Key of a conformer and grid settings, the coordinates are rounded to the 4 decimals of a molblock
+    """
+    hasher = hashlib.sha256()
+    hasher.update(np.round(np.asarray(coordinates, dtype=np.float64), 4).tobytes())
+    hasher.update(','.join(elements).encode())
+    hasher.update(repr((grid_type, sorted(settings.items()))).encode())
+    return hasher.hexdigest()
+
+
+class GridCache:
+    """Least recently used cache of grids, keyed by conformer and grid settings"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._grids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def grid(self, coordinates: np.ndarray, elements: list[str], grid_type: str = 'msk', **settings) -> np.ndarray:
+        """
+        Grid around a conformer, built with the builder of grid_type and its settings unless it is cached
+
+        Parameters
+        ----------
+        coordinates: np.ndarray
+            (n_atoms, 3) atom coordinates in angstrom
+        elements: list[str]
+            element symbols of the atoms
+        grid_type: str
+            msk or lattice
+        settings:
+            keyword arguments of msk_grid or lattice_grid, e.g. density
+
+        Returns
+        -------
+        np.ndarray
+            (n_grid, 3) read only grid points in angstrom
+        """
+        if grid_type not in GRID_BUILDERS:
+            raise ValueError(f'unknown grid type {grid_type}, expected one of {tuple(GRID_BUILDERS)}')
+        key = grid_key(coordinates, elements, grid_type, settings)
+        with self._lock:
+            if key in self._grids:
+                self._grids.move_to_end(key)
+                self.hits += 1
+                return self._grids[key]
+        grid = GRID_BUILDERS[grid_type](coordinates, elements, **settings)
+        #shared between requests, so it must not be changed in place
+        grid.setflags(write=False)
+        with self._lock:
+            self.misses += 1
+            self._grids[key] = grid
+            while len(self._grids) > self.max_entries:
+                self._grids.popitem(last=False)
+        return grid
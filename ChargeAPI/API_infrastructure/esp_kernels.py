@@ -0,0 +1,241 @@
+"""
+ESP of on-atom multipoles, evaluated on a grid without units.
+
+The multipoles and coordinates are converted to atomic units once, and the grid is then walked in blocks: the
+displacements and distances of a block of grid points from every atom are computed once and the monopole, dipole
+and quadrupole terms accumulated from them in the same pass, so memory stays bounded by the block size rather than
+growing with grid points x atoms. Blocks can be spread over a thread pool, numpy releases the GIL in its kernels.
+
+This module only needs numpy so it can also be imported by the model worker inside the model environments.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import numpy as np
+
+BOHR_PER_ANGSTROM = 1 / 0.529177210903
+#grid point x atom pairs per block, keeping the (block, atoms, 3) displacements at a few MB
+BLOCK_PAIRS = 2**18
+
+
+def multipole_esp(
+    grid: np.ndarray,
+    coordinates: np.ndarray,
+    monopoles: np.ndarray,
+    dipoles: Optional[np.ndarray] = None,
+    quadrupoles: Optional[np.ndarray] = None,
+    block_size: Optional[int] = None,
+    n_threads: int = 1,
+) -> np.ndarray:
+    """
+    ESP of on-atom monopoles, dipoles and quadrupoles on a grid
+
+    Parameters
+    ----------
+    grid: np.ndarray
+        (n_grid, 3) grid points in angstrom
+    coordinates: np.ndarray
+        (n_atoms, 3) atom coordinates in angstrom
+    monopoles: np.ndarray
+        (n_atoms,) on-atom charges in e
+    dipoles: np.ndarray, optional
+        (n_atoms, 3) on-atom dipoles in e.angstrom
+    quadrupoles: np.ndarray, optional
+        (n_atoms, 3, 3) on-atom quadrupoles in e.angstrom**2
+    block_size: int, optional
+        grid points per block, by default enough for BLOCK_PAIRS grid point x atom pairs
+    n_threads: int
+        threads the blocks are spread over
+
+    Returns
+    -------
+    np.ndarray
+        (n_grid,) ESP in hartree/e
+    """
+    grid = np.asarray(grid, dtype=np.float64).reshape(-1, 3) * BOHR_PER_ANGSTROM
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3) * BOHR_PER_ANGSTROM
+    monopoles = np.asarray(monopoles, dtype=np.float64).reshape(-1)
+    if dipoles is not None:
+        dipoles = np.asarray(dipoles, dtype=np.float64).reshape(-1, 3) * BOHR_PER_ANGSTROM
+    if quadrupoles is not None:
+        quadrupoles = np.asarray(quadrupoles, dtype=np.float64).reshape(-1, 3, 3) * BOHR_PER_ANGSTROM**2
+    return _multipole_esp_au(grid, coordinates, monopoles, dipoles, quadrupoles, block_size, n_threads)
+
+
+def _multipole_esp_au(
+    grid: np.ndarray,
+    coordinates: np.ndarray,
+    monopoles: np.ndarray,
+    dipoles: Optional[np.ndarray],
+    quadrupoles: Optional[np.ndarray],
+    block_size: Optional[int] = None,
+    n_threads: int = 1,
+) -> np.ndarray:
+    """
+    multipole_esp with everything already in atomic units
+    """
+    if block_size is None:
+        block_size = max(BLOCK_PAIRS // max(len(coordinates), 1), 1)
+    esp = np.zeros(len(grid))
+
+    def evaluate_block(start: int) -> None:
+        stop = min(start + block_size, len(grid))
+        #atomic units, so the 1/(4 pi epsilon_0) prefactor is 1
+        displacement = grid[start:stop, None, :] - coordinates[None, :, :]
+        inv_distance = 1 / np.sqrt(np.einsum('gai,gai->ga', displacement, displacement))
+        block_esp = inv_distance @ monopoles
+        if dipoles is not None or quadrupoles is not None:
+            inv_distance_cubed = inv_distance**3
+        if dipoles is not None:
+            block_esp += np.einsum('gai,ai,ga->g', displacement, dipoles, inv_distance_cubed, optimize=True)
+        if quadrupoles is not None:
+            #3/2 r.Q.r / |r|**5
+            quadrupole_dot = np.einsum('gai,aij,gaj->ga', displacement, quadrupoles, displacement, optimize=True)
+            block_esp += 1.5 * np.einsum('ga,ga->g', quadrupole_dot, inv_distance_cubed * inv_distance**2)
+        esp[start:stop] = block_esp
+
+    starts = range(0, len(grid), block_size)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(evaluate_block, starts))
+    else:
+        for start in starts:
+            evaluate_block(start)
+    return esp
+
+
+class _Node:
+    """Cell of the octree over the atoms, with the multipoles of its atoms about its centre in atomic units"""
+    __slots__ = ('atoms', 'centre', 'radius', 'children', 'monopole', 'dipole', 'quadrupole')
+
+    def __init__(self, atoms: np.ndarray, coordinates: np.ndarray):
+        self.atoms = atoms
+        self.centre = coordinates[atoms].mean(axis=0)
+        self.radius = np.sqrt(((coordinates[atoms] - self.centre)**2).sum(axis=1).max())
+        self.children = []
+
+
+def _build_tree(
+    atoms: np.ndarray,
+    coordinates: np.ndarray,
+    monopoles: np.ndarray,
+    dipoles: np.ndarray,
+    quadrupoles: np.ndarray,
+    leaf_size: int,
+) -> _Node:
+    node = _Node(atoms, coordinates)
+    #the atoms' multipoles shifted to the centre, in the convention of multipole_esp (3/2 r.Q.r / |r|**5)
+    shift = coordinates[atoms] - node.centre
+    charges = monopoles[atoms]
+    atom_dipoles = dipoles[atoms]
+    node.monopole = charges.sum()
+    node.dipole = atom_dipoles.sum(axis=0) + charges @ shift
+    second_moment = np.einsum('a,ai,aj->ij', charges, shift, shift)
+    second_moment += np.einsum('ai,aj->ij', atom_dipoles, shift) + np.einsum('ai,aj->ij', shift, atom_dipoles)
+    node.quadrupole = quadrupoles[atoms].sum(axis=0) + second_moment - np.trace(second_moment) / 3 * np.eye(3)
+
+    if len(atoms) > leaf_size and node.radius > 0:
+        octant = (coordinates[atoms] > node.centre) @ np.array([1, 2, 4])
+        for i in range(8):
+            child_atoms = atoms[octant == i]
+            if len(child_atoms):
+                node.children.append(_build_tree(child_atoms, coordinates, monopoles, dipoles, quadrupoles, leaf_size))
+    return node
+
+
+def _node_esp(node: _Node, points: np.ndarray) -> np.ndarray:
+    displacement = points - node.centre
+    inv_distance = 1 / np.sqrt(np.einsum('gi,gi->g', displacement, displacement))
+    quadrupole_dot = np.einsum('gi,ij,gj->g', displacement, node.quadrupole, displacement)
+    return (
+        node.monopole * inv_distance
+        + displacement @ node.dipole * inv_distance**3
+        + 1.5 * quadrupole_dot * inv_distance**5
+    )
+
+
+def treecode_esp(
+    grid: np.ndarray,
+    coordinates: np.ndarray,
+    monopoles: np.ndarray,
+    dipoles: Optional[np.ndarray] = None,
+    quadrupoles: Optional[np.ndarray] = None,
+    theta: float = 0.5,
+    leaf_size: int = 32,
+    n_threads: int = 1,
+) -> np.ndarray:
+    """
+    Approximate ESP of on-atom multipoles on a grid with a Barnes-Hut treecode
+
+    The atoms are split into an octree, and each cell holds the multipoles of its atoms about its centre up to the
+    quadrupole. A cell is used as a whole for the grid points it subtends an angle below theta from (its radius over
+    their distance from its centre), otherwise its children are visited; the atoms of the leaves are evaluated exactly.
+    The error of a cell falls as theta**3, theta = 0 is exact.
+
+    Parameters
+    ----------
+    grid: np.ndarray
+        (n_grid, 3) grid points in angstrom
+    coordinates: np.ndarray
+        (n_atoms, 3) atom coordinates in angstrom
+    monopoles: np.ndarray
+        (n_atoms,) on-atom charges in e
+    dipoles: np.ndarray, optional
+        (n_atoms, 3) on-atom dipoles in e.angstrom
+    quadrupoles: np.ndarray, optional
+        (n_atoms, 3, 3) on-atom quadrupoles in e.angstrom**2
+    theta: float
+        opening angle, smaller is more accurate and slower
+    leaf_size: int
+        most atoms in a leaf cell
+    n_threads: int
+        threads the grid is spread over
+
+    Returns
+    -------
+    np.ndarray
+        (n_grid,) ESP in hartree/e
+    """
+    grid = np.asarray(grid, dtype=np.float64).reshape(-1, 3) * BOHR_PER_ANGSTROM
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3) * BOHR_PER_ANGSTROM
+    monopoles = np.asarray(monopoles, dtype=np.float64).reshape(-1)
+    n_atoms = len(coordinates)
+    if dipoles is None:
+        dipoles = np.zeros((n_atoms, 3))
+    dipoles = np.asarray(dipoles, dtype=np.float64).reshape(-1, 3) * BOHR_PER_ANGSTROM
+    if quadrupoles is None:
+        quadrupoles = np.zeros((n_atoms, 3, 3))
+    quadrupoles = np.asarray(quadrupoles, dtype=np.float64).reshape(-1, 3, 3) * BOHR_PER_ANGSTROM**2
+
+    esp = np.zeros(len(grid))
+    if n_atoms == 0:
+        return esp
+    root = _build_tree(np.arange(n_atoms), coordinates, monopoles, dipoles, quadrupoles, leaf_size)
+
+    def evaluate(points: np.ndarray) -> None:
+        #cells still to visit, with the grid points (indices into grid) they are visited for
+        stack = [(root, points)]
+        while stack:
+            node, indices = stack.pop()
+            distance = np.sqrt(((grid[indices] - node.centre)**2).sum(axis=1))
+            far = node.radius < theta * distance
+            if far.any():
+                esp[indices[far]] += _node_esp(node, grid[indices[far]])
+            near = indices[~far]
+            if not len(near):
+                continue
+            if node.children:
+                stack.extend((child, near) for child in node.children)
+                continue
+            #near field of a leaf, evaluated exactly
+            esp[near] += _multipole_esp_au(
+                grid[near], coordinates[node.atoms], monopoles[node.atoms], dipoles[node.atoms], quadrupoles[node.atoms]
+            )
+
+    #each thread owns a contiguous part of the grid, so no two threads add to the same points
+    parts = np.array_split(np.arange(len(grid)), max(n_threads, 1))
+    if n_threads > 1 and len(grid) > 1:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(evaluate, parts))
+    else:
+        evaluate(parts[0])
+    return esp
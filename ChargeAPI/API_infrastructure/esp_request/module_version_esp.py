@@ -1,95 +1,258 @@
 import subprocess
 import json
 import numpy as np
-from typing import Optional, Dict, Any
+from typing import Iterator, Optional, Dict, Any, Tuple
 import os
+import time
 import logging
-import tempfile
-import ChargeAPI
 from openff.units import unit
+from ChargeAPI.API_infrastructure.model_dispatch import ModelDispatcher, decode_worker_output
+from ChargeAPI.API_infrastructure.result_cache import cache_key, model_version
+from ChargeAPI.API_infrastructure.results import (
+    ESPResult,
+    esp_result_from_response,
+    batch_esp_results_from_file,
+    batch_esp_results_from_values,
+)
+from ChargeAPI.API_infrastructure.array_files import ARRAY_FILE_POINTS, write_array, read_array, remove_array
 
 # Define available ESP models and their conda environments/model paths.
 model_locations = {
     'RIN': ['riniker', '/esp_models/riniker_model.py']
 }
 
+# The worker pool, result cache and timing of the ESP requests, see ModelDispatcher.
+_DISPATCHER = ModelDispatcher(model_locations, 'ESP charge model')
+
+start_worker_pool = _DISPATCHER.start_worker_pool
+stop_worker_pool = _DISPATCHER.stop_worker_pool
+connect_microservices = _DISPATCHER.connect_microservices
+enable_cache = _DISPATCHER.enable_cache
+disable_cache = _DISPATCHER.disable_cache
+cache_stats = _DISPATCHER.cache_stats
+enable_timing = _DISPATCHER.enable_timing
+disable_timing = _DISPATCHER.disable_timing
+timing_summary = _DISPATCHER.timing_summary
+dump_timings = _DISPATCHER.dump_timings
+
+def _esp_cache_key(
+    charge_model: str,
+    conformer_mol: str,
+    grid: Optional[unit.Quantity],
+    broken_up: bool,
+    protein: bool,
+    theta: Optional[float] = None
+) -> Optional[str]:
+    """
+    Key of a single molecule ESP request in the result cache, or None if the cache is not enabled.
+    """
+    if _DISPATCHER.cache is None:
+        return None
+    _, script_path = _DISPATCHER.model_paths(charge_model)
+    options = {'broken_up': broken_up, 'protein': protein}
+    if theta is not None:
+        options['theta'] = theta
+    return cache_key(
+        'esp',
+        charge_model,
+        model_version(script_path),
+        conformer_mol,
+        options,
+        None if grid is None else grid.m_as(unit.angstrom),
+    )
+
+def _cache_result(key: Optional[str], json_response: Dict[str, Any]) -> None:
+    """
+    Store a successful result in the result cache.
+    """
+    if key is not None and ('esp_result' in json_response or 'monopole' in json_response):
+        _DISPATCHER.cache.put(key, json_response)
+
+def _esp_request_payload(
+    batched: bool,
+    broken_up: bool,
+    conformer_mol: str,
+    grid: Optional[unit.Quantity],
+    batched_grid: bool,
+    protein: bool,
+    theta: Optional[float] = None,
+    multipoles_only: bool = False,
+    grid_file: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Request message for a model worker, the molecule and grid travel in the message rather than on the command line.
+
+    Grids of ARRAY_FILE_POINTS points or more are written to a .npy file which the worker memory maps, see
+    _read_array_response for the ESP coming back.
+    """
+    payload = {
+        'conformer': conformer_mol,
+        'batched': batched,
+        'broken_up': broken_up,
+        'batched_grid': batched_grid,
+        'protein': protein,
+        'grid': None,
+    }
+    if grid is not None:
+        grid_angstrom = grid.m_as(unit.angstrom)
+        if grid_angstrom.size >= 3 * ARRAY_FILE_POINTS:
+            payload['grid_file'] = write_array(grid_angstrom.reshape(-1, 3))
+        else:
+            payload['grid'] = grid_angstrom.flatten().tolist()
+    if theta is not None:
+        payload['theta'] = theta
+    if multipoles_only:
+        payload['multipoles_only'] = True
+    if grid_file is not None:
+        payload['batch_grid_file'] = os.path.abspath(grid_file)
+    return payload
+
 def _esp_requester(
     charge_model: str,
-    batched: str,
-    broken_up: str,
+    batched: bool,
+    broken_up: bool,
     conformer_mol: str,
     grid: Optional[unit.Quantity],
-    batched_grid: str,
-    protein: bool
+    batched_grid: bool,
+    protein: bool,
+    theta: Optional[float] = None,
+    grid_file: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Internal function to build and execute the ESP charge request.
 
+    The request is sent to a model worker as a framed message over its stdin, either a resident
+    worker from the pool or a one-off worker for this request.
+
     Parameters
     ----------
     charge_model : str
         The ESP charge model to use.
-    batched : str
-        Option for batched mode ('--batched' or '--not_batched').
-    broken_up : str
-        Option for broken-up mode ('--broken_up' or '--not_broken_up').
+    batched : bool
+        Whether to use batched mode.
+    broken_up : bool
+        Whether to return the multipoles rather than the ESP.
     conformer_mol : str
         The molecule conformer string.
-    grid : Optional[np.ndarray]
+    grid : Optional[unit.Quantity]
         Optional grid array.
-    batched_grid : str
-        Option for batched grid ('--batched_grid' or '--not_batched_grid').
+    batched_grid : bool
+        Whether to use batched grids.
     protein : bool
         Whether the molecule is a protein.
+    theta : Optional[float]
+        Opening angle of the treecode ESP, None for the exact ESP.
+    grid_file : Optional[str]
+        NPZ file of the grids of a batch.
 
     Returns
     -------
     Dict[str, Any]
         A JSON-style dictionary containing the result and any errors.
     """
+    key = None if batched else _esp_cache_key(charge_model, conformer_mol, grid, broken_up, protein, theta)
+    if key is not None:
+        cached = _DISPATCHER.cache.get(key)
+        if cached is not None:
+            return cached
+
+    response = _run_worker(
+        charge_model,
+        _esp_request_payload(batched, broken_up, conformer_mol, grid, batched_grid, protein, theta, grid_file=grid_file)
+    )
+    json_response = _format_response(response, batched, broken_up)
+    _cache_result(key, json_response)
+    return json_response
+
+def _run_worker(charge_model: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run a request on a resident worker if the pool is started, otherwise on a one-off worker, and return its response.
+    """
     try:
-        env, model_path = model_locations[charge_model]
-    except KeyError as e:
-        raise Exception("ESP charge model does not exist") from e
-
-    script_path = f'{os.path.dirname(ChargeAPI.__file__)}'+ model_path
-
-    tmp_file_path = None
-    if protein:
-        # Write conformer data to a temporary file in protein mode.
-        with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.pdb') as tmp_file:
-            tmp_file.write(conformer_mol)
-            input_path = tmp_file.name
-        protein_option = '--protein'
-        tmp_file_path = input_path
-    else:
-        input_path = conformer_mol
-        protein_option = '--not_protein'
-
-    # Build the command list.
-    cmd = [
-        "conda", "run", "--no-capture-output", "-n", env, "python", script_path,
-        "--conformer", input_path,
-        batched,
-        broken_up,
-        protein_option
-    ]
+        response = _DISPATCHER.run_worker(charge_model, payload)
+    except BaseException:
+        remove_array(payload.get('grid_file'))
+        raise
+    return _read_array_response(payload, response)
 
-    if grid is not None:
-        np.set_printoptions(threshold=np.inf)
-        grid_str = np.array2string(grid.m.flatten(), separator=' ', precision=8)
-        cmd.extend(["--grid_array", grid_str])
+async def _run_worker_async(charge_model: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Coroutine version of _run_worker.
+    """
+    try:
+        response = await _DISPATCHER.run_worker_async(charge_model, payload)
+    except BaseException:
+        remove_array(payload.get('grid_file'))
+        raise
+    return _read_array_response(payload, response)
 
-    cmd.append(batched_grid)
+def _read_array_response(payload: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Map the ESP a worker wrote to a file, for a grid sent as a file, into the response in place of the values.
 
-    logging.info("Executing command: %s", " ".join(cmd))
-    charge_result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    The grid is not sent back, it is the one in the request. Both files are removed.
+    """
+    grid_file = payload.get('grid_file')
+    if grid_file is None:
+        return response
+    grid = read_array(grid_file, remove=True)
+    result = response.get('result')
+    if isinstance(result, dict) and 'esp_file' in result:
+        result['esp_values'] = read_array(result.pop('esp_file'), remove=True)
+        result['grid'] = grid
+    return response
 
-    # Clean up temporary file if created.
-    if tmp_file_path is not None:
-        os.remove(tmp_file_path)
+def _stream_esp_requester(
+    charge_model: str,
+    conformer_mol: str,
+    broken_up: bool,
+    dtype: type,
+    theta: Optional[float] = None,
+    multipoles_only: bool = False,
+    molecules: Optional[Dict[str, Any]] = None,
+    grid_file: Optional[str] = None
+) -> Iterator[Tuple[str, ESPResult]]:
+    """
+    Run a batch on a worker which answers molecule by molecule, yielding each molecule's ESPResult as it arrives.
 
-    return prepare_json_outs(charge_result, batched == '--batched', broken_up == '--broken_up')
+    The batch is the JSON file conformer_mol, or the molecules held in memory as molblocks and grids. Molecules
+    without a grid take theirs from grid_file, if given.
+    """
+    payload = {'molecules': molecules} if molecules is not None else {'conformer': conformer_mol}
+    payload['broken_up'] = broken_up
+    if theta is not None:
+        payload['theta'] = theta
+    if multipoles_only:
+        payload['multipoles_only'] = True
+    if grid_file is not None:
+        payload['batch_grid_file'] = os.path.abspath(grid_file)
+    payload = _DISPATCHER.timed_payload(payload)
+    start = time.perf_counter()
+    responses = _DISPATCHER.stream(charge_model, payload)
+    try:
+        for response in responses:
+            if response.get('done', False):
+                _DISPATCHER.record_timings(charge_model, response, start)
+                if response['error']:
+                    raise RuntimeError(f"streamed batch failed: {response['error']}")
+                return
+            yield response['molecule'], esp_result_from_response(response, dtype, response['molecule'])
+    finally:
+        # Stops the worker if the caller stops early.
+        responses.close()
+
+def _typed_result(
+    response: Dict[str, Any],
+    batched: bool,
+    broken_up: bool,
+    dtype: type
+) -> ESPResult | Dict[str, ESPResult]:
+    """
+    ESPResult of a worker response, or for a batch an ESPResult for each molecule of its output file.
+    """
+    if batched and response.get('result') is not None:
+        return batch_esp_results_from_file(response['result'], broken_up, dtype)
+    return esp_result_from_response(response, dtype)
 
 def handle_esp_request(
     charge_model: str,
@@ -98,7 +261,13 @@ def handle_esp_request(
     broken_up: bool = False,
     grid: Optional[unit.Quantity] = None,
     batched_grid: bool = False,
-    protein: bool = False
+    protein: bool = False,
+    typed: bool = False,
+    dtype: type = np.float64,
+    stream: bool = False,
+    theta: Optional[float] = None,
+    multipoles_only: bool = False,
+    grid_file: Optional[str] = None
 ) -> Dict[str, Any]:
     """
     Handle the ESP charge request and run the specified charge model.
@@ -116,41 +285,224 @@ def handle_esp_request(
     grid : Optional[np.ndarray], optional
         Optional grid array.
     batched_grid : bool, optional
-        Whether to use batched grid, by default False.
+        Whether a batch writes its ESP as an NPZ file of concatenated arrays and per-molecule offsets (the layout of
+        a grid_file, read with charge_files.read_esp_file) rather than JSON, by default False.
     protein : bool, optional
         Whether the molecule is a protein, by default False.
+    typed : bool, optional
+        Whether to return an ESPResult of arrays rather than the JSON-style output, by default False.
+        In batched mode this is a dictionary of molecule names and their ESPResults.
+    dtype : type, optional
+        Float type of the typed arrays, np.float32 or np.float64, by default np.float64.
+    stream : bool, optional
+        Whether to return a generator of (molecule name, ESPResult) pairs for a batched request, yielded as
+        each molecule finishes rather than once the whole ESP file has been written, by default False. A grid_file
+        is used as for a batch, batched_grid is not available as no ESP file is written.
+    theta : Optional[float], optional
+        Opening angle of a Barnes-Hut treecode evaluation of the ESP, trading accuracy for speed on large systems
+        such as proteins: atoms near a grid point are evaluated exactly and distant groups of atoms by their combined
+        multipoles. Smaller is more accurate, by default None for the exact ESP.
+    multipoles_only : bool, optional
+        Whether to return only the multipoles and the atoms they sit on, without building or sending a grid, by
+        default False. The result is typed (implying broken_up and typed), and the ESP of each ESPResult can then be
+        evaluated in this process on any grid with ESPResult.evaluate_esp, so one prediction serves many grids.
+    grid_file : Optional[str], optional
+        NPZ file with a grid for each molecule of a batch, written with charge_files.write_grid_file, which is
+        memory mapped by the model rather than parsed from the batch JSON. The molecules of the batch JSON may
+        then be given as just their molblocks.
 
     Returns
     -------
     Dict[str, Any]
         A JSON-style dictionary containing the charge result and any errors.
     """
-    batched_option = '--batched' if batched else '--not_batched'
-    broken_up_option = '--broken_up' if broken_up else '--not_broken_up'
-    batched_grid_option = '--batched_grid' if batched_grid else '--not_batched_grid'
-
+    if grid_file is not None and not batched:
+        raise ValueError("grid_file is only available for batched requests")
+    if multipoles_only:
+        broken_up, typed = True, True
+    if stream:
+        if not batched:
+            raise ValueError("stream is only available for batched requests")
+        if batched_grid:
+            raise ValueError("batched_grid writes an ESP file, a streamed batch yields its results instead")
+        # Find the model now, rather than when the generator is first used.
+        _DISPATCHER.model_paths(charge_model)
+        return _stream_esp_requester(
+            charge_model, conformer_mol, broken_up, dtype, theta, multipoles_only, grid_file=grid_file
+        )
+    if typed:
+        payload = _esp_request_payload(
+            batched, broken_up, conformer_mol, grid, batched_grid, protein, theta, multipoles_only, grid_file
+        )
+        return _typed_result(_run_worker(charge_model, payload), batched, broken_up, dtype)
     return _esp_requester(
         charge_model, 
-        batched_option, 
-        broken_up_option, 
+        batched, 
+        broken_up, 
         conformer_mol, 
         grid, 
-        batched_grid_option,
-        protein
+        batched_grid,
+        protein,
+        theta,
+        grid_file
     )
 
-def prepare_json_outs(
-    charge_result: subprocess.CompletedProcess,
+def handle_esp_batch(
+    charge_model: str,
+    molecules: Dict[str, Any],
+    broken_up: bool = False,
+    dtype: type = np.float64,
+    stream: bool = False,
+    theta: Optional[float] = None,
+    multipoles_only: bool = False
+) -> Dict[str, ESPResult] | Iterator[Tuple[str, ESPResult]]:
+    """
+    ESP of a batch of molecules held in memory, such as the molecules posted to the HTTP server, without writing a
+    batch JSON or ESP file.
+
+    The batch runs on one worker, a resident one if the pool is started, which predicts it a chunk of molecules at a
+    time (see assign_esp_chunk). A batch which fails is run again one molecule at a time, so that only the molecules
+    which fail have errors. A streamed batch is run one molecule at a time.
+
+    Parameters
+    ----------
+    charge_model : str
+        The ESP charge model to use.
+    molecules : Dict[str, Any]
+        Molecule names and their molblocks, or their molblocks and (n_points, 3) grids in angstrom (None to build
+        the model's grid).
+    broken_up : bool, optional
+        Whether to return the multipoles rather than the ESP, by default False.
+    dtype : type, optional
+        Float type of the arrays, by default np.float64.
+    stream : bool, optional
+        Whether to return a generator of (molecule name, ESPResult) pairs, yielded as each molecule finishes, by
+        default False.
+    theta : Optional[float], optional
+        Opening angle of the treecode ESP, by default None for the exact ESP.
+    multipoles_only : bool, optional
+        Whether to return only the multipoles and the atoms they sit on, see handle_esp_request, by default False.
+
+    Returns
+    -------
+    Dict[str, ESPResult] or generator
+        Molecule names and their ESPResults in the input order.
+    """
+    _DISPATCHER.model_paths(charge_model)
+    if not molecules:
+        return iter(()) if stream else {}
+    entries = {}
+    for name, entry in molecules.items():
+        molblock, grid = (entry, None) if isinstance(entry, str) else entry
+        entries[name] = [molblock, None if grid is None else np.asarray(grid, dtype=float).flatten().tolist()]
+    broken_up = broken_up or multipoles_only
+    if not stream:
+        payload = {'molecules': entries, 'broken_up': broken_up}
+        if theta is not None:
+            payload['theta'] = theta
+        if multipoles_only:
+            payload['multipoles_only'] = True
+        response = _run_worker(charge_model, payload)
+        if response.get('result') is not None:
+            return batch_esp_results_from_values(response['result'], broken_up, dtype)
+        logging.info("Batch failed, running it one molecule at a time: %s", response.get('error'))
+    results = _stream_esp_requester(
+        charge_model, None, broken_up, dtype, theta, multipoles_only, molecules=entries
+    )
+    if stream:
+        return results
+    return dict(results)
+
+async def handle_esp_request_async(
+    charge_model: str,
+    conformer_mol: str,
+    batched: bool = False,
+    broken_up: bool = False,
+    grid: Optional[unit.Quantity] = None,
+    batched_grid: bool = False,
+    protein: bool = False,
+    typed: bool = False,
+    dtype: type = np.float64,
+    theta: Optional[float] = None,
+    multipoles_only: bool = False,
+    grid_file: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Coroutine version of handle_esp_request.
+
+    The request runs on a resident worker (or microservice) if the pool is started, otherwise on a one-off worker
+    process run with asyncio, so many requests can be in flight from one event loop. The number of one-off workers
+    running at once in each conda environment is limited, see
+    ChargeAPI.API_infrastructure.async_dispatch.set_concurrency_limit.
+
+    Parameters
+    ----------
+    charge_model : str
+        The ESP charge model to use.
+    conformer_mol : str
+        The molecule conformer string.
+    batched : bool, optional
+        Whether to use batched mode, by default False.
+    broken_up : bool, optional
+        Whether to use broken-up mode, by default False.
+    grid : Optional[unit.Quantity], optional
+        Optional grid array.
+    batched_grid : bool, optional
+        Whether a batch writes its ESP as an NPZ file rather than JSON, see handle_esp_request, by default False.
+    protein : bool, optional
+        Whether the molecule is a protein, by default False.
+    typed : bool, optional
+        Whether to return an ESPResult of arrays rather than the JSON-style output, by default False.
+    dtype : type, optional
+        Float type of the typed arrays, by default np.float64.
+    theta : Optional[float], optional
+        Opening angle of the treecode ESP, by default None for the exact ESP.
+    multipoles_only : bool, optional
+        Whether to return only typed multipoles and the atoms they sit on, see handle_esp_request, by default False.
+    grid_file : Optional[str], optional
+        NPZ file with a grid for each molecule of a batch, see handle_esp_request.
+
+    Returns
+    -------
+    Dict[str, Any]
+        A JSON-style dictionary containing the charge result and any errors.
+    """
+    _DISPATCHER.model_paths(charge_model)
+    if grid_file is not None and not batched:
+        raise ValueError("grid_file is only available for batched requests")
+    if multipoles_only:
+        broken_up, typed = True, True
+
+    key = None if batched or typed else _esp_cache_key(charge_model, conformer_mol, grid, broken_up, protein, theta)
+    if key is not None:
+        cached = _DISPATCHER.cache.get(key)
+        if cached is not None:
+            return cached
+
+    payload = _esp_request_payload(
+        batched, broken_up, conformer_mol, grid, batched_grid, protein, theta, multipoles_only, grid_file
+    )
+    response = await _run_worker_async(charge_model, payload)
+    if typed:
+        return _typed_result(response, batched, broken_up, dtype)
+    json_response = _format_response(response, batched, broken_up)
+    _cache_result(key, json_response)
+    return json_response
+
+def _format_response(
+    response: Dict[str, Any],
     batched: bool,
     broken_up: bool
 ) -> Dict[str, Any]:
     """
-    Process the subprocess result and produce a JSON-style output.
+    Produce the JSON-style output of a worker response.
+
+    The values are given in the same form as the model script prints them.
 
     Parameters
     ----------
-    charge_result : subprocess.CompletedProcess
-        The result of the subprocess call containing stdout and stderr.
+    response : Dict[str, Any]
+        The worker response with the ``result`` and ``error``.
     batched : bool
         Indicates whether batched mode was used.
     broken_up : bool
@@ -161,47 +513,61 @@ def prepare_json_outs(
     Dict[str, Any]
         A dictionary with the ESP results and any error messages.
     """
-    output = charge_result.stdout.decode()
-    error = charge_result.stderr.decode()
-
-    if not batched:
-        if not broken_up:
-            try:
-                esp, grid_out = output.split('OO')
-                json_response = {
-                    'esp_result': esp.strip(),
-                    'grid': grid_out.strip(),
-                    'error': error
-                }
-            except ValueError:
-                json_response = {
-                    'result': output.strip(),
-                    'error': error
-                }
-        else:
-            try:
-                monopole, dipole, quadropole, grid_out = output.split('OO')
-                json_response = {
-                    'monopole': monopole.strip(),
-                    'dipole': dipole.strip(),
-                    'quadrupole': quadropole.strip(),
-                    # 'grid': grid_out.strip(),
-                    'error': error
-                }
-            except ValueError:
-                json_response = {
-                    'result': output.strip(),
-                    'error': error
-                }
+    result = response.get('result')
+    error = response.get('error', '')
+
+    if result is None:
+        json_response = {
+            'result': '',
+            'error': error
+        }
+    elif batched:
+        json_response = {
+            'file_path': result,
+            'error': error
+        }
+    elif broken_up:
+        json_response = {
+            'monopole': str(result['monopole']),
+            'dipole': str(result['dipole']),
+            'quadrupole': str(result['quadrupole']),
+            'error': error
+        }
     else:
+        # Values read from array files are arrays, printed as the lists of the JSON path.
         json_response = {
-            'file_path': output.strip(),
+            'esp_result': str(np.asarray(result['esp_values']).tolist()),
+            'grid': str(np.asarray(result['grid']).tolist()),
             'error': error
         }
 
     logging.info("Response: %s", json_response)
     return json_response
 
+def prepare_json_outs(
+    charge_result: subprocess.CompletedProcess,
+    batched: bool,
+    broken_up: bool
+) -> Dict[str, Any]:
+    """
+    Process the subprocess result and produce a JSON-style output.
+
+    Parameters
+    ----------
+    charge_result : subprocess.CompletedProcess
+        The result of the subprocess call, the stdout holding the framed messages written by the worker.
+    batched : bool
+        Indicates whether batched mode was used.
+    broken_up : bool
+        Indicates whether broken-up mode was used.
+
+    Returns
+    -------
+    Dict[str, Any]
+        A dictionary with the ESP results and any error messages.
+    """
+    return _format_response(decode_worker_output(charge_result), batched, broken_up)
+
 def main():
     mol = (
         "\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n"
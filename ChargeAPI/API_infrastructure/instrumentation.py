@@ -0,0 +1,149 @@
+"""
+Latency histograms of the stages of charge and ESP requests.
+
+Timed requests report how long the model worker spent importing the model script, loading the model, and in each
+stage of the request (parsing the molecule, assigning charges or ESP, serializing the response). The host adds the
+request's total round trip time and the time not accounted for by the worker, ``process_overhead``, which for a
+one-off worker is mostly conda activation and interpreter start-up and for a resident worker is the pipe round trip.
+"""
+from typing import Optional
+import threading
+import bisect
+import json
+import math
+
+#stages the worker reports which do not overlap, so their sum is the time spent in the worker
+WORKER_STAGES = ('import', 'load_model', 'request', 'serialize')
+
+
+class LatencyHistogram:
+    """Histogram of latencies in log spaced buckets, from a microsecond to over an hour,
+    with a relative error of at most about 6% in the percentiles.
+    """
+    BUCKETS_PER_DECADE = 20
+    MIN_SECONDS = 1e-6
+    MAX_SECONDS = 1e4
+
+    def __init__(self):
+        n_buckets = int(math.log10(self.MAX_SECONDS / self.MIN_SECONDS) * self.BUCKETS_PER_DECADE)
+        #upper edge of each bucket, with the last bucket holding anything longer
+        self.edges = [self.MIN_SECONDS * 10 ** ((i + 1) / self.BUCKETS_PER_DECADE) for i in range(n_buckets)]
+        self.counts = [0] * (n_buckets + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+        Upper edge of the bucket holding the q-th percentile (0 to 100), capped at the largest latency seen
+        """
+        if self.count == 0:
+            return math.nan
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.edges[i] if i < len(self.edges) else self.max, self.max)
+        return self.max
+
+    def summary(self) -> dict[str, float]:
+        """
+        Count, mean, min, max and the 50th, 90th and 99th percentiles in seconds
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else math.nan,
+            'min': self.min if self.count else math.nan,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else math.nan,
+        }
+
+    def to_dict(self) -> dict:
+        """
+        Summary and the non-empty buckets, keyed by their upper edges
+        """
+        buckets = {
+            (f'{self.edges[i]:.3g}' if i < len(self.edges) else 'inf'): count
+            for i, count in enumerate(self.counts) if count
+        }
+        return dict(self.summary(), buckets=buckets)
+
+
+class TimingRecorder:
+    """Per model, per stage latency histograms of timed requests"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, timings: dict[str, float]) -> None:
+        """
+        Record the stage timings of one request
+
+        Parameters
+        ----------
+        model: str
+            model flag
+        timings: dict
+            seconds spent in each stage
+        """
+        with self._lock:
+            model_histograms = self._histograms.setdefault(model, {})
+            for stage, seconds in timings.items():
+                model_histograms.setdefault(stage, LatencyHistogram()).record(seconds)
+
+    def record_response(self, model: str, worker_timings: Optional[dict[str, float]], total: float) -> None:
+        """
+        Record the timings a worker reported for a request together with the request's round trip time
+
+        Parameters
+        ----------
+        model: str
+            model flag
+        worker_timings: dict or None
+            stage timings from the worker response, nothing is recorded if the worker did not time the request
+        total: float
+            seconds from sending the request (or starting the worker) to having the response
+        """
+        if not worker_timings:
+            return
+        timings = dict(worker_timings, total=total)
+        timings['process_overhead'] = max(total - sum(worker_timings.get(stage, 0.0) for stage in WORKER_STAGES), 0.0)
+        self.record(model, timings)
+
+    def summary(self) -> dict[str, dict[str, dict[str, float]]]:
+        """
+        Summary of each stage of each model, see LatencyHistogram.summary
+        """
+        with self._lock:
+            return {
+                model: {stage: histogram.summary() for stage, histogram in stages.items()}
+                for model, stages in self._histograms.items()
+            }
+
+    def dump(self, file_path: str) -> None:
+        """
+        Write the histograms of each stage of each model to a JSON file
+        """
+        with self._lock:
+            histograms = {
+                model: {stage: histogram.to_dict() for stage, histogram in stages.items()}
+                for model, stages in self._histograms.items()
+            }
+        with open(file_path, 'w') as outfile:
+            json.dump(histograms, outfile, indent=2)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._histograms.clear()
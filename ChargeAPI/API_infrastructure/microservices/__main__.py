@@ -0,0 +1,55 @@
+"""Start the model microservices of conda environments, see ChargeAPI.API_infrastructure.microservices.router"""
+import argparse
+import logging
+import os
+import ChargeAPI
+from ChargeAPI.API_infrastructure.charge_request import module_version
+from ChargeAPI.API_infrastructure.microservices.router import start_microservice
+
+
+def environment_models(env: str) -> dict[str, str]:
+    """
+    Flags and script paths of the charge and ESP models which run in a conda environment
+    """
+    locations = dict(module_version.model_locations)
+    try:
+        from ChargeAPI.API_infrastructure.esp_request import module_version_esp
+        locations.update(module_version_esp.model_locations)
+    except ImportError:
+        logging.warning('openff-units is not installed, the ESP models are not served')
+    package = os.path.dirname(ChargeAPI.__file__)
+    return {
+        model_key: f'{package}{script_path}'
+        for model_key, (model_env, script_path) in locations.items() if model_env == env
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start the model microservices of conda environments')
+    parser.add_argument('envs', nargs='+', help='conda environments to start microservices for')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5101, help='port of the first microservice, the rest follow it')
+    parser.add_argument('--replicas', type=int, default=1, help='microservices started for each environment')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    processes = []
+    port = args.port
+    for env in args.envs:
+        model_scripts = environment_models(env)
+        if not model_scripts:
+            parser.error(f'no models run in conda environment {env}')
+        for _ in range(args.replicas):
+            processes.append(start_microservice(env, port, model_scripts, args.host))
+            print(f'{env}: http://{args.host}:{port}', flush=True)
+            port += 1
+    try:
+        for process in processes:
+            process.wait()
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == '__main__':
+    main()
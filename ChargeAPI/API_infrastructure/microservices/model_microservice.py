@@ -0,0 +1,143 @@
+"""Long-lived HTTP model server, run inside a conda environment.
+
+The microservice loads every model of its conda environment once at start-up and answers the same requests as
+the model worker (see model_worker.py) over HTTP/1.1 with keep-alive, so ChargeAPI can reach it through pooled
+connections from another process or another machine. Only the standard library is used, as the model
+environments do not have a web framework.
+
+    POST /models/<model_key>    request for the model as JSON, answered with the worker's response as JSON, or
+                                for a request with ``stream`` set with the worker's responses as NDJSON lines
+    GET /health                 the models served and the number of requests in flight
+
+Requests are run one at a time, as the models keep per-request settings on themselves, while health checks are
+answered straight away. To serve more requests at once, start more microservices for the environment and
+list them all with the router (see router.py).
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#model_worker is part of ChargeAPI's infrastructure, which sits one directory up from the microservices
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model_worker import load_model, answer, stream_responses
+
+NDJSON = 'application/x-ndjson'
+
+
+class ModelServer(ThreadingHTTPServer):
+    """HTTP server holding the loaded models of one conda environment"""
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], models: dict):
+        super().__init__(address, ModelRequestHandler)
+        self.models = models
+        self.in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        #the models are not thread safe and redirect stderr, which is global, so one request runs at a time
+        self.model_lock = threading.Lock()
+
+    def track(self, change: int):
+        with self._in_flight_lock:
+            self.in_flight += change
+
+
+class ModelRequestHandler(BaseHTTPRequestHandler):
+    #keep-alive, so the router's connections are reused
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_json(404, {'error': f'no route {self.path}'})
+            return
+        self._send_json(200, {
+            'status': 'ok',
+            'models': list(self.server.models),
+            'in_flight': self.server.in_flight,
+        })
+
+    def do_POST(self):
+        prefix = '/models/'
+        model_key = self.path[len(prefix):] if self.path.startswith(prefix) else None
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if model_key not in self.server.models:
+            self._send_json(404, {'error': f'model {model_key} is not served here'})
+            return
+        try:
+            request = json.loads(body)
+        except ValueError as e:
+            self._send_json(400, {'error': f'request is not JSON: {e}'})
+            return
+
+        model = self.server.models[model_key]
+        self.server.track(1)
+        try:
+            with self.server.model_lock:
+                if not request.get('stream', False):
+                    self._send_json(200, answer(model, request))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', NDJSON)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for response in stream_responses(model, request):
+                    self._write_chunk(json.dumps(response).encode() + b'\n')
+                self._write_chunk(b'')
+        finally:
+            self.server.track(-1)
+
+
+def load_models(model_scripts: dict[str, str]) -> dict:
+    """Load the models of the environment, models which fail to load are logged and left out"""
+    models = {}
+    for model_key, model_script in model_scripts.items():
+        try:
+            models[model_key] = load_model(model_script)
+        except Exception:
+            logging.error('could not load %s from %s:\n%s', model_key, model_script, traceback.format_exc())
+    return models
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Model microservice for one conda environment')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument(
+        '--model', action='append', required=True, metavar='KEY=SCRIPT',
+        help='flag of a model and the path to its script, repeated for each model of the environment',
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    models = load_models(dict(model.split('=', 1) for model in args.model))
+    if not models:
+        sys.exit('none of the models could be loaded')
+    server = ModelServer((args.host, args.port), models)
+    logging.info('serving %s on %s:%d', ', '.join(models), args.host, args.port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
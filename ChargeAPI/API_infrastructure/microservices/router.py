@@ -0,0 +1,314 @@
+"""
+Routing of model requests to the model microservices (see model_microservice.py).
+
+The router holds a pool of keep-alive connections to every microservice, checks their health in the background
+to learn which models each one serves, and sends each request to the healthy microservice serving its model with
+the fewest requests in flight. A microservice which cannot be reached is marked down and the request is sent to
+the next one. Starting more microservices for an environment and listing them here is all horizontal scaling
+takes.
+
+MicroserviceRouter answers requests the way WorkerPool does, so ChargeAPI can run its requests on the
+microservices in place of the resident workers, see module_version.connect_microservices. Microservices on other
+machines do not share ChargeAPI's file system: grids written to array files and streamed batch JSON files are sent in
+the requests instead, and batched requests, whose models read the batch JSON and write their output file next to it,
+are refused. Microservices on the same machine, or on a shared file system, can be given every request with
+``shared_filesystem=True``.
+"""
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from typing import Iterator, Optional
+import requests
+from requests.adapters import HTTPAdapter
+import ChargeAPI
+from ChargeAPI.API_infrastructure.environments import python_command
+from ChargeAPI.API_infrastructure.worker_pool import WorkerError
+from ChargeAPI.API_infrastructure.array_files import read_array
+
+MICROSERVICE_SCRIPT = f'{os.path.dirname(ChargeAPI.__file__)}/API_infrastructure/microservices/model_microservice.py'
+
+
+def microservice_command(
+    env: str,
+    port: int,
+    model_scripts: dict[str, str],
+    host: str = '127.0.0.1',
+    ) -> tuple[list[str], Optional[dict[str, str]]]:
+    """
+    Command to start the microservice of a conda environment
+    Parameters
+    ----------
+    env: str
+        conda environment the models run in
+    port: int
+        port to serve on
+    model_scripts: dict
+        flags of the models of the environment and the absolute paths to their scripts
+    host: str
+        interface to serve on
+
+    Returns
+    -------
+    cmd, variables: tuple
+        command to pass to subprocess and the environment variables to run it with, see
+        ChargeAPI.API_infrastructure.environments.python_command
+    """
+    models = [f'--model={model_key}={script_path}' for model_key, script_path in model_scripts.items()]
+    return python_command(env, MICROSERVICE_SCRIPT, '--host', host, '--port', str(port), *models)
+
+
+def start_microservice(env: str, port: int, model_scripts: dict[str, str], host: str = '127.0.0.1') -> subprocess.Popen:
+    """
+    Start the microservice of a conda environment, it serves once its models are loaded, see microservice_command
+    """
+    cmd, variables = microservice_command(env, port, model_scripts, host)
+    return subprocess.Popen(cmd, env=variables)
+
+
+class Microservice:
+    """A model microservice and the pooled connections to it"""
+
+    def __init__(self, url: str, pool_size: int):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.models = set()
+        self.healthy = False
+        #requests this router has in flight on the microservice, and those the microservice last reported
+        self.in_flight = 0
+        self.reported_in_flight = 0
+
+    def load(self) -> tuple[int, int]:
+        return self.in_flight, self.reported_in_flight
+
+
+class MicroserviceRouter:
+    """Least loaded dispatch of model requests over a set of model microservices.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        pool_size: int = 16,
+        health_interval: float = 5.0,
+        timeout: Optional[float] = None,
+        startup_timeout: float = 60.0,
+        shared_filesystem: bool = False,
+        ):
+        """Connect to the microservices and check which models they serve
+
+        Parameters
+        ----------
+        urls: list[str]
+            base URLs of the microservices, e.g. ``http://127.0.0.1:5101``
+        pool_size: int
+            most keep-alive connections kept to each microservice
+        health_interval: float
+            seconds between the background health checks
+        timeout: float, optional
+            seconds to wait for a response, by default no limit as large batches can take a long time
+        startup_timeout: float
+            seconds to wait for every microservice to be healthy, as microservices only serve once their models are
+            loaded. Those still down afterwards are left to the health checks
+        shared_filesystem: bool
+            whether the microservices share ChargeAPI's file system, so requests with file paths can be sent as they are
+        """
+        if not urls:
+            raise ValueError('at least one microservice URL is needed')
+        self.timeout = timeout
+        self.shared_filesystem = shared_filesystem
+        self.services = [Microservice(url, pool_size) for url in urls]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.wait_until_healthy(startup_timeout)
+        self._health_thread = threading.Thread(target=self._check_health_every, args=(health_interval,), daemon=True)
+        self._health_thread.start()
+
+    def check_health(self):
+        """Ask every microservice which models it serves and how busy it is, marking those which do not answer down"""
+        for service in self.services:
+            try:
+                health = service.session.get(f'{service.url}/health', timeout=5).json()
+            except (requests.RequestException, ValueError) as e:
+                if service.healthy:
+                    logging.warning('microservice %s is down: %s', service.url, e)
+                with self._lock:
+                    service.healthy = False
+                continue
+            with self._lock:
+                service.models = set(health.get('models', []))
+                service.reported_in_flight = health.get('in_flight', 0)
+                service.healthy = health.get('status') == 'ok'
+
+    def wait_until_healthy(self, timeout: float) -> bool:
+        """Check the health of the microservices until all of them are healthy or timeout seconds have passed
+
+        Returns
+        -------
+        bool
+            whether every microservice is healthy
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.check_health()
+            down = [service.url for service in self.services if not service.healthy]
+            if not down:
+                return True
+            if time.monotonic() >= deadline:
+                logging.warning('microservices %s are not healthy after %.0f s', ', '.join(down), timeout)
+                return False
+            time.sleep(0.5)
+
+    def _check_health_every(self, interval: float):
+        while not self._stop.wait(interval):
+            self.check_health()
+
+    def _acquire(self, model_key: str, tried: set) -> Microservice:
+        service = self._least_loaded(model_key, tried)
+        if service is None:
+            #a microservice may have come up, or back, since the last health check
+            self.check_health()
+            service = self._least_loaded(model_key, tried)
+        if service is None:
+            raise WorkerError(f'no healthy microservice serves {model_key}')
+        return service
+
+    def _least_loaded(self, model_key: str, tried: set) -> Optional[Microservice]:
+        with self._lock:
+            candidates = [
+                service for service in self.services
+                if service.healthy and model_key in service.models and service not in tried
+            ]
+            if not candidates:
+                return None
+            service = min(candidates, key=Microservice.load)
+            service.in_flight += 1
+        return service
+
+    def _release(self, service: Microservice):
+        with self._lock:
+            service.in_flight -= 1
+
+    def _mark_down(self, service: Microservice, error: Exception):
+        logging.warning('microservice %s is down: %s', service.url, error)
+        with self._lock:
+            service.healthy = False
+
+    def _post(self, model_key: str, payload: dict, stream: bool = False) -> tuple[Microservice, requests.Response]:
+        """
+        post a request to the least loaded microservice serving the model, moving on to the next one if it cannot be
+        reached. The microservice is held until released by the caller.
+        """
+        tried = set()
+        while True:
+            service = self._acquire(model_key, tried)
+            try:
+                response = service.session.post(
+                    f'{service.url}/models/{model_key}', json=payload, stream=stream, timeout=self.timeout
+                )
+                response.raise_for_status()
+                return service, response
+            except requests.ConnectionError as e:
+                self._release(service)
+                self._mark_down(service, e)
+                tried.add(service)
+            except requests.RequestException as e:
+                self._release(service)
+                raise WorkerError(f'microservice {service.url} failed to run {model_key}: {e}') from e
+
+    def _portable(self, payload: dict) -> dict:
+        """
+        the payload with the files the microservice may not reach sent in the request instead: a grid written to an
+        array file, which the caller removes once the response is read, and the JSON of a streamed batch. Batched
+        requests are refused, their models read the batch JSON and write the output file next to it
+        """
+        if self.shared_filesystem:
+            return payload
+        if payload.get('batched', False) or 'batch_grid_file' in payload:
+            raise ValueError(
+                'batched requests read and write files next to the batch JSON, which the microservices may not reach: '
+                'use a typed or streamed batch, or connect to the microservices with shared_filesystem=True'
+            )
+        payload = dict(payload)
+        if 'grid_file' in payload:
+            payload['grid'] = read_array(payload.pop('grid_file')).tolist()
+        if payload.get('stream', False) and 'molecules' not in payload:
+            with open(payload.pop('conformer'), 'r') as conformer_file:
+                payload['molecules'] = json.load(conformer_file)
+        return payload
+
+    def start(self, model_key: str, env: str, script_path: str):
+        """Check a microservice serves the model, the models are loaded when the microservices start"""
+        self._release(self._acquire(model_key, set()))
+
+    @contextlib.contextmanager
+    def extended(self, model_key: str, n_workers: int):
+        """The microservices set how many requests run at once, see WorkerPool.extended"""
+        yield
+
+    def request(self, model_key: str, env: str, script_path: str, payload: dict) -> dict:
+        """Run a request on the least loaded microservice for the model
+
+        Parameters
+        ----------
+        model_key: str
+            flag of the model
+        env: str
+            conda environment the model runs in, the microservices were started in it
+        script_path: str
+            absolute path to the model script, the microservices loaded it
+        payload: dict
+            request to send, as for a model worker
+
+        Returns
+        -------
+        dict
+            response from the microservice, as from a model worker
+        """
+        service, response = self._post(model_key, self._portable(payload))
+        try:
+            return response.json()
+        finally:
+            self._release(service)
+
+    def request_many(self, model_key: str, env: str, script_path: str, payloads: list[dict]) -> list[dict]:
+        """Run several requests for the model, each on the least loaded microservice at the time"""
+        return [self.request(model_key, env, script_path, payload) for payload in payloads]
+
+    def stream(self, model_key: str, env: str, script_path: str, payload: dict) -> Iterator[dict]:
+        """Run a streamed request on the least loaded microservice for the model, yielding its responses as they
+        arrive, see ModelWorker.stream"""
+        service, response = self._post(model_key, self._portable(dict(payload, stream=True)), stream=True)
+        try:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+            self._release(service)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Healthy microservices serving each model, and those with no requests in flight from this router"""
+        stats = {}
+        with self._lock:
+            for service in self.services:
+                if not service.healthy:
+                    continue
+                for model_key in service.models:
+                    model_stats = stats.setdefault(model_key, {'started': 0, 'idle': 0})
+                    model_stats['started'] += 1
+                    model_stats['idle'] += service.in_flight == 0
+        return stats
+
+    def close(self):
+        """Stop the health checks and close the connections"""
+        self._stop.set()
+        self._health_thread.join()
+        for service in self.services:
+            service.session.close()
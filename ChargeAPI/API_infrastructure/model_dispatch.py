@@ -0,0 +1,246 @@
+"""
+Running requests on model workers, shared by the charge and ESP request modules.
+
+A ModelDispatcher holds the model locations of a request module and the opt-in state its requests run with: the
+pool of resident workers (or the microservice router in its place), the result cache and the timing recorder. The
+request modules build the requests and format the responses, the dispatcher finds the model, runs the request on a
+resident or one-off worker and records its timings.
+"""
+import asyncio
+import logging
+import os
+import subprocess
+import time
+from typing import Iterator, Optional
+import ChargeAPI
+from ChargeAPI.API_infrastructure.worker_pool import WorkerPool, worker_command, stream_request
+from ChargeAPI.API_infrastructure.protocol import encode_message, decode_messages, ProtocolError
+from ChargeAPI.API_infrastructure.async_dispatch import run_worker_request
+from ChargeAPI.API_infrastructure.result_cache import ResultCache
+from ChargeAPI.API_infrastructure.instrumentation import TimingRecorder
+
+
+def decode_worker_output(completed: subprocess.CompletedProcess) -> dict:
+    """
+    worker response from the captured output of a one-off worker, with everything written to stderr added to its error
+    """
+    try:
+        messages = decode_messages(completed.stdout)
+    except ProtocolError as e:
+        messages = [{'error': f'{e}\n'}]
+    #the ready message is followed by the response, a worker which failed to start only sends the former
+    response = {'error': ''.join(message.get('error', '') for message in messages) + completed.stderr.decode()}
+    if messages and 'result' in messages[-1]:
+        response['result'] = messages[-1]['result']
+    if messages and 'timings' in messages[-1] and 'ready' not in messages[-1]:
+        #start-up timings from the ready message and request timings from the timed response
+        response['timings'] = {stage: seconds for message in messages for stage, seconds in message.get('timings', {}).items()}
+    return response
+
+
+class ModelDispatcher:
+    """Runs the requests of a set of models on model workers, with the pool, cache and timing switched on or off.
+    """
+
+    def __init__(self, model_locations: dict[str, list[str]], kind: str):
+        """
+        Parameters
+        ----------
+        model_locations: dict
+            model flags and their conda environment and script path, relative to the ChargeAPI package
+        kind: str
+            what the models are, e.g. ``charge model``, for the error of an unknown model
+        """
+        self.model_locations = model_locations
+        self.kind = kind
+        self.pool = None
+        self.cache = None
+        self.timings = None
+
+    def model_paths(self, model_key: str) -> tuple[str, str]:
+        """
+        conda environment and absolute script path of a model, NameError if there is no such model
+        """
+        try:
+            env, model_path = self.model_locations[model_key]
+        except KeyError as e:
+            raise NameError(f"{self.kind} does not exist") from e
+        return env, f'{os.path.dirname(ChargeAPI.__file__)}' + model_path
+
+    def start_worker_pool(self, workers_per_model: int = 1, preload: Optional[list[str]] = None) -> WorkerPool:
+        """
+        Start a pool of resident model workers. Once started, requests run on the warm workers instead of
+        spawning a new process per request.
+        Parameters
+        ----------
+        workers_per_model: int
+            Maximum number of resident workers for each model
+        preload: list[str]
+            Models to start workers for straight away rather than on their first request
+        """
+        if self.pool is None:
+            self.pool = WorkerPool(workers_per_model=workers_per_model)
+        for model_key in preload or []:
+            env, script_path = self.model_paths(model_key)
+            self.pool.start(model_key, env, script_path)
+        return self.pool
+
+    def stop_worker_pool(self) -> None:
+        """
+        Stop the resident model workers, or disconnect the microservices, subsequent requests spawn a process
+        each again
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def connect_microservices(
+        self, urls: list[str], pool_size: int = 16, health_interval: float = 5.0, shared_filesystem: bool = False
+        ):
+        """
+        Run the requests on model microservices, routed to the least loaded one serving each model, in place of the
+        resident workers. Stop with stop_worker_pool.
+        Parameters
+        ----------
+        urls: list[str]
+            base URLs of the microservices, e.g. http://127.0.0.1:5101
+        pool_size: int
+            most keep-alive connections kept to each microservice
+        health_interval: float
+            seconds between the health checks of the microservices
+        shared_filesystem: bool
+            whether the microservices share this machine's file system, which batched requests of a batch JSON need
+        """
+        from ChargeAPI.API_infrastructure.microservices.router import MicroserviceRouter
+
+        self.stop_worker_pool()
+        self.pool = MicroserviceRouter(
+            urls, pool_size=pool_size, health_interval=health_interval, shared_filesystem=shared_filesystem
+        )
+        return self.pool
+
+    def enable_cache(
+        self, memory_entries: int = 1024, disk_path: Optional[str] = None, disk_max_bytes: int = 1024**3
+        ) -> ResultCache:
+        """
+        Cache the results of single molecule requests. Repeated requests for the same conformer (and grid) and model
+        are answered from the cache without starting a worker. Batched requests are not cached.
+        Parameters
+        ----------
+        memory_entries: int
+            Number of results to keep in memory, least recently used results are evicted first
+        disk_path: str
+            Path of an SQLite database to also keep results in across processes, or None for memory only
+        disk_max_bytes: int
+            Size limit of the results kept on disk
+        """
+        if self.cache is None:
+            self.cache = ResultCache(memory_entries=memory_entries, disk_path=disk_path, disk_max_bytes=disk_max_bytes)
+        return self.cache
+
+    def disable_cache(self) -> None:
+        """
+        Stop caching results, the cached results on disk are kept
+        """
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def cache_stats(self) -> dict[str, int]:
+        """
+        Hit and miss counts of the result cache, empty if the cache is not enabled
+        """
+        return self.cache.stats() if self.cache is not None else {}
+
+    def enable_timing(self) -> TimingRecorder:
+        """
+        Time the stages of each request (interpreter start-up, model import and loading, molecule parsing, grid
+        building, charge, ESP or multipole assignment and serialization, plus the round trip) and keep per model,
+        per stage latency histograms of them. Batched requests are timed as a whole.
+        """
+        if self.timings is None:
+            self.timings = TimingRecorder()
+        return self.timings
+
+    def disable_timing(self) -> None:
+        """
+        Stop timing requests, the histograms recorded so far are discarded
+        """
+        self.timings = None
+
+    def timing_summary(self) -> dict[str, dict[str, dict[str, float]]]:
+        """
+        Count, mean and percentiles in seconds of each stage of each model, empty if timing is not enabled
+        """
+        return self.timings.summary() if self.timings is not None else {}
+
+    def dump_timings(self, file_path: str) -> None:
+        """
+        Write the latency histograms of each stage of each model to a JSON file
+        """
+        if self.timings is None:
+            raise RuntimeError("timing is not enabled, see enable_timing")
+        self.timings.dump(file_path)
+
+    def timed_payload(self, payload: dict) -> dict:
+        """
+        ask the worker to time the request if timing is enabled
+        """
+        return dict(payload, timing=True) if self.timings is not None else payload
+
+    def record_timings(self, model_key: str, response: dict, start: float) -> None:
+        """
+        record the stage timings of a worker response, with the round trip time since start
+        """
+        if self.timings is not None:
+            self.timings.record_response(model_key, response.get('timings'), time.perf_counter() - start)
+
+    def run_worker(self, model_key: str, payload: dict) -> dict:
+        """
+        run a request on a resident worker if the pool is started, otherwise on a one-off worker, and return its
+        response
+        """
+        env, script_path = self.model_paths(model_key)
+        payload = self.timed_payload(payload)
+        start = time.perf_counter()
+        if self.pool is not None:
+            response = self.pool.request(model_key, env, script_path, payload)
+        else:
+            logging.info("Executing request with %s in %s", script_path, env)
+            cmd, variables = worker_command(env, script_path)
+            response = decode_worker_output(subprocess.run(
+                cmd,
+                env=variables,
+                input=encode_message(payload),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            ))
+        self.record_timings(model_key, response, start)
+        return response
+
+    async def run_worker_async(self, model_key: str, payload: dict) -> dict:
+        """
+        coroutine version of run_worker, a resident worker is waited on in the event loop's default executor and a
+        one-off worker is run with asyncio, see ChargeAPI.API_infrastructure.async_dispatch
+        """
+        env, script_path = self.model_paths(model_key)
+        payload = self.timed_payload(payload)
+        start = time.perf_counter()
+        if self.pool is not None:
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, self.pool.request, model_key, env, script_path, payload
+            )
+        else:
+            response = decode_worker_output(await run_worker_request(env, script_path, payload))
+        self.record_timings(model_key, response, start)
+        return response
+
+    def stream(self, model_key: str, payload: dict) -> Iterator[dict]:
+        """
+        run a streamed request on a resident worker if the pool is started, otherwise on a one-off worker, yielding
+        its responses as they arrive. The payload is sent as it is, see timed_payload
+        """
+        env, script_path = self.model_paths(model_key)
+        if self.pool is not None:
+            return self.pool.stream(model_key, env, script_path, payload)
+        return stream_request(env, script_path, payload)
@@ -0,0 +1,83 @@
+"""
+Lazily populated registries of the external models in a package.
+
+A model module declares the conda environment it runs in as ``ENV_NAME`` and its name as ``MODULE`` at the top of the
+file, before the body guarded by ``IMPORT_CHECK``, so it can be imported without the model's dependencies. The
+registry only imports the model modules, and lists the conda environments, the first time it is queried.
+"""
+from collections.abc import Mapping
+from typing import Iterable, Iterator, Optional
+import threading
+import importlib
+import pkgutil
+import os
+from ChargeAPI.API_infrastructure.environments import conda_environments
+
+
+class ModelRegistry(Mapping):
+    """Models of a package whose conda environments are available, mapping the model names to their environments"""
+
+    def __init__(self, package: str, path: Iterable[str]):
+        """
+        Parameters
+        ----------
+        package: str
+            name of the package holding the model modules
+        path: list[str]
+            ``__path__`` of the package
+        """
+        self.package = package
+        self.path = list(path)
+        self._models: Optional[dict[str, str]] = None
+        self._lock = threading.Lock()
+
+    def _inspect_modules(self) -> dict[str, str]:
+        """
+        Import each module of the package with IMPORT_CHECK set, and read the environment and name of the models
+        """
+        previous = os.environ.get('IMPORT_CHECK')
+        os.environ['IMPORT_CHECK'] = '1'
+        try:
+            declared = {}
+            for _, module_name, _ in pkgutil.iter_modules(self.path):
+                module = importlib.import_module('.' + module_name, self.package)
+                env_name = getattr(module, 'ENV_NAME', None)
+                if env_name is not None:
+                    declared[getattr(module, 'MODULE', None)] = env_name
+            return declared
+        finally:
+            if previous is None:
+                os.environ.pop('IMPORT_CHECK', None)
+            else:
+                os.environ['IMPORT_CHECK'] = previous
+
+    @property
+    def models(self) -> dict[str, str]:
+        with self._lock:
+            if self._models is None:
+                declared = self._inspect_modules()
+                environments = set(conda_environments())
+                self._models = {model: env for model, env in declared.items() if env in environments}
+            return self._models
+
+    def refresh(self) -> None:
+        """
+        List the conda environments again and inspect the modules on the next query, e.g. after creating an environment
+        """
+        with self._lock:
+            self._models = None
+        conda_environments(refresh=True)
+
+    def __getitem__(self, model: str) -> str:
+        return self.models[model]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.models)
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+    def __repr__(self) -> str:
+        if self._models is None:
+            return f'{type(self).__name__}({self.package!r}, not yet loaded)'
+        return f'{type(self).__name__}({self._models!r})'
@@ -0,0 +1,307 @@
+"""Long-lived model worker, run inside a model's conda environment.
+
+The worker imports a single model script, instantiates its model once and then serves requests
+from stdin until stdin is closed, so the interpreter start-up, library imports and model loading
+are paid once per worker rather than once per request. Requests and responses are framed messages
+(see protocol.py) and are answered in the order they arrive, so requests can be pipelined. This
+script is launched by ChargeAPI for both one-off and resident workers and is not meant to be run
+by hand.
+"""
+import os
+import sys
+import io
+import time
+import inspect
+import argparse
+import importlib
+import contextlib
+import traceback
+
+from protocol import read_message, write_message, encode_message
+
+
+def load_model(model_script: str, timings: dict = None):
+    """Import a model script and instantiate the model class it defines.
+
+    Parameters
+    ----------
+    model_script: str
+        Absolute path to the model script, e.g. ``.../charge_models/mbis_model.py``
+    timings: dict, optional
+        seconds spent importing the script (with the model libraries it imports) and
+        instantiating the model (loading its weights) are added to this as ``import`` and ``load_model``
+
+    Returns
+    -------
+    model
+        Instance of the charge (or ESP) model defined in the script
+    """
+    timings = {} if timings is None else timings
+    model_dir, model_file = os.path.split(os.path.abspath(model_script))
+    #model scripts import their base class as a sibling module
+    sys.path.insert(0, model_dir)
+    start = time.perf_counter()
+    module = importlib.import_module(os.path.splitext(model_file)[0])
+    timings['import'] = time.perf_counter() - start
+    for _, obj in inspect.getmembers(module, inspect.isclass):
+        #only the model defined in this script, not the base class it imports
+        if obj.__module__ == module.__name__ and hasattr(obj, 'subclasses'):
+            start = time.perf_counter()
+            model = obj()
+            timings['load_model'] = time.perf_counter() - start
+            return model
+    raise ImportError(f'no model class found in {model_script}')
+
+
+def protein_to_molblock(pdb_block: str) -> str:
+    """Convert a PDB block to a MolBlock, as the model scripts do in protein mode"""
+    from rdkit import Chem
+
+    mol = Chem.MolFromPDBBlock(pdb_block, removeHs=False)
+    if mol is None:
+        raise ValueError("Failed to parse the PDB block into a valid RDKit molecule.")
+    return Chem.MolToMolBlock(mol)
+
+
+def is_esp_model(model) -> bool:
+    """ESP models build a grid to evaluate the ESP on, charge models do not"""
+    return hasattr(model, 'build_grid')
+
+
+def handle_esp_request(model, conformer_mol: str, request: dict):
+    """Run an ESP request through the resident model
+
+    Returns
+    -------
+    result
+        dictionary of the ESP values and grid (or the ``esp_file`` of the values for a ``grid_file``), or of the
+        multipoles in broken up mode (with the coordinates and elements of the atoms for multipole only requests),
+        or the path to the ESP file in batched mode
+    """
+    import numpy as np
+
+    grid = request.get('grid')
+    grid_file = request.get('grid_file')
+    if grid_file is not None:
+        from array_files import read_array
+        #large grids are memory mapped rather than sent in the message
+        grid = read_array(grid_file).reshape(-1, 3)
+    elif grid is not None:
+        grid = np.array(grid, dtype=float).reshape(-1, 3)
+    batched = request.get('batched', False)
+    broken_up = request.get('broken_up', False)
+    #exact ESP unless the request asks for the treecode
+    model.theta = request.get('theta')
+    #the multipoles and the atoms they sit on, without a grid, for the caller to evaluate the ESP on
+    model.multipoles_only = request.get('multipoles_only', False)
+    #NPZ file of the grids of a batch
+    model.batch_grid_file = request.get('batch_grid_file')
+    result = model(
+        conformer_mol=conformer_mol,
+        batched=batched,
+        broken_up=broken_up,
+        batched_grid=request.get('batched_grid', False),
+        grid=grid,
+    )
+    if batched:
+        return result
+    if broken_up and model.multipoles_only:
+        monopole, dipole, quadrupole, coordinates, elements = result
+        return {
+            'monopole': monopole,
+            'dipole': dipole,
+            'quadrupole': quadrupole,
+            'coordinates': coordinates,
+            'elements': elements,
+        }
+    if broken_up:
+        monopole, dipole, quadrupole = result
+        return {'monopole': monopole, 'dipole': dipole, 'quadrupole': quadrupole}
+    values, esp_grid = result
+    if grid_file is not None:
+        from array_files import write_array
+        #the ESP goes back the way the grid came, which the caller already has
+        return {'esp_file': write_array(values, os.path.dirname(grid_file))}
+    return {'esp_values': np.asarray(values).tolist(), 'grid': np.asarray(esp_grid).tolist()}
+
+
+def handle_request(model, request: dict):
+    """Run a single request through the resident model
+
+    Parameters
+    ----------
+    model:
+        Resident model instance
+    request: dict
+        Request with the ``conformer`` (MolBlock, PDB block or batched json path) and the
+        ``batched``, ``file_type``, ``protein`` and ``typed`` options, plus the grid options for ESP models, or with
+        ``molecules``, a dictionary of names and molblocks (or molblocks and grids for ESP models) to run as one batch
+
+    Returns
+    -------
+    result
+        list of charges (or dictionary of properties if typed), ESP results or, in batched mode, the
+        path to the output file. For a batch of ``molecules`` the charges and errors of each molecule, or the ESP
+        results of each molecule as written to a batch's ESP JSON
+    """
+    if 'molecules' in request and is_esp_model(model):
+        #a batch held in memory, run a chunk at a time without a batch JSON or ESP file
+        model.theta = request.get('theta')
+        model.multipoles_only = request.get('multipoles_only', False)
+        model.batch_grid_file = None
+        return model.assign_esp_batched(request['molecules'], request.get('broken_up', False))
+    if 'molecules' in request:
+        #a batch of molblocks run in memory, as coalesced by ChargeAPI
+        charges, errors = model.assign_charges_batched(request['molecules'])
+        return {'charges': charges, 'errors': errors}
+    conformer_mol = request['conformer']
+    if request.get('protein', False):
+        conformer_mol = protein_to_molblock(conformer_mol)
+    if is_esp_model(model):
+        return handle_esp_request(model, conformer_mol, request)
+    if request.get('typed', False):
+        #charges and any other properties, rather than the charges alone
+        with model.timed('convert_to_charge_format'):
+            charge_format = model.convert_to_charge_format(conformer_mol)
+        return model.assign_properties(charge_format)
+    if request.get('batched', False):
+        #npz, parquet or arrow rather than the json charge file
+        model.file_type = request.get('file_type', 'json')
+    return model(conformer_mol=conformer_mol, batched=request.get('batched', False))
+
+
+def stream_request(model, request: dict):
+    """Run a batch one molecule at a time
+
+    Parameters
+    ----------
+    model:
+        Resident model instance
+    request: dict
+        Request with the ``conformer`` path of the batch JSON (molblocks, or molblocks and grids for
+        ESP models) or the ``molecules`` themselves, and the ``broken_up``, ``theta``, ``multipoles_only`` and
+        ``batch_grid_file`` options for ESP models
+
+    Yields
+    ------
+    name, result, error: tuple
+        name of each molecule, its properties (as for a typed request) or ESP result, and its error
+        output. A molecule which fails has a result of None and its traceback as the error
+    """
+    molecules = request.get('molecules') or model.molfile_to_dict(request['conformer'])
+    grid_file = None
+    if request.get('batch_grid_file') is not None:
+        from charge_files import read_esp_file
+        #the grids of the batch are memory mapped from the grid file
+        grid_file = read_esp_file(request['batch_grid_file'])
+    for name, entry in molecules.items():
+        err_buf = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(err_buf):
+                if is_esp_model(model):
+                    #molecules whose grids are in the grid file may be given without one
+                    molblock, grid = (entry, None) if isinstance(entry, str) else entry
+                    if grid is None and grid_file is not None and name in grid_file:
+                        grid = grid_file[name]['grid']
+                    options = {key: request[key] for key in ('broken_up', 'theta', 'multipoles_only') if key in request}
+                    result = handle_esp_request(model, molblock, {'grid': grid, **options})
+                else:
+                    with model.timed('convert_to_charge_format'):
+                        charge_format = model.convert_to_charge_format(entry)
+                    result = model.assign_properties(charge_format)
+            error = err_buf.getvalue()
+        except Exception:
+            result = None
+            error = err_buf.getvalue() + traceback.format_exc()
+        yield name, result, error
+
+
+def start_timing(model, request: dict) -> bool:
+    """Start recording the model's stage timings if the request asks for them"""
+    if not request.get('timing', False):
+        return False
+    model.timings = {}
+    return True
+
+
+def stop_timing(model, response: dict, start: float) -> dict:
+    """Stop recording and add the stage timings to the response
+
+    The whole request is timed as ``request``, and encoding the response as ``serialize``.
+    """
+    timings = dict(model.timings or {}, request=time.perf_counter() - start)
+    model.timings = None
+    serialize_start = time.perf_counter()
+    encode_message(response)
+    timings['serialize'] = time.perf_counter() - serialize_start
+    return dict(response, timings=timings)
+
+
+def stream_responses(model, request: dict):
+    """Answer a streamed request with a response per molecule as it finishes, then a ``done`` response,
+    which holds the timings summed over the batch for timed requests"""
+    timed = start_timing(model, request)
+    start = time.perf_counter()
+    try:
+        for name, result, error in stream_request(model, request):
+            yield {'id': request.get('id'), 'molecule': name, 'result': result, 'error': error}
+        error = ''
+    except Exception:
+        error = traceback.format_exc()
+    response = {'id': request.get('id'), 'done': True, 'error': error}
+    yield stop_timing(model, response, start) if timed else response
+
+
+def answer(model, request: dict) -> dict:
+    """Run a request through the resident model and build its response, with anything the model wrote to
+    stderr, or the traceback if it failed, as the ``error``"""
+    timed = start_timing(model, request)
+    start = time.perf_counter()
+    err_buf = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(err_buf):
+            result = handle_request(model, request)
+        error = err_buf.getvalue()
+    except Exception:
+        result = None
+        error = err_buf.getvalue() + traceback.format_exc()
+    response = {'id': request.get('id'), 'result': result, 'error': error}
+    return stop_timing(model, response, start) if timed else response
+
+
+def serve(model, requests_in, responses_out):
+    """Serve framed requests until the input stream is closed"""
+    while True:
+        request = read_message(requests_in)
+        if request is None:
+            break
+        if request.get('stream', False):
+            for response in stream_responses(model, request):
+                write_message(responses_out, response)
+            continue
+        write_message(responses_out, answer(model, request))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resident model worker')
+    parser.add_argument('--model_script', type=str, help='Path to the model script to serve', required=True)
+    args = parser.parse_args()
+
+    #keep the real stdout for responses and send anything the models print to stderr
+    responses_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    startup_timings = {}
+    try:
+        model = load_model(args.model_script, startup_timings)
+    except Exception:
+        write_message(responses_out, {'ready': False, 'error': traceback.format_exc()})
+        sys.exit(1)
+
+    write_message(responses_out, {'ready': True, 'error': '', 'timings': startup_timings})
+    serve(model, sys.stdin.buffer, responses_out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Framed message protocol between ChargeAPI and the model workers.
+
+Every message is a JSON document prefixed with its length as a 4 byte big-endian unsigned integer,
+so MolBlocks, PDB blocks and results of any size can be sent over a pipe without going through
+the command line and without ambiguity about where one message stops and the next starts.
+Numbers are sent as JSON numbers, which round trip python floats exactly.
+
+This module only uses the standard library as it is imported both by ChargeAPI and, as a sibling
+module, by the model worker running in the model's conda environment.
+"""
+import json
+import struct
+from typing import BinaryIO, Optional
+
+HEADER = struct.Struct('>I')
+
+
+class ProtocolError(RuntimeError):
+    """Raised when a stream does not contain a complete message"""
+
+
+def encode_message(payload: dict) -> bytes:
+    """Encode a message as a length-prefixed frame
+
+    Parameters
+    ----------
+    payload: dict
+        JSON serialisable message
+
+    Returns
+    -------
+    bytes
+        framed message
+    """
+    body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return HEADER.pack(len(body)) + body
+
+
+def write_message(stream: BinaryIO, payload: dict) -> None:
+    """Write a framed message to a binary stream and flush it"""
+    stream.write(encode_message(payload))
+    stream.flush()
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_message(stream: BinaryIO) -> Optional[dict]:
+    """Read a framed message from a binary stream
+
+    Parameters
+    ----------
+    stream: BinaryIO
+        stream to read from
+
+    Returns
+    -------
+    dict or None
+        the message, or None if the stream was closed before a new message started
+    """
+    header = _read_exactly(stream, HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise ProtocolError('stream closed part way through a message header')
+    (size,) = HEADER.unpack(header)
+    body = _read_exactly(stream, size)
+    if len(body) < size:
+        raise ProtocolError(f'stream closed after {len(body)} of {size} message bytes')
+    return json.loads(body)
+
+
+def decode_messages(data: bytes) -> list[dict]:
+    """Decode all of the framed messages in a buffer, e.g. the captured stdout of a worker
+
+    Parameters
+    ----------
+    data: bytes
+        concatenated framed messages
+
+    Returns
+    -------
+    list[dict]
+        messages in the order they were written
+    """
+    messages = []
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < HEADER.size:
+            raise ProtocolError('buffer ends part way through a message header')
+        (size,) = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        if len(data) - offset < size:
+            raise ProtocolError(f'buffer ends after {len(data) - offset} of {size} message bytes')
+        messages.append(json.loads(data[offset:offset + size]))
+        offset += size
+    return messages
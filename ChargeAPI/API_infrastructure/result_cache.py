@@ -0,0 +1,251 @@
+import collections
+import threading
+import functools
+import hashlib
+import sqlite3
+import json
+import time
+import os
+from typing import Optional
+import numpy as np
+
+
+def _canonical_token(token: str) -> str:
+    """Coordinates and other decimals to a fixed precision, with -0.0000 and 0.0000 made the same"""
+    if '.' in token:
+        try:
+            return f'{float(token) + 0.0:.4f}'
+        except ValueError:
+            pass
+    return token
+
+
+def canonical_molecule_hash(conformer_mol: str) -> str:
+    """
+    Hash of the topology and coordinates of a MolBlock (or PDB block), independent of the MolBlock header
+    and of whitespace and number formatting, so the same conformer written twice hashes the same.
+
+    Parameters
+    ----------
+    conformer_mol: str
+        MolBlock or PDB block
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    lines = conformer_mol.splitlines()
+    if 'V2000' in conformer_mol or 'V3000' in conformer_mol:
+        #the name, program/timestamp and comment lines say nothing about the molecule
+        lines = lines[3:]
+    canonical = '\n'.join(
+        ' '.join(_canonical_token(token) for token in line.split()) for line in lines if line.strip()
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def grid_hash(grid: Optional[np.ndarray]) -> str:
+    """
+    Hash of a grid in angstrom, rounded so numerically identical grids hash the same
+    """
+    if grid is None:
+        return ''
+    grid = np.round(np.asarray(grid, dtype=np.float64).reshape(-1, 3), 6) + 0.0
+    return hashlib.sha256(grid.tobytes()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(path: str, mtime: float) -> str:
+    with open(path, 'rb') as script:
+        return hashlib.sha256(script.read()).hexdigest()
+
+
+def model_version(script_path: str) -> str:
+    """
+    Version of a model, the hash of its model script, so editing a model invalidates its cached results
+    """
+    return _file_hash(script_path, os.path.getmtime(script_path))
+
+
+def cache_key(kind: str, model: str, version: str, conformer_mol: str, options: dict, grid: Optional[np.ndarray] = None) -> str:
+    """
+    Key of a result in the cache
+
+    Parameters
+    ----------
+    kind: str
+        type of request, e.g. charge or esp
+    model: str
+        model flag
+    version: str
+        model version, see model_version
+    conformer_mol: str
+        MolBlock or PDB block
+    options: dict
+        any request options which change the result
+    grid: np.ndarray, optional
+        grid in angstrom for ESP requests
+
+    Returns
+    -------
+    str
+        hex digest
+    """
+    key = json.dumps(
+        [kind, model, version, options, canonical_molecule_hash(conformer_mol), grid_hash(grid)],
+        sort_keys=True,
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class MemoryCache:
+    """Least recently used cache of results in memory, holding at most max_entries results"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache:
+    """Least recently used cache of results in an SQLite database, holding at most max_bytes of results"""
+
+    def __init__(self, path: str, max_bytes: int = 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            with self._connection:
+                self._connection.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, value: dict) -> None:
+        data = json.dumps(value)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, data, len(data), time.time()),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        while total > self.max_bytes:
+            key, size = self._connection.execute(
+                'SELECT key, size FROM results ORDER BY last_access LIMIT 1'
+            ).fetchone()
+            self._connection.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM results')
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+class ResultCache:
+    """Two tier result cache, a memory tier in front of an optional disk tier.
+
+    Results found on disk are promoted to the memory tier, and hits and misses are counted for each tier.
+    """
+
+    def __init__(self, memory_entries: int = 1024, disk_path: Optional[str] = None, disk_max_bytes: int = 1024**3):
+        self.memory = MemoryCache(memory_entries)
+        self.disk = DiskCache(disk_path, disk_max_bytes) if disk_path is not None else None
+        self._counts = collections.Counter()
+        #requests from the server threads, the async and the sharded paths count hits at once
+        self._counts_lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._counts_lock:
+            self._counts[name] += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Cached result for a key, or None if it is not in either tier
+        """
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            return dict(value)
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self._count('disk_hits')
+                self.memory.put(key, value)
+                return dict(value)
+        self._count('misses')
+        return None
+
+    def put(self, key: str, value: dict) -> None:
+        """
+        Store a result in both tiers
+        """
+        self.memory.put(key, dict(value))
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Hit and miss counts and the number of entries in each tier
+        """
+        with self._counts_lock:
+            counts = dict(self._counts)
+        return {
+            'memory_hits': counts.get('memory_hits', 0),
+            'disk_hits': counts.get('disk_hits', 0),
+            'misses': counts.get('misses', 0),
+            'memory_entries': len(self.memory),
+            'disk_entries': len(self.disk) if self.disk is not None else 0,
+        }
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+        with self._counts_lock:
+            self._counts.clear()
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
@@ -0,0 +1,351 @@
+from dataclasses import dataclass, field
+from typing import Optional
+import json
+import numpy as np
+from ChargeAPI.API_infrastructure.charge_files import read_esp_file
+
+
+@dataclass
+class MoleculeError:
+    """A molecule which failed, and why"""
+    molecule: str
+    message: str
+
+
+@dataclass
+class ChargeResult:
+    """Charges of a molecule as arrays
+
+    Attributes
+    ----------
+    charges: np.ndarray
+        (n_atoms,) partial charges in e, None if the molecule failed
+    dipoles: np.ndarray
+        (n_atoms, 3) on-atom dipoles, for the models which predict them
+    errors: list[MoleculeError]
+        why the molecule failed, empty if it did not
+    log: str
+        anything else the model wrote to stderr
+    """
+    charges: Optional[np.ndarray] = None
+    dipoles: Optional[np.ndarray] = None
+    errors: list[MoleculeError] = field(default_factory=list)
+    log: str = ''
+
+    @property
+    def ok(self) -> bool:
+        return self.charges is not None and not self.errors
+
+
+@dataclass
+class ESPResult:
+    """ESP, or the multipoles which produce it, of a molecule as arrays
+
+    Attributes
+    ----------
+    esp: np.ndarray
+        (n_grid,) ESP in hartree/e
+    grid: np.ndarray
+        (n_grid, 3) grid the ESP was evaluated on, in angstrom
+    monopoles: np.ndarray
+        (n_atoms,) on-atom monopoles in e
+    dipoles: np.ndarray
+        (n_atoms, 3) on-atom dipoles in e.angstrom
+    quadrupoles: np.ndarray
+        (n_atoms, 3, 3) on-atom quadrupoles in e.angstrom**2
+    coordinates: np.ndarray
+        (n_atoms, 3) coordinates of the atoms the multipoles sit on in angstrom, for multipole only requests
+    elements: list[str]
+        element symbols of the atoms, for multipole only requests
+    errors: list[MoleculeError]
+        why the molecule failed, empty if it did not
+    log: str
+        anything else the model wrote to stderr
+    """
+    esp: Optional[np.ndarray] = None
+    grid: Optional[np.ndarray] = None
+    monopoles: Optional[np.ndarray] = None
+    dipoles: Optional[np.ndarray] = None
+    quadrupoles: Optional[np.ndarray] = None
+    coordinates: Optional[np.ndarray] = None
+    elements: Optional[list[str]] = None
+    errors: list[MoleculeError] = field(default_factory=list)
+    log: str = ''
+
+    @property
+    def ok(self) -> bool:
+        return (self.esp is not None or self.monopoles is not None) and not self.errors
+
+    def evaluate_esp(self, grid: np.ndarray, theta: Optional[float] = None, n_threads: int = 1) -> np.ndarray:
+        """
+        ESP of the multipoles on a grid, evaluated in this process
+
+        Parameters
+        ----------
+        grid: np.ndarray
+            (n_grid, 3) grid points in angstrom
+        theta: float, optional
+            opening angle of the treecode for large systems, by default the ESP is exact
+        n_threads: int
+            threads the grid is spread over
+
+        Returns
+        -------
+        np.ndarray
+            (n_grid,) ESP in hartree/e
+        """
+        from ChargeAPI.API_infrastructure.esp_kernels import multipole_esp, treecode_esp
+
+        if self.monopoles is None or self.coordinates is None:
+            raise ValueError('the ESP can only be evaluated from the multipoles and coordinates of a multipole only request')
+        multipoles = dict(
+            grid=grid,
+            coordinates=self.coordinates,
+            monopoles=self.monopoles,
+            dipoles=self.dipoles,
+            quadrupoles=self.quadrupoles,
+            n_threads=n_threads,
+        )
+        if theta is None:
+            return multipole_esp(**multipoles)
+        return treecode_esp(theta=theta, **multipoles)
+
+
+def _array(values, dtype, shape: tuple = (-1,)) -> Optional[np.ndarray]:
+    if values is None:
+        return None
+    return np.asarray(values, dtype=dtype).reshape(shape)
+
+
+def charge_result_from_response(response: dict, dtype: type = np.float64, molecule: str = '') -> ChargeResult:
+    """
+    Build a ChargeResult from a worker response to a typed charge request
+
+    Parameters
+    ----------
+    response: dict
+        worker response, whose ``result`` holds the ``charges`` and optionally the ``dipoles``
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+    molecule: str
+        name of the molecule, used in the error records
+
+    Returns
+    -------
+    ChargeResult
+    """
+    result = response.get('result')
+    error = response.get('error', '')
+    if result is None:
+        return ChargeResult(errors=[MoleculeError(molecule, error)])
+    return ChargeResult(
+        charges=_array(result.get('charges'), dtype),
+        dipoles=_array(result.get('dipoles'), dtype, (-1, 3)),
+        log=error,
+    )
+
+
+def batch_charge_results_from_response(
+    response: dict, molecules: list[str], dtype: type = np.float64
+) -> dict[str, ChargeResult]:
+    """
+    Build a ChargeResult for each molecule of a worker response to a batch of molecules
+
+    Parameters
+    ----------
+    response: dict
+        worker response, whose ``result`` holds the ``charges`` and ``errors`` of each molecule
+    molecules: list[str]
+        names of the molecules in the batch, in order
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+
+    Returns
+    -------
+    dict[str, ChargeResult]
+        results in the order of the molecules
+    """
+    result = response.get('result') or {}
+    charges = result.get('charges', {})
+    errors = result.get('errors', {})
+    results = {}
+    for name in molecules:
+        if name in errors or name not in charges:
+            #the molecule failed, or the whole batch did
+            message = errors.get(name, response.get('error', ''))
+            results[name] = ChargeResult(errors=[MoleculeError(name, message)])
+        else:
+            results[name] = ChargeResult(charges=_array(charges[name], dtype))
+    return results
+
+
+def esp_result_from_values(values: dict, dtype: type = np.float64, log: str = '') -> ESPResult:
+    """
+    Build an ESPResult from the ESP values and grid, or the multipoles, of a molecule
+
+    Parameters
+    ----------
+    values: dict
+        ``esp_values`` and ``grid``, or ``monopole``, ``dipole`` and ``quadrupole`` (and for multipole only requests
+        the ``coordinates`` and ``elements`` of the atoms)
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+    log: str
+        anything else the model wrote to stderr
+
+    Returns
+    -------
+    ESPResult
+    """
+    return ESPResult(
+        esp=_array(values.get('esp_values'), dtype),
+        grid=_array(values.get('grid', values.get('esp_grid')), dtype, (-1, 3)),
+        monopoles=_array(values.get('monopole'), dtype),
+        dipoles=_array(values.get('dipole'), dtype, (-1, 3)),
+        quadrupoles=_array(values.get('quadrupole'), dtype, (-1, 3, 3)),
+        coordinates=_array(values.get('coordinates'), dtype, (-1, 3)),
+        elements=values.get('elements'),
+        log=log,
+    )
+
+
+def esp_result_from_response(response: dict, dtype: type = np.float64, molecule: str = '') -> ESPResult:
+    """
+    Build an ESPResult from a worker response to a single molecule ESP request
+
+    Parameters
+    ----------
+    response: dict
+        worker response
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+    molecule: str
+        name of the molecule, used in the error records
+
+    Returns
+    -------
+    ESPResult
+    """
+    result = response.get('result')
+    error = response.get('error', '')
+    if result is None:
+        return ESPResult(errors=[MoleculeError(molecule, error)])
+    return esp_result_from_values(result, dtype, log=error)
+
+
+def esp_result_from_json(values: dict, dtype: type = np.float64, molecule: str = '') -> ESPResult:
+    """
+    Build an ESPResult from the JSON the HTTP server answers an ESP request with, see api_class
+
+    Parameters
+    ----------
+    values: dict
+        the ``esp``, ``grid``, ``monopoles``, ``dipoles``, ``quadrupoles``, ``coordinates`` and ``elements`` the
+        molecule has, and its ``error``
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+    molecule: str
+        name of the molecule, used in the error records
+
+    Returns
+    -------
+    ESPResult
+    """
+    error = values.get('error', '')
+    if 'esp' not in values and 'monopoles' not in values:
+        return ESPResult(errors=[MoleculeError(molecule, error)])
+    return ESPResult(
+        esp=_array(values.get('esp'), dtype),
+        grid=_array(values.get('grid'), dtype, (-1, 3)),
+        monopoles=_array(values.get('monopoles'), dtype),
+        dipoles=_array(values.get('dipoles'), dtype, (-1, 3)),
+        quadrupoles=_array(values.get('quadrupoles'), dtype, (-1, 3, 3)),
+        coordinates=_array(values.get('coordinates'), dtype, (-1, 3)),
+        elements=values.get('elements'),
+        log=error,
+    )
+
+
+def batch_esp_results_from_file(file_path: str, broken_up: bool, dtype: type = np.float64) -> dict[str, ESPResult]:
+    """
+    Build an ESPResult for each molecule of a batched ESP output file
+
+    Parameters
+    ----------
+    file_path: str
+        JSON file written by the batched ESP request, of molecule names and their ``esp_values`` and ``esp_grid``, or
+        for multipole only requests their ``esp_values`` and the ``coordinates`` and ``elements`` of the atoms. Or the
+        NPZ file of a batched_grid request
+    broken_up: bool
+        whether the ``esp_values`` are the monopoles, dipoles and quadrupoles rather than the ESP
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+
+    Returns
+    -------
+    dict[str, ESPResult]
+        results in the order of the file
+    """
+    if file_path.endswith('.npz'):
+        return _batch_esp_results_from_npz(file_path, dtype)
+    with open(file_path, 'r') as esp_file:
+        esp_dictionary = json.load(esp_file)
+    return batch_esp_results_from_values(esp_dictionary, broken_up, dtype)
+
+
+def batch_esp_results_from_values(
+    esp_dictionary: dict, broken_up: bool, dtype: type = np.float64
+    ) -> dict[str, ESPResult]:
+    """
+    Build an ESPResult for each molecule of the results of a batch, as held in a batched ESP JSON file or returned
+    by a worker for a batch of molecules held in memory
+
+    Parameters
+    ----------
+    esp_dictionary: dict
+        molecule names and their ``esp_values`` and ``esp_grid``, or for multipole only requests their
+        ``esp_values`` and the ``coordinates`` and ``elements`` of the atoms
+    broken_up: bool
+        whether the ``esp_values`` are the monopoles, dipoles and quadrupoles rather than the ESP
+    dtype: type
+        float type of the arrays, np.float32 or np.float64
+
+    Returns
+    -------
+    dict[str, ESPResult]
+        results in the order of the batch
+    """
+    results = {}
+    for name, values in esp_dictionary.items():
+        if broken_up:
+            monopole, dipole, quadrupole = values['esp_values']
+            #multipole only batches have the atoms rather than the grid
+            values = {
+                'monopole': monopole,
+                'dipole': dipole,
+                'quadrupole': quadrupole,
+                'grid': values.get('esp_grid'),
+                'coordinates': values.get('coordinates'),
+                'elements': values.get('elements'),
+            }
+        results[name] = esp_result_from_values(values, dtype)
+    return results
+
+
+def _batch_esp_results_from_npz(file_path: str, dtype: type) -> dict[str, ESPResult]:
+    """
+    ESPResults of an NPZ ESP file, whose arrays are slices of the memory mapped file when dtype is float64
+    """
+    results = {}
+    for name, arrays in read_esp_file(file_path).items():
+        elements = arrays.get('elements')
+        results[name] = ESPResult(
+            esp=_array(arrays.get('esp'), dtype),
+            grid=_array(arrays.get('grid'), dtype, (-1, 3)),
+            monopoles=_array(arrays.get('monopoles'), dtype),
+            dipoles=_array(arrays.get('dipoles'), dtype, (-1, 3)),
+            quadrupoles=_array(arrays.get('quadrupoles'), dtype, (-1, 3, 3)),
+            coordinates=_array(arrays.get('coordinates'), dtype, (-1, 3)),
+            elements=None if elements is None else [str(element) for element in elements],
+        )
+    return results
@@ -0,0 +1,369 @@
+import subprocess
+import contextlib
+import threading
+import itertools
+import logging
+import os
+from typing import Iterator, Optional
+import ChargeAPI
+from ChargeAPI.API_infrastructure.environments import python_command
+from ChargeAPI.API_infrastructure.protocol import read_message, write_message, encode_message
+
+WORKER_SCRIPT = f'{os.path.dirname(ChargeAPI.__file__)}/API_infrastructure/model_worker.py'
+
+
+def worker_command(env: str, script_path: str) -> tuple[list[str], Optional[dict[str, str]]]:
+    """Command to start a model worker for a model script in its conda environment
+
+    Parameters
+    ----------
+    env: str
+        conda environment the model runs in
+    script_path: str
+        absolute path to the model script
+
+    Returns
+    -------
+    cmd, variables: tuple
+        command to pass to subprocess and the environment variables to run it with, see
+        ChargeAPI.API_infrastructure.environments.python_command
+    """
+    return python_command(env, WORKER_SCRIPT, "--model_script", script_path)
+
+
+class WorkerError(RuntimeError):
+    """Raised when a model worker fails to start or dies while serving a request"""
+
+
+class ModelWorker:
+    """A long-lived python process in a model's conda environment with the model loaded.
+    """
+    _ids = itertools.count()
+
+    def __init__(self, env: str, script_path: str):
+        """Start the worker and wait for the model to be loaded
+
+        Parameters
+        ----------
+        env: str
+            conda environment the model runs in
+        script_path: str
+            absolute path to the model script
+        """
+        self.env = env
+        self.script_path = script_path
+        cmd, variables = worker_command(env, script_path)
+        self.process = subprocess.Popen(
+            cmd,
+            env=variables,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        #stderr must be drained or a chatty model will eventually block on a full pipe
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+
+        ready = self._read_message()
+        if not ready.get('ready', False):
+            self.close()
+            raise WorkerError(f'worker for {script_path} failed to start: {ready.get("error")}')
+
+    def _drain_stderr(self):
+        for line in self.process.stderr:
+            logging.debug('[%s] %s', os.path.basename(self.script_path), line.decode(errors='replace').rstrip())
+
+    def _read_message(self) -> dict:
+        message = read_message(self.process.stdout)
+        if message is None:
+            raise WorkerError(f'worker for {self.script_path} exited with code {self.process.poll()}')
+        return message
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def request(self, payload: dict) -> dict:
+        """Send a request to the worker and wait for the response
+
+        Parameters
+        ----------
+        payload: dict
+            request containing the ``conformer`` and the ``batched`` and ``protein`` options
+
+        Returns
+        -------
+        dict
+            response with the ``result`` and the ``error`` output
+        """
+        try:
+            write_message(self.process.stdin, dict(payload, id=next(self._ids)))
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerError(f'worker for {self.script_path} is not accepting requests') from e
+        return self._read_message()
+
+    def request_many(self, payloads: list[dict]) -> list[dict]:
+        """Pipeline several requests through the worker
+
+        The requests are written from a separate thread while the responses are read, so neither
+        side blocks on a full pipe however many requests are sent.
+
+        Parameters
+        ----------
+        payloads: list[dict]
+            requests to send to the worker
+
+        Returns
+        -------
+        list[dict]
+            responses in the same order as the requests
+        """
+        frames = [encode_message(dict(payload, id=next(self._ids))) for payload in payloads]
+        write_errors = []
+
+        def _write():
+            try:
+                for frame in frames:
+                    self.process.stdin.write(frame)
+                self.process.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                write_errors.append(e)
+
+        writer = threading.Thread(target=_write, daemon=True)
+        writer.start()
+        try:
+            responses = [self._read_message() for _ in frames]
+        finally:
+            writer.join()
+        if write_errors:
+            raise WorkerError(f'worker for {self.script_path} is not accepting requests') from write_errors[0]
+        return responses
+
+    def stream(self, payload: dict) -> Iterator[dict]:
+        """Send a streamed request and yield the worker's responses as they arrive
+
+        The worker answers with a response per molecule and then a response with ``done`` set, which is
+        also yielded. If the caller stops early the worker is killed, as it would otherwise carry on
+        writing responses nobody reads.
+
+        Parameters
+        ----------
+        payload: dict
+            request with ``stream`` set, see model_worker.stream_request
+
+        Yields
+        ------
+        dict
+            responses with the ``molecule``, ``result`` and ``error``, the last with ``done`` and any error
+            which stopped the batch
+        """
+        try:
+            write_message(self.process.stdin, dict(payload, stream=True, id=next(self._ids)))
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerError(f'worker for {self.script_path} is not accepting requests') from e
+        done = False
+        try:
+            while not done:
+                message = self._read_message()
+                done = message.get('done', False)
+                yield message
+        finally:
+            if not done:
+                self.process.kill()
+                self.process.wait()
+
+    def close(self):
+        """Close the worker's stdin so it exits, killing it if it does not"""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+
+class WorkerPool:
+    """Pool of resident model workers, with up to ``workers_per_model`` workers per model.
+
+    Workers are started on the first request for a model and then reused, so only the first
+    request for each model pays for the environment start-up and model loading.
+    """
+
+    def __init__(self, workers_per_model: int = 1):
+        if workers_per_model < 1:
+            raise ValueError('workers_per_model must be at least 1')
+        self.workers_per_model = workers_per_model
+        self._idle = {}
+        self._started = {}
+        #workers allowed above workers_per_model for each model, see extended
+        self._extra = {}
+        self._workers = []
+        self._closed = False
+        #waited on by requests for a model at workers_per_model, notified whenever a worker is freed, dies or
+        #fails to start and when the pool closes
+        self._condition = threading.Condition()
+
+    def _capacity(self, model_key: str) -> int:
+        return self.workers_per_model + self._extra.get(model_key, 0)
+
+    def _acquire(self, model_key: str, env: str, script_path: str) -> ModelWorker:
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise WorkerError('the worker pool is closed')
+                idle = self._idle.setdefault(model_key, [])
+                if idle:
+                    return idle.pop()
+                if self._started.get(model_key, 0) < self._capacity(model_key):
+                    self._started[model_key] = self._started.get(model_key, 0) + 1
+                    break
+                self._condition.wait()
+        try:
+            worker = ModelWorker(env, script_path)
+        except Exception:
+            with self._condition:
+                self._started[model_key] -= 1
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            closed = self._closed
+            if not closed:
+                self._workers.append(worker)
+        if closed:
+            worker.close()
+            raise WorkerError('the worker pool is closed')
+        return worker
+
+    def _release(self, model_key: str, worker: ModelWorker):
+        with self._condition:
+            #the pool was closed while the worker was busy
+            retire = worker not in self._workers
+            if not retire:
+                #a dead worker, or one above the capacity once an extension has ended
+                retire = not worker.is_alive() or self._started[model_key] > self._capacity(model_key)
+                if retire:
+                    #let the next request start a replacement
+                    self._started[model_key] -= 1
+                    self._workers.remove(worker)
+                else:
+                    self._idle[model_key].append(worker)
+            self._condition.notify_all()
+        if retire:
+            worker.close()
+
+    @contextlib.contextmanager
+    def extended(self, model_key: str, n_workers: int):
+        """Allow up to n_workers workers for the model while in the context, e.g. for the shards of a batch to run at
+        once, the extra workers are stopped once they are released after it"""
+        extra = max(0, n_workers - self.workers_per_model)
+        with self._condition:
+            self._extra[model_key] = self._extra.get(model_key, 0) + extra
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            retired = []
+            with self._condition:
+                self._extra[model_key] -= extra
+                idle = self._idle.get(model_key, [])
+                while idle and self._started.get(model_key, 0) > self._capacity(model_key):
+                    worker = idle.pop()
+                    self._started[model_key] -= 1
+                    self._workers.remove(worker)
+                    retired.append(worker)
+            for worker in retired:
+                worker.close()
+
+    def start(self, model_key: str, env: str, script_path: str):
+        """Start a worker for a model ahead of its first request"""
+        self._release(model_key, self._acquire(model_key, env, script_path))
+
+    def request(self, model_key: str, env: str, script_path: str, payload: dict) -> dict:
+        """Run a request on an idle worker for the model, starting one if needed
+
+        Parameters
+        ----------
+        model_key: str
+            flag of the model, used to group the workers
+        env: str
+            conda environment the model runs in
+        script_path: str
+            absolute path to the model script
+        payload: dict
+            request to send to the worker
+
+        Returns
+        -------
+        dict
+            response from the worker
+        """
+        worker = self._acquire(model_key, env, script_path)
+        try:
+            return worker.request(payload)
+        finally:
+            self._release(model_key, worker)
+
+    def request_many(self, model_key: str, env: str, script_path: str, payloads: list[dict]) -> list[dict]:
+        """Pipeline several requests through a single worker for the model, see ModelWorker.request_many"""
+        worker = self._acquire(model_key, env, script_path)
+        try:
+            return worker.request_many(payloads)
+        finally:
+            self._release(model_key, worker)
+
+    def stream(self, model_key: str, env: str, script_path: str, payload: dict) -> Iterator[dict]:
+        """Run a streamed request on an idle worker for the model, see ModelWorker.stream
+
+        The worker is held until the stream is exhausted or closed.
+        """
+        worker = self._acquire(model_key, env, script_path)
+        try:
+            yield from worker.stream(payload)
+        finally:
+            self._release(model_key, worker)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        """Workers started and idle for each model"""
+        with self._condition:
+            return {
+                model_key: {'started': started, 'idle': len(self._idle.get(model_key, []))}
+                for model_key, started in self._started.items()
+            }
+
+    def pids(self) -> list[int]:
+        """Process ids of the started workers"""
+        with self._condition:
+            return [worker.process.pid for worker in self._workers]
+
+    def close(self):
+        """Stop all of the workers, requests waiting for a worker raise WorkerError"""
+        with self._condition:
+            workers, self._workers = self._workers, []
+            self._idle = {}
+            self._started = {}
+            self._closed = True
+            self._condition.notify_all()
+        for worker in workers:
+            worker.close()
+
+
+def stream_request(env: str, script_path: str, payload: dict) -> Iterator[dict]:
+    """Run a streamed request on a one-off worker, see ModelWorker.stream
+
+    Parameters
+    ----------
+    env: str
+        conda environment the model runs in
+    script_path: str
+        absolute path to the model script
+    payload: dict
+        request to stream
+
+    Yields
+    ------
+    dict
+        responses from the worker
+    """
+    worker = ModelWorker(env, script_path)
+    try:
+        yield from worker.stream(payload)
+    finally:
+        worker.close()
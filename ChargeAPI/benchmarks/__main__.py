@@ -0,0 +1,51 @@
+"""Run the dispatch benchmarks, see ChargeAPI.benchmarks.dispatch"""
+import argparse
+import cProfile
+import json
+import sys
+from ChargeAPI.benchmarks.dispatch import run_suite, save_baseline, compare
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark handle_charge_request and handle_esp_request for each model')
+    parser.add_argument('--models', nargs='+', default=None, help='model flags to benchmark, all of them by default')
+    parser.add_argument('--kinds', nargs='+', default=['charge', 'esp'], choices=['charge', 'esp'], help='charge and/or ESP models')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 64], help='numbers of molecules per batch')
+    parser.add_argument('--repeats', type=int, default=5, help='number of times each case is run')
+    parser.add_argument('--pool', action='store_true', help='run the requests on resident workers')
+    parser.add_argument('--save', type=str, default=None, help='file to save the results to as a baseline')
+    parser.add_argument('--compare', type=str, default=None, help='baseline file to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--profile', type=str, default=None, help='file to save a cProfile of the dispatch side to')
+    args = parser.parse_args()
+
+    options = dict(
+        models=args.models,
+        kinds=tuple(args.kinds),
+        batch_sizes=tuple(args.batch_sizes),
+        repeats=args.repeats,
+        use_pool=args.pool,
+    )
+    if args.profile is not None:
+        #in the pstats format of module_version.profile, so the two can be read side by side
+        profiler = cProfile.Profile()
+        suite = profiler.runcall(run_suite, **options)
+        profiler.dump_stats(args.profile)
+    else:
+        suite = run_suite(**options)
+    for result in suite['results']:
+        print(json.dumps(result))
+    if args.save is not None:
+        save_baseline(suite, args.save)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as baseline_file:
+            regressions = compare(suite, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION', json.dumps(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
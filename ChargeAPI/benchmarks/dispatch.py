@@ -0,0 +1,356 @@
+"""Benchmarks of handle_charge_request and handle_esp_request for every registered model.
+
+Each model is run on the molecules in tests/data one at a time, from the smallest to the largest molecule, and in
+batches of increasing size. For each case the latency percentiles, molecules per second and, when the requests run on
+resident workers on Linux, the peak RSS of the workers during the case are reported. Results can be saved as a JSON
+baseline and later runs compared against it.
+
+Usage::
+
+    python -m ChargeAPI.benchmarks --models MBIS EEM --batch-sizes 1 16 64 --repeats 5 --save baseline.json
+    python -m ChargeAPI.benchmarks --models MBIS EEM --batch-sizes 1 16 64 --repeats 5 --compare baseline.json
+"""
+from typing import Callable, Optional
+import subprocess
+import itertools
+import platform
+import tempfile
+import time
+import json
+import sys
+import os
+import numpy as np
+from rdkit import Chem
+import ChargeAPI
+from ChargeAPI.API_infrastructure.charge_request import module_version
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(ChargeAPI.__file__))), 'tests', 'data')
+
+#the water conformer used throughout the tests
+WATER = '\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n   -0.7890   -0.1982   -0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n   -0.0061    0.3917   -0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n    0.7951   -0.1936    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n  1  2  1  0\n  2  3  1  0\nM  END\n'
+
+#metrics where a larger value is a regression, the others are regressions when they drop
+LOWER_IS_BETTER = ('latency_p50_s', 'latency_p90_s', 'latency_p99_s', 'peak_rss_mb')
+HIGHER_IS_BETTER = ('molecules_per_s',)
+
+
+def load_molecules(data_dir: str = DATA_DIR) -> dict[str, str]:
+    """
+    Molblocks of the benchmark molecules: water, the SDF files and the batched JSON in the data directory
+
+    Parameters
+    ----------
+    data_dir: str
+        directory holding the test data
+
+    Returns
+    -------
+    dict
+        molecule names and molblocks, ordered by increasing number of atoms
+    """
+    molecules = {'water': WATER}
+
+    for sdf_file in ('batched_compounds.sdf', 'ph4_6.sdf', 'understanding.sdf'):
+        sdf_path = os.path.join(data_dir, sdf_file)
+        if not os.path.exists(sdf_path):
+            continue
+        for i, mol in enumerate(Chem.SDMolSupplier(sdf_path, removeHs=False)):
+            if mol is not None:
+                molecules[f'{os.path.splitext(sdf_file)[0]}_{i}'] = Chem.MolToMolBlock(mol)
+
+    #the batched input of the integration tests, including the saq-moved ligand of mol_file.mol_esp.json
+    batch_path = os.path.join(data_dir, 'mol_file.mol')
+    if os.path.exists(batch_path):
+        with open(batch_path, 'r') as batch_file:
+            molecules.update(json.load(batch_file))
+
+    return dict(sorted(molecules.items(), key=lambda item: _n_atoms(item[1])))
+
+
+def _n_atoms(molblock: str) -> int:
+    mol = Chem.MolFromMolBlock(molblock, removeHs=False, sanitize=False)
+    return 0 if mol is None else mol.GetNumAtoms()
+
+
+def _worker_pids(kind: str) -> list[int]:
+    """
+    process ids of the resident workers of the charge or ESP models, and of their children for workers started
+    with conda run, empty if the pool is not started
+    """
+    if kind == 'charge':
+        pool = module_version._DISPATCHER.pool
+    else:
+        from ChargeAPI.API_infrastructure.esp_request import module_version_esp
+        pool = module_version_esp._DISPATCHER.pool
+    if pool is None:
+        return []
+    pids = []
+    stack = pool.pids()
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        try:
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children', 'r') as children:
+                    stack.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def _reset_peak_rss(pids: list[int]) -> None:
+    """
+    start the peak RSS of the processes again from their current RSS, so the next sample covers only one case
+    """
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/clear_refs', 'w') as clear_refs:
+                clear_refs.write('5')
+        except OSError:
+            continue
+
+
+def _peak_rss_mb(pids: list[int]) -> Optional[float]:
+    """
+    largest peak RSS (VmHWM) of the processes since it was last reset, in MB, None if it cannot be read
+    """
+    peaks = []
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status', 'r') as status:
+                peaks.extend(int(line.split()[1]) for line in status if line.startswith('VmHWM:'))
+        except OSError:
+            continue
+    #kilobytes
+    return max(peaks) / 1024 if peaks else None
+
+
+def _charge_request(model: str, conformer_mol: str, batched: bool) -> bool:
+    result = module_version.handle_charge_request(charge_model=model, conformer_mol=conformer_mol, batched=batched)
+    return bool(result['charge_result'])
+
+
+def _esp_request(model: str, conformer_mol: str, batched: bool) -> bool:
+    from ChargeAPI.API_infrastructure.esp_request import module_version_esp
+
+    result = module_version_esp.handle_esp_request(charge_model=model, conformer_mol=conformer_mol, batched=batched)
+    return 'result' not in result
+
+
+def _summarise(
+    latencies: list[float], n_molecules: int, n_atoms: int, failures: int, peak_rss_mb: Optional[float]
+    ) -> dict[str, float]:
+    latencies = np.asarray(latencies)
+    return {
+        'n_molecules': n_molecules,
+        'n_atoms': n_atoms,
+        'repeats': len(latencies),
+        'failures': failures,
+        'latency_mean_s': float(latencies.mean()),
+        'latency_p50_s': float(np.percentile(latencies, 50)),
+        'latency_p90_s': float(np.percentile(latencies, 90)),
+        'latency_p99_s': float(np.percentile(latencies, 99)),
+        'molecules_per_s': float(n_molecules * len(latencies) / latencies.sum()),
+        'peak_rss_mb': peak_rss_mb,
+    }
+
+
+def _time_requests(kind: str, request: Callable[[], bool], repeats: int) -> tuple[list[float], int, Optional[float]]:
+    """
+    latencies and failures of the repeated request, and the peak RSS of the resident workers while it ran
+    """
+    _reset_peak_rss(_worker_pids(kind))
+    latencies = []
+    failures = 0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        ok = request()
+        latencies.append(time.perf_counter() - start)
+        failures += not ok
+    #workers started during the case are included, their peak covers only this case too
+    return latencies, failures, _peak_rss_mb(_worker_pids(kind))
+
+
+def benchmark_model(
+    kind: str,
+    model: str,
+    molecules: dict[str, str],
+    batch_sizes: list[int],
+    repeats: int,
+) -> list[dict]:
+    """
+    Benchmark one model on single molecules of increasing size and on batches of increasing size
+
+    Parameters
+    ----------
+    kind: str
+        charge or esp
+    model: str
+        model flag, a key of the module's model_locations
+    molecules: dict
+        molecule names and molblocks ordered by size, see load_molecules
+    batch_sizes: list[int]
+        numbers of molecules per batch, the molecules are repeated to fill large batches
+    repeats: int
+        number of times each case is run
+
+    Returns
+    -------
+    list[dict]
+        a result per case, see _summarise
+    """
+    request = _charge_request if kind == 'charge' else _esp_request
+    results = []
+
+    for name, molblock in molecules.items():
+        latencies, failures, peak_rss_mb = _time_requests(kind, lambda: request(model, molblock, False), repeats)
+        results.append(dict(
+            {'kind': kind, 'model': model, 'case': f'single/{name}'},
+            **_summarise(latencies, 1, _n_atoms(molblock), failures, peak_rss_mb),
+        ))
+
+    with tempfile.TemporaryDirectory() as batch_dir:
+        for batch_size in batch_sizes:
+            names = list(itertools.islice(itertools.cycle(molecules), batch_size))
+            if kind == 'charge':
+                batch = {f'{i}_{name}': molecules[name] for i, name in enumerate(names)}
+            else:
+                #ESP batches hold each molblock with its grid, None to build the default grid
+                batch = {f'{i}_{name}': [molecules[name], None] for i, name in enumerate(names)}
+            batch_path = os.path.join(batch_dir, f'batch_{batch_size}.json')
+            with open(batch_path, 'w') as batch_file:
+                json.dump(batch, batch_file)
+
+            latencies, failures, peak_rss_mb = _time_requests(kind, lambda: request(model, batch_path, True), repeats)
+            n_atoms = sum(_n_atoms(molecules[name]) for name in names)
+            results.append(dict(
+                {'kind': kind, 'model': model, 'case': f'batch/{batch_size}'},
+                **_summarise(latencies, batch_size, n_atoms, failures, peak_rss_mb),
+            ))
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(ChargeAPI.__file__)),
+            capture_output=True,
+            check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(
+    models: Optional[list[str]] = None,
+    kinds: tuple[str, ...] = ('charge', 'esp'),
+    batch_sizes: tuple[int, ...] = (1, 8, 64),
+    repeats: int = 5,
+    use_pool: bool = False,
+    data_dir: str = DATA_DIR,
+) -> dict:
+    """
+    Benchmark every registered model, or the given models
+
+    Parameters
+    ----------
+    models: list[str], optional
+        model flags to benchmark, all the flags in model_locations by default
+    kinds: tuple
+        charge and/or esp models
+    batch_sizes: tuple
+        numbers of molecules per batch
+    repeats: int
+        number of times each case is run
+    use_pool: bool
+        run the requests on resident workers rather than a one-off worker each, the peak RSS is only measured for
+        resident workers
+    data_dir: str
+        directory holding the test data
+
+    Returns
+    -------
+    dict
+        the ``meta`` data of the run and the ``results`` of each case
+    """
+    molecules = load_molecules(data_dir)
+    modules = {'charge': module_version}
+    if 'esp' in kinds:
+        from ChargeAPI.API_infrastructure.esp_request import module_version_esp
+        modules['esp'] = module_version_esp
+
+    results = []
+    for kind in kinds:
+        module = modules[kind]
+        if use_pool:
+            module.start_worker_pool()
+        try:
+            for model in module.model_locations:
+                if models is None or model in models:
+                    results.extend(benchmark_model(kind, model, molecules, list(batch_sizes), repeats))
+        finally:
+            if use_pool:
+                module.stop_worker_pool()
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeats': repeats,
+            'use_pool': use_pool,
+        },
+        'results': results,
+    }
+
+
+def save_baseline(suite: dict, file_path: str) -> None:
+    """
+    Save the results of run_suite as a JSON baseline
+    """
+    with open(file_path, 'w') as baseline_file:
+        json.dump(suite, baseline_file, indent=2)
+
+
+def compare(suite: dict, baseline: dict, tolerance: float = 0.1) -> list[dict]:
+    """
+    Cases which got worse than the baseline by more than the tolerance
+
+    Parameters
+    ----------
+    suite: dict
+        results of run_suite
+    baseline: dict
+        earlier results of run_suite, e.g. loaded from save_baseline
+    tolerance: float
+        relative change allowed before a case counts as a regression
+
+    Returns
+    -------
+    list[dict]
+        the kind, model, case and metric of each regression with its baseline and current values
+    """
+    baseline_results = {(r['kind'], r['model'], r['case']): r for r in baseline['results']}
+    regressions = []
+    for result in suite['results']:
+        before = baseline_results.get((result['kind'], result['model'], result['case']))
+        if before is None:
+            continue
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            #the peak RSS is not measured for one-off workers
+            if not before.get(metric) or result.get(metric) is None:
+                continue
+            change = (result[metric] - before[metric]) / before[metric]
+            if (metric in LOWER_IS_BETTER and change > tolerance) or (metric in HIGHER_IS_BETTER and change < -tolerance):
+                regressions.append({
+                    'kind': result['kind'],
+                    'model': result['model'],
+                    'case': result['case'],
+                    'metric': metric,
+                    'baseline': before[metric],
+                    'current': result[metric],
+                    'change': change,
+                })
+    return regressions
@@ -0,0 +1,78 @@
+"""Per-call cost of starting python in a model environment with conda run and with the resolved interpreter.
+
+Usage::
+
+    python -m ChargeAPI.benchmarks.interpreter_overhead --envs naglmbis openbabel --repeats 10
+"""
+import subprocess
+import statistics
+import argparse
+import time
+import json
+import os
+from ChargeAPI.API_infrastructure.environments import resolve_environment
+
+
+def time_command(cmd: list[str], variables: dict[str, str] = None, repeats: int = 10) -> list[float]:
+    """
+    wall times in seconds of running a command repeatedly
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, env=variables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def benchmark_environment(env: str, repeats: int = 10) -> dict[str, float]:
+    """
+    Compare starting an empty python process with conda run and with the resolved interpreter of an environment
+
+    Parameters
+    ----------
+    env: str
+        name of the conda environment
+    repeats: int
+        number of processes to start each way
+
+    Returns
+    -------
+    dict
+        median and mean seconds per call each way and the saving per call
+    """
+    resolved = resolve_environment(env)
+    if resolved is None:
+        raise RuntimeError(f'could not resolve the interpreter of conda environment {env}')
+
+    variables = os.environ.copy()
+    variables.update(resolved.variables)
+
+    conda_run = time_command(["conda", "run", "--no-capture-output", "-n", env, "python", "-c", "pass"], repeats=repeats)
+    direct = time_command([resolved.python, "-c", "pass"], variables=variables, repeats=repeats)
+    return {
+        'env': env,
+        'repeats': repeats,
+        'conda_run_median_s': statistics.median(conda_run),
+        'conda_run_mean_s': statistics.mean(conda_run),
+        'direct_median_s': statistics.median(direct),
+        'direct_mean_s': statistics.mean(direct),
+        'saving_per_call_s': statistics.median(conda_run) - statistics.median(direct),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-call overhead of conda run against the resolved interpreter')
+    parser.add_argument('--envs', nargs='+', default=['naglmbis', 'openbabel', 'riniker'], help='conda environments to benchmark')
+    parser.add_argument('--repeats', type=int, default=10, help='number of processes to start each way')
+    args = parser.parse_args()
+
+    for env in args.envs:
+        try:
+            print(json.dumps(benchmark_environment(env, args.repeats)))
+        except Exception as e:
+            print(json.dumps({'env': env, 'error': str(e)}))
+
+
+if __name__ == '__main__':
+    main()
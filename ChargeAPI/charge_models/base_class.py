@@ -5,7 +5,9 @@ import os
 import logging 
 import numpy as np
 import tempfile
+import time
 import sys
+import contextlib
 
 from rdkit import Chem
 from rdkit.Chem import rdmolfiles
@@ -26,6 +28,14 @@ class ExternalChargeModel:
     subclasses = {}
 
     _name = None
+    #type of file batched charges are written to, one of json, npz, parquet or arrow
+    file_type = "json"
+    #seconds spent in each stage, recorded while this is a dictionary (set by the model worker for timed requests)
+    timings = None
+    #molecules per forward pass for the models which assign a batch's charges in chunks, see assign_charges_chunk
+    chunk_size = int(os.environ.get("CHARGEAPI_CHUNK_SIZE", 64))
+    #charges which depend only on the molecular graph are assigned once per topology in a batch, and mapped onto each conformer
+    conformer_independent = False
     def __init_subclass__(cls, *args, **kwargs):
         """
         Catch any new external charge models (all external charge models must inherit
@@ -41,6 +51,24 @@ class ExternalChargeModel:
         """Check external code can be run
         """
 
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        """Add the time spent in the block to the stage's timing, if timings are being recorded
+
+        Parameters
+        ----------
+        stage: str
+            name of the stage, e.g. assign_charges
+        """
+        if self.timings is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
     @abstractmethod
     def __call__(self, conformer_mol: str, file_method = False, batched = False) -> list[int]  : #| None | str
         """Get charges for molecule.
@@ -66,38 +94,31 @@ class ExternalChargeModel:
         if not batched:
             logging.info('not batched option chosen')
 
-            charge_format = self.convert_to_charge_format(conformer_mol)
+            with self.timed('convert_to_charge_format'):
+                charge_format = self.convert_to_charge_format(conformer_mol)
             #if the charge model requires generation and reading of files to produce charges
             if file_method:
                 file_path = self.generate_temp_files(charge_format)
-                charge_file_path = self.run_external_code(file_path)
+                with self.timed('run_external_code'):
+                    charge_file_path = self.run_external_code(file_path)
                 charges = self.read_charge_output(charge_file_path)
             #other charge model types will produce charges based on python objects in internal memory
             else:
-                charges = self.assign_charges(charge_format)
+                with self.timed('assign_charges'):
+                    charges = self.assign_charges(charge_format)
             return charges
 
         else:
             logging.info('batched option chosen')
             #make dictionary from json file
-            mol_dictionary = self.molfile_to_dict(conformer_mol)
-            for mol in mol_dictionary.items():
-                charge_format = self.convert_to_charge_format(mol[1])
-                try:
-                    charges = self.assign_charges(charge_format)
-                except Exception as e:
-                    mol_block = rdmolfiles.MolFromMolBlock(mol[1], removeHs=False)
-                    no_atoms = len([atom for atom in mol_block.GetAtoms()])
-                    charges = [0] * no_atoms
-                    error_message = f'charges failed with {Chem.MolToSmiles(mol_block)} due to {e}'
-                    print(error_message, file=sys.stderr)  # Write error message to stderr
-                mol_dictionary[mol[0]] = charges
+            with self.timed('read_batch'):
+                mol_dictionary = self.molfile_to_dict(conformer_mol)
+            mol_dictionary, errors = self.assign_charges_batched(mol_dictionary)
+            for error_message in errors.values():
+                print(error_message, file=sys.stderr)  # Write error message to stderr
             #write charges dictionary to file
-            charge_file = f"{conformer_mol.strip('.json')}_charges.json"
-            with open(charge_file,"w+") as outfile:
-                json.dump(mol_dictionary, outfile, indent=2)
-                #charge_file_path = os.path.abspath(charge_file)
-            return charge_file
+            with self.timed('write_charges'):
+                return self.write_charges(mol_dictionary, conformer_mol)
 
 
 
@@ -125,6 +146,176 @@ class ExternalChargeModel:
 
         return mol_dictionary
 
+    def write_charges(self, mol_dictionary: dict[str, list[float]], conformer_mol: str) -> str:
+        """Write the charges of a batch to a file of the model's file_type, next to the batch file
+
+        Parameters
+        ----------
+        mol_dictionary: dict
+            molecule names and their charges
+        conformer_mol: str
+            file path of the batch
+
+        Returns
+        -------
+        charge_file: str
+            file path of the charges
+        """
+        charge_file = f"{conformer_mol.strip('.json')}_charges.{self.file_type}"
+        if self.file_type == "json":
+            with open(charge_file,"w+") as outfile:
+                json.dump(mol_dictionary, outfile, indent=2)
+        else:
+            #the columnar formats are written by ChargeAPI's charge_files module, which sits next to the model worker
+            from charge_files import write_charge_file
+            write_charge_file(mol_dictionary, charge_file, self.file_type)
+        return charge_file
+
+    def assign_charges_batched(self, mol_dictionary: dict[str, str]) -> tuple[dict[str, list[float]], dict[str, str]]:
+        """Assign charges to a batch of molecules
+
+        Parameters
+        ----------
+        mol_dictionary: dict
+            molecule names and their molblocks
+
+        Returns
+        -------
+        charges: dict
+            molecule names and their charges, molecules which failed are given zero charges
+        errors: dict
+            molecule names and error messages of the molecules which failed
+        """
+        if self.conformer_independent:
+            return self.assign_charges_by_topology(mol_dictionary)
+        return self.assign_charges_chunked(mol_dictionary)
+
+    def assign_charges_chunked(self, mol_dictionary: dict[str, str]) -> tuple[dict[str, list[float]], dict[str, str]]:
+        """Assign charges to a batch of molecules a chunk of chunk_size molecules at a time, see assign_charges_batched
+        """
+        charges = {}
+        errors = {}
+        names = list(mol_dictionary)
+        #converted and assigned a chunk at a time, so only one chunk of converted molecules is held in memory
+        for start in range(0, len(names), max(self.chunk_size, 1)):
+            charge_formats = {}
+            for name in names[start:start + max(self.chunk_size, 1)]:
+                try:
+                    with self.timed('convert_to_charge_format'):
+                        charge_formats[name] = self.convert_to_charge_format(mol_dictionary[name])
+                except Exception as e:
+                    charges[name], errors[name] = self.failed_charges(name, mol_dictionary[name], e)
+            chunk_charges = None
+            if charge_formats:
+                try:
+                    with self.timed('assign_charges'):
+                        chunk_charges = self.assign_charges_chunk(list(charge_formats.values()))
+                except Exception as e:
+                    #e.g. one molecule the model cannot featurize, the others are still assigned one by one
+                    LOGGER.info(f'chunk of {len(charge_formats)} molecules failed, assigning them one by one: {e}')
+            if chunk_charges is not None:
+                charges.update(zip(charge_formats, chunk_charges))
+                continue
+            for name, charge_format in charge_formats.items():
+                try:
+                    with self.timed('assign_charges'):
+                        charges[name] = self.assign_charges(charge_format)
+                except Exception as e:
+                    charges[name], errors[name] = self.failed_charges(name, mol_dictionary[name], e)
+        return {name: charges[name] for name in names}, errors
+
+    def assign_charges_by_topology(self, mol_dictionary: dict[str, str]) -> tuple[dict[str, list[float]], dict[str, str]]:
+        """Assign charges once to each topology in a batch, for conformer independent models, see assign_charges_batched
+
+        Molecules are grouped by their canonical SMILES (with the hydrogens), the first molecule of each group is
+        run through the model and its charges are mapped onto the atom order of the others by their canonical ranks.
+        """
+        representatives = {}
+        topology = {}
+        unique = {}
+        with self.timed('deduplicate'):
+            for name, molblock in mol_dictionary.items():
+                mol = rdmolfiles.MolFromMolBlock(molblock, removeHs=False)
+                if mol is None:
+                    #left for the model to fail on
+                    unique[name] = molblock
+                    continue
+                representative = representatives.setdefault(Chem.MolToSmiles(mol), name)
+                topology[name] = (representative, list(Chem.CanonicalRankAtoms(mol, breakTies=True)))
+                if representative == name:
+                    unique[name] = molblock
+
+        unique_charges, unique_errors = self.assign_charges_chunked(unique)
+        charges = {}
+        errors = {}
+        for name in mol_dictionary:
+            representative, ranks = topology.get(name, (name, None))
+            if representative == name:
+                charges[name] = unique_charges[name]
+                if name in unique_errors:
+                    errors[name] = unique_errors[name]
+            elif representative in unique_errors:
+                charges[name], errors[name] = [0] * len(ranks), unique_errors[representative]
+            else:
+                #atoms with the same canonical rank are the same atom of the topology
+                by_rank = dict(zip(topology[representative][1], unique_charges[representative]))
+                charges[name] = [by_rank[rank] for rank in ranks]
+        return charges, errors
+
+    def assign_charges_chunk(self, charge_formats: list[any]) -> list[list[float]] | None:
+        """Assign charges to a chunk of molecules at once, e.g. in one forward pass of a batched graph
+
+        Parameters
+        ----------
+        charge_formats: list
+            the molecules of the chunk, converted with convert_to_charge_format
+
+        Returns
+        -------
+        charges: list of lists or None
+            charges of each molecule in order, or None for models which assign charges one molecule at a time
+        """
+        return None
+
+    def assign_properties(self, charge_format: any) -> dict[str, list]:
+        """Assign charges, and any other on-atom properties the model predicts
+
+        Parameters
+        ----------
+        charge_format: generic python object depending on the charge model
+            Charge model appropriate python object on which to assign the charges
+
+        Returns
+        -------
+        properties: dict
+            the ``charges`` and, for models which predict them, the ``dipoles`` as lists
+        """
+        with self.timed('assign_charges'):
+            return {'charges': self.assign_charges(charge_format)}
+
+    def failed_charges(self, name: str, molblock: str, error: Exception) -> tuple[list[float], str]:
+        """Zero charges and an error message for a molecule which failed
+
+        Parameters
+        ----------
+        name: str
+            name of the molecule
+        molblock: str
+            molblock of the molecule
+        error: Exception
+            the error raised by the charge model
+
+        Returns
+        -------
+        charges, error_message: tuple
+            a zero charge for each atom and the error message
+        """
+        mol_block = rdmolfiles.MolFromMolBlock(molblock, removeHs=False)
+        if mol_block is None:
+            return [], f'charges failed with {name} due to {error}'
+        no_atoms = mol_block.GetNumAtoms()
+        return [0] * no_atoms, f'charges failed with {Chem.MolToSmiles(mol_block)} due to {error}'
+
     def assign_charges(self, charge_format: any):
         """Assign charges according to charge model selected
 
@@ -11,6 +11,7 @@ else:
     #used for execution
     from naglmbis.models import load_charge_model
     from base_class  import ExternalChargeModel
+    from nagl_batching import NaglBatchedModel
     from rdkit import Chem
     from openff.toolkit.topology import Molecule
     import rdkit
@@ -18,7 +19,7 @@ else:
     import argparse
     import sys
 
-    class MBIS_Model(ExternalChargeModel):
+    class MBIS_Model(NaglBatchedModel, ExternalChargeModel):
 
         _name = "naglmbis"
         def __init__(self, ftype="json"):
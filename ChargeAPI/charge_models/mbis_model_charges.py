@@ -13,13 +13,14 @@ else:
     #used for execution
     from naglmbis.models import load_charge_model
     from base_class  import ExternalChargeModel
+    from nagl_batching import NaglBatchedModel
     from openff.toolkit.topology import Molecule
     from rdkit import Chem
     import rdkit
     import subprocess
     import argparse
 
-    class MBIS_Model_charge(ExternalChargeModel):
+    class MBIS_Model_charge(NaglBatchedModel, ExternalChargeModel):
 
         _name = "naglmbis_charge"
         def __init__(self, ftype="json"):
@@ -13,6 +13,7 @@ else:
     #used for execution
     from naglmbis.models import load_charge_model
     from base_class  import ExternalChargeModel
+    from nagl_batching import NaglBatchedModel
     from openff.toolkit.topology import Molecule
     from rdkit import Chem
     import rdkit
@@ -20,7 +21,7 @@ else:
     import subprocess
     import argparse
 
-    class MBIS_Model_charge(ExternalChargeModel):
+    class MBIS_Model_charge(NaglBatchedModel, ExternalChargeModel):
 
         _name = "naglmbis_wb_esp_gas_charge_dipole_esp_default"
         def __init__(self, ftype="json"):
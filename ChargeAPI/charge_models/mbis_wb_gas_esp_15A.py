@@ -14,13 +14,14 @@ else:
     from naglmbis.models import load_charge_model
     from rdkit import Chem
     from base_class  import ExternalChargeModel
+    from nagl_batching import NaglBatchedModel
     from openff.toolkit.topology import Molecule
     import rdkit
     import subprocess
     import argparse
     import sys
 
-    class MBIS_Model_charge(ExternalChargeModel):
+    class MBIS_Model_charge(NaglBatchedModel, ExternalChargeModel):
 
         _name = "naglmbis_wb_water_charge"
         def __init__(self, ftype="json"):
@@ -0,0 +1,63 @@
+"""
+Batched inference for the Nagl MBIS models : https://github.com/jthorton/nagl-mbis
+"""
+import os
+# Only the models are inspected when checking environments, this module is imported by them
+if os.environ.get("IMPORT_CHECK") != "1":
+    import numpy as np
+
+    class NaglBatchedModel:
+        """Mixin for the Nagl MBIS models, assigning the charges of a chunk of molecules with one forward pass
+        of the model over the batched graph of the chunk, rather than one pass per molecule
+        """
+        #output of the model holding the on-atom charges
+        charge_property = "mbis-charges"
+        #output of the models with a dipole readout holding the on-atom dipoles, returned to typed requests with the charges
+        dipole_property = "mbis-dipoles"
+        #the models only see the molecular graph
+        conformer_independent = True
+
+        def assign_properties(self, charge_format) -> dict[str, list]:
+            """Assign charges, and the on-atom dipoles of the models which predict them, from one pass of the model
+
+            Parameters
+            ----------
+            charge_format: rdkit molecule
+                molecule, as converted with convert_to_charge_format
+
+            Returns
+            -------
+            properties: dict
+                the ``charges`` and, for models with a dipole readout, the (n_atoms, 3) ``dipoles`` as lists
+            """
+            with self.timed('assign_charges'):
+                properties = self.charge_model.compute_properties(charge_format)
+                result = {'charges': np.asarray(properties[self.charge_property]).flatten().tolist()}
+                if self.dipole_property in properties:
+                    result['dipoles'] = np.asarray(properties[self.dipole_property]).reshape(-1, 3).tolist()
+            return result
+
+        def assign_charges_chunk(self, rdkit_conformers: list) -> list[list[float]]:
+            """Assign charges to a chunk of rdkit molecules with a single forward pass
+
+            Parameters
+            ----------
+            rdkit_conformers: list
+                rdkit molecules, as converted with convert_to_charge_format
+
+            Returns
+            -------
+            charges: list of lists
+                charges of each molecule in order
+            """
+            from openff.nagl.molecule._dgl import DGLMoleculeBatch
+            import torch
+
+            batch = DGLMoleculeBatch(*[self.charge_model.to_nagl_molecule(mol) for mol in rdkit_conformers])
+            with torch.no_grad():
+                charges = self.charge_model.forward(batch)[self.charge_property].detach().numpy().flatten()
+            n_atoms = [mol.GetNumAtoms() for mol in rdkit_conformers]
+            if len(charges) != sum(n_atoms):
+                raise ValueError(f"{len(charges)} charges predicted for a chunk of {sum(n_atoms)} atoms")
+            #the atoms of the batched graph are the atoms of each molecule in turn
+            return [molecule_charges.tolist() for molecule_charges in np.split(charges, np.cumsum(n_atoms)[:-1])]
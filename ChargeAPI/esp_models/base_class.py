@@ -5,6 +5,8 @@ import os
 import logging 
 import numpy as np
 import tempfile
+import time
+import contextlib
 from typing import Optional
 
 
@@ -26,6 +28,16 @@ class ExternalESPModel:
     subclasses = {}
 
     _name = None
+    #seconds spent in each stage, recorded while this is a dictionary (set by the model worker for timed requests)
+    timings = None
+    #opening angle of the treecode ESP, or None to evaluate the ESP exactly (set by the model worker for each request)
+    theta = None
+    #whether broken up requests return the atoms the multipoles sit on rather than a grid (set by the model worker)
+    multipoles_only = False
+    #NPZ file of the grids of a batch, see charge_files.write_grid_file (set by the model worker)
+    batch_grid_file = None
+    #molecules per prediction for the models which run a batch in chunks, see assign_esp_chunk
+    chunk_size = int(os.environ.get("CHARGEAPI_CHUNK_SIZE", 64))
     def __init_subclass__(cls, *args, **kwargs):
         """
         Catch any new external charge models (all external charge models must inherit
@@ -41,6 +53,24 @@ class ExternalESPModel:
         """Check external code can be run
         """
 
+    @contextlib.contextmanager
+    def timed(self, stage: str):
+        """Add the time spent in the block to the stage's timing, if timings are being recorded
+
+        Parameters
+        ----------
+        stage: str
+            name of the stage, e.g. assign_esp
+        """
+        if self.timings is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
     @abstractmethod
     def __call__(self,
                 conformer_mol: str,
@@ -72,11 +102,13 @@ class ExternalESPModel:
         if not batched:
             logging.info('not batched option chosen')
 
-            charge_format = self.convert_to_charge_format(conformer_mol)
+            with self.timed('convert_to_charge_format'):
+                charge_format = self.convert_to_charge_format(conformer_mol)
             if grid is not None:
                 grid = grid * unit.angstrom
             else:
-                grid = self.build_grid(conformer_mol)
+                with self.timed('build_grid'):
+                    grid = self.build_grid(conformer_mol, charge_format)
             #if the charge model requires generation and reading of files to produce charges
             if file_method:
                 file_path = self.generate_temp_files(charge_format)
@@ -84,38 +116,23 @@ class ExternalESPModel:
                 charges = self.read_charge_output(charge_file_path)
             #other charge model types will produce charges based on python objects in internal memory
             else:
-                values, esp_grid = self.assign_esp(charge_format, grid)
+                with self.timed('assign_esp'):
+                    values, esp_grid = self.assign_esp(charge_format, grid)
             return values, esp_grid
 
         else:
             logging.info(' batched option chosen')
             #make dictionary from json file
             mol_dictionary = self.molfile_to_dict(conformer_mol)
-            results_dictionary = {}
-            for molhash, mol_data in mol_dictionary.items():
-                molblock = mol_data[0]
-                mol_grid = mol_data[1]  # This could be None
-                # logging.error(f'molbock is {molblock}')
-                # logging.error(f'mol_grid is {mol_grid}')
-                charge_format = self.convert_to_charge_format(molblock)
-                if mol_grid is None:
-                    grid = self.build_grid(molblock)
-                else:
-                    #loop through grid points here
-                    grid = np.array(mol_grid).reshape(-1,3) * unit.angstrom
-                
-                if broken_up:
-                    monopole, dipole, quadropole = self.assign_multipoles(charge_format, grid)
-                    values = (monopole, dipole, quadropole)
-                    esp_grid = grid.m.tolist()
-                else:
-                    values, esp_grid = self.assign_esp(charge_format, grid)
-                esp_result = dict()
-                esp_result['esp_values'] = values
-                esp_result['esp_grid'] = esp_grid
-                results_dictionary[molhash] = esp_result
+            results_dictionary = self.assign_esp_batched(mol_dictionary, broken_up, batched_grid)
+            if batched_grid:
+                #concatenated arrays and offsets, in the layout of the grid file
+                from charge_files import write_esp_file
+                with self.timed('write_esp'):
+                    esp_file = write_esp_file(results_dictionary, f"{os.path.splitext(conformer_mol)[0]}_esp.npz")
+                return os.path.abspath(esp_file)
             #write charges dictionary to file
-            esp_file = f"{conformer_mol.strip('.json')}_esp.json"
+            esp_file = f"{os.path.splitext(conformer_mol)[0]}_esp.json"
             with open(esp_file,"w+") as outfile:
                 json.dump(results_dictionary, outfile, indent=2)
             charge_file_path = os.path.abspath(esp_file)
@@ -123,6 +140,85 @@ class ExternalESPModel:
 
 
 
+    def assign_esp_batched(self, mol_dictionary: dict, broken_up: bool = False, batched_grid: bool = False) -> dict:
+        """Assign the ESP, or the multipoles, of a batch of molecules a chunk at a time, see assign_esp_chunk
+
+        Parameters
+        ----------
+        mol_dictionary: dict
+            molecule names and their molblocks, or their molblocks and grids (None to build the model's grid)
+        broken_up: bool
+            whether to assign the multipoles rather than the ESP
+        batched_grid: bool
+            whether to return the arrays of each molecule, as written to an NPZ ESP file, rather than lists
+
+        Returns
+        -------
+        results_dictionary: dict
+            molecule names and their ``esp_values`` with the ``esp_grid``, or the ``coordinates`` and ``elements``
+            of the atoms for multipole only requests, in the order of the batch
+        """
+        results_dictionary = {}
+        names = list(mol_dictionary)
+        grid_file = None
+        if self.batch_grid_file is not None:
+            #the grid file is part of ChargeAPI's infrastructure, which sits next to the model worker
+            from charge_files import read_esp_file
+            grid_file = read_esp_file(self.batch_grid_file)
+        #converted, gridded and assigned a chunk at a time
+        for start in range(0, len(names), max(self.chunk_size, 1)):
+            charge_formats = []
+            grids = []
+            for molhash in names[start:start + max(self.chunk_size, 1)]:
+                entry = mol_dictionary[molhash]
+                #molecules whose grids are in the grid file may be given without one
+                molblock, mol_grid = (entry, None) if isinstance(entry, str) else entry  # grid could be None
+                with self.timed('convert_to_charge_format'):
+                    charge_formats.append(self.convert_to_charge_format(molblock))
+                if broken_up and self.multipoles_only:
+                    #the ESP is evaluated by the caller, on its own grids
+                    grids.append(None)
+                elif grid_file is not None and molhash in grid_file:
+                    #a slice of the memory mapped grid file
+                    grids.append(grid_file[molhash]['grid'] * unit.angstrom)
+                elif mol_grid is None:
+                    with self.timed('build_grid'):
+                        grids.append(self.build_grid(molblock, charge_formats[-1]))
+                else:
+                    #loop through grid points here
+                    grids.append(np.array(mol_grid).reshape(-1,3) * unit.angstrom)
+
+            chunk_values = None
+            try:
+                with self.timed('assign_multipoles' if broken_up else 'assign_esp'):
+                    chunk_values = self.assign_esp_chunk(charge_formats, grids, broken_up)
+            except Exception as e:
+                LOGGER.info(f'chunk of {len(charge_formats)} molecules failed, assigning them one by one: {e}')
+            if chunk_values is None:
+                chunk_values = []
+                for charge_format, grid in zip(charge_formats, grids):
+                    if broken_up:
+                        with self.timed('assign_multipoles'):
+                            chunk_values.append(self.assign_multipoles(charge_format, grid))
+                    else:
+                        with self.timed('assign_esp'):
+                            chunk_values.append(self.assign_esp(charge_format, grid)[0])
+
+            for molhash, values, grid, charge_format in zip(names[start:start + max(self.chunk_size, 1)], chunk_values, grids, charge_formats):
+                if batched_grid:
+                    results_dictionary[molhash] = self.esp_arrays(values, grid, charge_format, broken_up)
+                    continue
+                esp_result = dict()
+                esp_result['esp_values'] = tuple(values) if broken_up else np.asarray(values).tolist()
+                if grid is None:
+                    coordinates, elements = self.multipole_sites(charge_format)
+                    esp_result['coordinates'] = np.asarray(coordinates).tolist()
+                    esp_result['elements'] = list(elements)
+                else:
+                    esp_result['esp_grid'] = grid.m.tolist()
+                results_dictionary[molhash] = esp_result
+        return results_dictionary
+
     def convert_to_charge_format(self, conformer_mol: str):
         """Convert openff molecule to appropriate format on which to assign charges
 
@@ -175,6 +271,78 @@ class ExternalESPModel:
             tuple of multipoles  
         """
 
+    def assign_esp_chunk(self, charge_formats: list[any], grids: list[unit.Quantity], broken_up: bool) -> list | None:
+        """Assign the ESP, or the multipoles, of a chunk of molecules at once, e.g. with one prediction over the
+        batched graph of the chunk
+
+        Parameters
+        ----------
+        charge_formats: list
+            the molecules of the chunk, converted with convert_to_charge_format
+        grids: list[unit.Quantity]
+            grid of each molecule
+        broken_up: bool
+            whether to return the multipoles rather than the ESP
+
+        Returns
+        -------
+        list or None
+            the ESP values, or the monopoles, dipoles and quadrupoles, of each molecule in order, or None for
+            models which assign them one molecule at a time
+        """
+        return None
+
+    def esp_arrays(self, values: list, grid: Optional[unit.Quantity], charge_format: any, broken_up: bool) -> dict[str, np.ndarray]:
+        """Arrays of a molecule for the NPZ ESP file of a batch, see charge_files.write_esp_file
+
+        Parameters
+        ----------
+        values: list
+            the ESP values, or the monopoles, dipoles and quadrupoles
+        grid: unit.Quantity or None
+            grid of the molecule, None for multipole only requests
+        charge_format: any
+            the molecule converted with convert_to_charge_format
+        broken_up: bool
+            whether the values are the multipoles
+
+        Returns
+        -------
+        dict[str, np.ndarray]
+            the esp and grid, or the multipoles (and the coordinates and elements for multipole only requests)
+        """
+        if not broken_up:
+            return {'esp': np.asarray(values, dtype=np.float64), 'grid': grid.m_as(unit.angstrom)}
+        monopoles, dipoles, quadrupoles = values
+        arrays = {
+            'monopoles': np.asarray(monopoles, dtype=np.float64).reshape(-1),
+            'dipoles': np.asarray(dipoles, dtype=np.float64).reshape(-1, 3),
+            'quadrupoles': np.asarray(quadrupoles, dtype=np.float64).reshape(-1, 3, 3),
+        }
+        if grid is None:
+            coordinates, elements = self.multipole_sites(charge_format)
+            arrays['coordinates'] = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+            arrays['elements'] = np.asarray(elements, dtype=str)
+        return arrays
+
+    def multipole_sites(self, charge_format: any) -> tuple[np.ndarray, list[str]]:
+        """Coordinates and elements of the atoms the multipoles sit on, returned by multipole only requests so the
+        caller can evaluate the ESP itself
+
+        Parameters
+        ----------
+        charge_format: any
+            the molecule converted with convert_to_charge_format, the coordinates and elements for models which
+            do not override this
+
+        Returns
+        -------
+        coordinates, elements: tuple
+            (n_atoms, 3) coordinates in angstrom and element symbols
+        """
+        coordinates, elements = charge_format
+        return coordinates, elements
+
     def generate_temp_files(self, charge_format: any):
         """Generate the temporary files required to run charge model
 
@@ -215,8 +383,18 @@ class ExternalESPModel:
         returns charges as a list of lists (charges for each atom for each molecule)
         """
 
-    def build_grid(molecule: any) -> np.ndarray:
+    def build_grid(self, conformer_mol: str, charge_format: any = None) -> unit.Quantity:
         """Build grid required for ESP method around molecule
-        
-        
+
+        Parameters
+        ----------
+        conformer_mol: str
+            mol block of the molecule
+        charge_format: any, optional
+            the molecule already converted with convert_to_charge_format, so it need not be parsed again
+
+        Returns
+        -------
+        grid: unit.Quantity
+            grid points
         """
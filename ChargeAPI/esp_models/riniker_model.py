@@ -35,12 +35,22 @@ else:
     class RIN_model(ExternalESPModel):
         
         _name = "rinker"
-        def __init__(self, ftype="json"):
+        #threads the grid blocks of the ESP are spread over
+        esp_threads = int(os.environ.get("CHARGEAPI_ESP_THREADS", 1))
+        def __init__(self, ftype="json", grid_settings: Optional[dict] = None):
             super().__init__()
             self.file_type = ftype
             self.dtype = np.float32
             self.esp_model = load_model()
-            self.AU_ESP = unit.atomic_unit_of_energy / unit.elementary_charge
+            #whether batched predictions agree with single ones, checked on the first chunk and set to False if they
+            #differ or a batched prediction fails, the later chunks are then predicted one molecule at a time
+            self.batched_prediction = None
+            #the grid builder is part of ChargeAPI's infrastructure, which sits next to the model worker
+            from esp_grids import GridCache, grid_settings_from_environment
+            #the grids are reused for repeated requests on the same conformer while the model is resident
+            self.grid_cache = GridCache()
+            #grid type and settings of the grids the model builds, see esp_grids.grid_settings_from_environment
+            self.grid_settings = grid_settings if grid_settings is not None else grid_settings_from_environment()
 
         def __call__(self,  conformer_mol: 
             str, batched: bool, 
@@ -66,18 +76,25 @@ else:
                 Files containing charges for each molecule
             """
             
-            if not broken_up:
+            if batched or not broken_up:
                 return super().__call__(conformer_mol = conformer_mol, 
                                         batched = batched,
+                                        broken_up = broken_up,
+                                        batched_grid = batched_grid,
                                         grid=grid)
             else:
-                charge_format = self.convert_to_charge_format(conformer_mol)
+                with self.timed('convert_to_charge_format'):
+                    charge_format = self.convert_to_charge_format(conformer_mol)
                 # if grid is None:
                 #     grid = self.build_grid(conformer_mol)
                 # else:
                 #     grid = grid * unit.angstrom
                 #if the charge model requires generation and reading of files to produce charges
-                monopole, dipole, quadropole = self.assign_multipoles(charge_format)
+                with self.timed('assign_multipoles'):
+                    monopole, dipole, quadropole = self.assign_multipoles(charge_format)
+                if self.multipoles_only:
+                    coordinates, elements = self.multipole_sites(charge_format)
+                    return monopole, dipole, quadropole, coordinates.tolist(), elements
                 return monopole, dipole, quadropole
                 
         
@@ -101,24 +118,48 @@ else:
             coordinates = rdkit_conformer.GetConformer(0).GetPositions().astype(self.dtype)
             return coordinates, elements  
         
-        def build_grid(self, conformer_mol: str) -> np.ndarray:
-            """Builds the grid on which to assign the esp
+        def build_grid(self, conformer_mol: str, charge_format: Optional[tuple[np.ndarray, list[str]]] = None) -> unit.Quantity:
+            """Builds the grid on which to assign the esp, or reuses the grid of an earlier request on the same conformer
 
             Parameters
             ----------
-            co
-            
+            conformer_mol: str
+                mol block of the molecule
+            charge_format: tuple, optional
+                coordinates and elements from convert_to_charge_format, to save parsing the mol block again
+
+            Returns
+            -------
+            grid: unit.Quantity
+                grid of the model's grid_settings in angstrom, an MSK grid by default
+            """
+            if charge_format is None:
+                charge_format = self.convert_to_charge_format(conformer_mol)
+            coordinates, elements = charge_format
+            return self.grid_cache.grid(coordinates, elements, **self.grid_settings) * unit.angstrom
+
+        def build_openff_grid(self, conformer_mol: str) -> unit.Quantity:
+            """Builds the grid on which to assign the esp with openff-recharge, with the model's grid_settings. The
+            MSK grids of build_grid reproduce it, openff-recharge's lattices are face centred rather than cubic
+
+            Parameters
+            ----------
+            conformer_mol: str
+                mol block of the molecule
             """
 
             rdkit_conformer = rdkit.Chem.rdmolfiles.MolFromMolBlock(conformer_mol, removeHs = False)
             openff_mol = Molecule.from_rdkit(rdkit_conformer, allow_undefined_stereo=True)
-            grid_settings = MSKGridSettings(
-                    type="msk", density=1.0
-                )
+            if self.grid_settings['grid_type'] == 'msk':
+                grid_settings = MSKGridSettings(
+                        type="msk", density=self.grid_settings['density']
+                    )
+            else:
+                grid_settings = LatticeGridSettings(spacing=self.grid_settings['spacing'])
             grid = GridGenerator.generate(openff_mol, openff_mol.conformers[0], grid_settings)
             return grid
         
-        def assign_esp(self, coordinates_elements: tuple[np.ndarray,str], grid: unit.Quantity) -> list[float,float]:
+        def assign_esp(self, coordinates_elements: tuple[np.ndarray,str], grid: unit.Quantity) -> tuple[np.ndarray, np.ndarray]:
             """Assign charges according to charge model selected
 
             Parameters
@@ -128,184 +169,144 @@ else:
 
             Returns
             -------
-            partial_charges: list of partial charges 
+            esp, grid: tuple
+                esp at each grid point and the grid, as arrays so large grids are not turned into lists
             """
             (coordinates, elements) = coordinates_elements
             monopoles, dipoles, quadrupoles = self.esp_model.predict(coordinates, elements)
-            #multipoles with correct units
-            monopoles_quantity = monopoles.numpy()*unit.e
-            dipoles_quantity = dipoles.numpy()*unit.e*unit.angstrom
-            quadropoles_quantity = quadrupoles.numpy()*unit.e*unit.angstrom*unit.angstrom
-            coordinates_ang = coordinates * unit.angstrom
-            monopole_esp = self.calculate_esp_monopole_au(grid_coordinates=grid,
-                                                atom_coordinates=coordinates_ang,
-                                                charges = monopoles_quantity)
-            dipole_esp = self.calculate_esp_dipole_au(grid_coordinates=grid,
-                                            atom_coordinates=coordinates_ang,
-                                            dipoles= dipoles_quantity)
-            quadrupole_esp = self.calculate_esp_quadropole_au(grid_coordinates=grid,
-                                            atom_coordinates=coordinates_ang,
-                                            quadrupoles= quadropoles_quantity)
+            esp = self.esp_from_multipoles(coordinates, grid, monopoles.numpy(), dipoles.numpy(), quadrupoles.numpy())
             #NOTE: ESP units, hartree/e and grid units are angstrom
-            return (monopole_esp + dipole_esp + quadrupole_esp).m.flatten().tolist(), grid.m.tolist()
-        
-        def assign_multipoles(self, coordinates_elements: tuple[np.ndarray]) -> tuple[list, list, list]:
-            """Assign charges according to charge model selected
+            return esp, grid.m_as(unit.angstrom)
+
+        def esp_from_multipoles(self,
+            coordinates: np.ndarray,
+            grid: unit.Quantity,
+            monopoles: np.ndarray,
+            dipoles: np.ndarray,
+            quadrupoles: np.ndarray,
+            ) -> np.ndarray:
+            """ESP of the predicted multipoles on the grid, in hartree/e
 
             Parameters
             ----------
-            ob_mol: generic python object depending on the charge model
-                Charge model appropriate python object on which to assign the charges
+            coordinates: np.ndarray
+                atom coordinates in angstrom
+            grid: unit.Quantity
+                grid on which to build the esp on
+            monopoles, dipoles, quadrupoles: np.ndarray
+                multipoles in e, e.angstrom and e.angstrom**2
 
             Returns
             -------
-            tuple[list]
-                tuple of multipoles  
+            esp: np.ndarray
+                esp at each grid point
             """
-            (coordinates, elements) = coordinates_elements
-            monopoles, dipoles, quadrupoles = self.esp_model.predict(coordinates, elements)
-            #multipoles with correct units
-            logging.error(f"monopole predicted {monopoles}")
-            logging.error(f"dipoles predicted {dipoles}")
-            logging.error(f"quadrupole predicted {quadrupoles}")
+            #the ESP kernels are part of ChargeAPI's infrastructure, which sits next to the model worker
+            from esp_kernels import multipole_esp, treecode_esp
+
+            #units are stripped here, the grid is in angstrom
+            multipoles = dict(grid=grid.m_as(unit.angstrom),
+                              coordinates=coordinates,
+                              monopoles=monopoles,
+                              dipoles=dipoles,
+                              quadrupoles=quadrupoles,
+                              n_threads=self.esp_threads)
+            if self.theta is None:
+                return multipole_esp(**multipoles)
+            #approximate far field, for large systems
+            return treecode_esp(theta=self.theta, **multipoles)
+
+        def predict_batched(self, coordinates_elements: list[tuple[np.ndarray, list[str]]]) -> list[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+            """Predict the multipoles of many molecules with one pass of the model over their batched graph
 
-            monopoles_quantity = monopoles.numpy()*unit.e
-            dipoles_quantity = dipoles.numpy()*unit.e*unit.angstrom
-            quadropoles_quantity = quadrupoles.numpy()*unit.e*unit.angstrom*unit.angstrom
-            coordinates_ang = coordinates * unit.angstrom
-            # monopole_esp = self.calculate_esp_monopole_au(grid_coordinates=grid,
-            #                                     atom_coordinates=coordinates_ang,
-            #                                     charges = monopoles_quantity)
-            # dipole_esp = self.calculate_esp_dipole_au(grid_coordinates=grid,
-            #                                 atom_coordinates=coordinates_ang,
-            #                                 dipoles= dipoles_quantity)
-            # quadrupole_esp = self.calculate_esp_quadropole_au(grid_coordinates=grid,
-            #                                 atom_coordinates=coordinates_ang,
-            #                                 quadrupoles= quadropoles_quantity)
-            # #NOTE: ESP units, hartree/e and grid units are angstrom
-            return monopoles_quantity.m.flatten().tolist(), dipoles_quantity.m.flatten().tolist(), quadropoles_quantity.m.flatten().tolist()
-    
-        def calculate_esp_monopole_au(self,
-            grid_coordinates: unit.Quantity,  # N x 3
-            atom_coordinates: unit.Quantity,  # M x 3
-            charges: unit.Quantity,  # M
-            ):
-            """Generate the esp from the on atom monopole
-            
             Parameters
             ----------
-            grid_coordinates: unit.Quantity
-                grid on which to build the esp on 
-
-            atom_coordinates: unit.Quantity
-                coordinates of atoms to build the esp  
-            
-            charges: unit.Quantity
-                monopole or charges
+            coordinates_elements: list[tuple]
+                coordinates and elements of each molecule
 
             Returns
             -------
-            monopole_esp: unit.Quantity
-                monopole esp
+            list[tuple]
+                monopoles (n_atoms,), dipoles (n_atoms, 3) and quadrupoles (n_atoms, 3, 3) of each molecule
             """
-            #prefactor
-            ke = 1 / (4 * np.pi * unit.epsilon_0) # 1/vacuum_permittivity, 1/(e**2 * a0 *Eh)
-
-            #Ensure everything is in AU and correct dimensions
-            charges = charges.flatten()
-            grid_coordinates = grid_coordinates.reshape((-1, 3)).to(unit.bohr)  #Å to Bohr
-            atom_coordinates = atom_coordinates.reshape((-1, 3)).to(unit.bohr)    #Å to Bohr
-            #displacement and distance
-            displacement = grid_coordinates[:, None, :] - atom_coordinates[None, :, :]  # N x M x 3 B
-            distance = np.linalg.norm(displacement.m, axis=-1)*unit.bohr # N, M
-            inv_distance = 1 / distance  #N, M
-
-            esp = ke*np.sum(inv_distance * charges[None,:], axis=1)  # (N,M)*(1,M) -> (N,M) numpy broadcasts all charges. Over all atoms  =  Sum over M (atoms), resulting shape: (N,) charges broadcast over each N
-            
-            return esp.to(self.AU_ESP)
-
-        def calculate_esp_dipole_au(self,
-            grid_coordinates: unit.Quantity,  # N , 3
-            atom_coordinates: unit.Quantity,  # M , 3
-            dipoles: unit.Quantity,  # M , 3       
-            ) -> unit.Quantity:
-            """Generate the esp from the on atom dipoles
-            
-            Parameters
-            ----------
-            grid_coordinates: unit.Quantity
-                grid on which to build the esp on 
-
-            atom_coordinates: unit.Quantity
-                coordinates of atoms to build the esp  
-            
-            dipoles: unit.Quantity
-                dipoles or charges
-
-            Returns
-            -------
-            dipoles_esp: unit.Quantity
-                monopole esp
+            coordinates = [coordinates for coordinates, _ in coordinates_elements]
+            elements = [elements for _, elements in coordinates_elements]
+            graph = build_graph_batched(coordinates, elements)
+            monopoles, dipoles, quadrupoles = self.esp_model(graph)
+            n_atoms = [len(molecule_coordinates) for molecule_coordinates in coordinates]
+            monopoles = np.asarray(monopoles).reshape(-1)
+            if len(monopoles) != sum(n_atoms):
+                raise ValueError(f"{len(monopoles)} monopoles predicted for a chunk of {sum(n_atoms)} atoms")
+            #the atoms of the batched graph are the atoms of each molecule in turn
+            splits = np.cumsum(n_atoms)[:-1]
+            return list(zip(
+                np.split(monopoles, splits),
+                np.split(np.asarray(dipoles).reshape(-1, 3), splits),
+                np.split(np.asarray(quadrupoles).reshape(-1, 3, 3), splits),
+            ))
+
+        def assign_esp_chunk(self, charge_formats: list[tuple[np.ndarray, list[str]]], grids: list[unit.Quantity], broken_up: bool) -> list | None:
+            """Assign the ESP, or the multipoles, of a chunk of molecules from one batched prediction
+
+            The batched pass skips the post-processing of esp_model.predict, so the smallest molecule of the first
+            chunk is also predicted with predict, and if the two differ, or the batched prediction fails, the model
+            goes back to predicting one molecule at a time.
             """
+            if self.batched_prediction is False:
+                return None
+            try:
+                multipoles = self.predict_batched(charge_formats)
+            except Exception:
+                self.batched_prediction = False
+                raise
+            if self.batched_prediction is None:
+                smallest = int(np.argmin([len(coordinates) for coordinates, _ in charge_formats]))
+                single = [multipole.numpy() for multipole in self.esp_model.predict(*charge_formats[smallest])]
+                self.batched_prediction = all(
+                    np.allclose(batched.reshape(-1), predicted.reshape(-1), rtol=1e-4, atol=1e-5)
+                    for batched, predicted in zip(multipoles[smallest], single)
+                )
+                if not self.batched_prediction:
+                    logging.warning("batched multipole predictions differ from single ones, predicting one molecule at a time")
+                    return None
+
+            if broken_up:
+                return [
+                    (monopoles.flatten().tolist(), dipoles.flatten().tolist(), quadrupoles.flatten().tolist())
+                    for monopoles, dipoles, quadrupoles in multipoles
+                ]
+            return [
+                self.esp_from_multipoles(coordinates, grid, monopoles, dipoles, quadrupoles).tolist()
+                for (coordinates, _), grid, (monopoles, dipoles, quadrupoles) in zip(charge_formats, grids, multipoles)
+            ]
+
+        def assign_multipoles(self, coordinates_elements: tuple[np.ndarray], grid: Optional[unit.Quantity] = None) -> tuple[list, list, list]:
+            """Assign charges according to charge model selected
 
-            #prefactor
-            ke = 1 / (4 * np.pi * unit.epsilon_0) # 1/vacuum_permittivity, 1/(e**2 * a0 *Eh)
-
-            #Ensure everything is in AU
-            dipoles = dipoles.to(unit.e*unit.bohr)
-            grid_coordinates = grid_coordinates.reshape((-1, 3)).to(unit.bohr)  #Å to Bohr
-            atom_coordinates = atom_coordinates.reshape((-1, 3)).to(unit.bohr)    #Å to Bohr
-
-            displacement = grid_coordinates[:, None, :] - atom_coordinates[None, :, :]  # N , M , 3 
-            distance = np.linalg.norm(displacement.m, axis=-1)*unit.bohr # N, M 
-            inv_distance_cubed = 1 / distance**3 #1/B
-            #Hadamard product for element-wise multiplication
-            dipole_dot = np.sum(displacement * dipoles[None,:,:], axis=-1) # dimless * e.a
-
-            esp = ke*np.sum(inv_distance_cubed* dipole_dot,axis=1) # e.a/a**2 
-
-            return esp.to(self.AU_ESP)
-
-        def calculate_esp_quadropole_au(self,
-            grid_coordinates: unit.Quantity,  # N x 3
-            atom_coordinates: unit.Quantity,  # M x 3
-            quadrupoles: unit.Quantity,  # M N 
-            ) -> unit.Quantity:
-            """Generate the esp from the on atom quandropoles
-            
             Parameters
             ----------
-            grid_coordinates: unit.Quantity
-                grid on which to build the esp on 
+            ob_mol: generic python object depending on the charge model
+                Charge model appropriate python object on which to assign the charges
 
-            atom_coordinates: unit.Quantity
-                coordinates of atoms to build the esp  
-            
-            quandropoles: unit.Quantity
-                dipoles or charges
+            grid: unit.Quantity, optional
+                not needed, the multipoles do not depend on the grid
 
             Returns
             -------
-            quandropoles_esp: unit.Quantity
-                monopole esp
+            tuple[list]
+                tuple of multipoles  
             """
+            (coordinates, elements) = coordinates_elements
+            monopoles, dipoles, quadrupoles = self.esp_model.predict(coordinates, elements)
+            #multipoles with correct units
+            logging.error(f"monopole predicted {monopoles}")
+            logging.error(f"dipoles predicted {dipoles}")
+            logging.error(f"quadrupole predicted {quadrupoles}")
 
-            #prefactor
-            ke = 1 / (4 * np.pi * unit.epsilon_0) # 1/vacuum_permittivity, 1/(e**2 * a0 *Eh)
-            #Ensure everything is in AU
-            quadrupoles = quadrupoles.to(unit.e*unit.bohr*unit.bohr)    
-            grid_coordinates = grid_coordinates.reshape((-1, 3)).to(unit.bohr)  #Å to Bohr
-            atom_coordinates = atom_coordinates.reshape((-1, 3)).to(unit.bohr)    #Å to Bohr
-
-            displacement = grid_coordinates[:, None, :] - atom_coordinates[None, :, :]  # N , M , 3 
-            distance = np.linalg.norm(displacement.m, axis=-1)*unit.bohr # N, M 
-            inv_distance = 1 / distance #1/B
-
-            quadrupole_dot_1 = np.sum(quadrupoles[None,:,:] * displacement[:,:,None],axis=-1)
-            quadrupole_dot_2 = np.sum(quadrupole_dot_1*displacement,axis=-1)
-            esp = ke*np.sum((3*quadrupole_dot_2*(1/2 * inv_distance**5)),axis=-1)
-
-            return esp.to(self.AU_ESP)
+            monopoles_quantity = monopoles.numpy()*unit.e
+            dipoles_quantity = dipoles.numpy()*unit.e*unit.angstrom
+            quadropoles_quantity = quadrupoles.numpy()*unit.e*unit.angstrom*unit.angstrom
+            return monopoles_quantity.m.flatten().tolist(), dipoles_quantity.m.flatten().tolist(), quadropoles_quantity.m.flatten().tolist()
 
 def main():
     parser = argparse.ArgumentParser(description='RIN charge model arguments')
@@ -316,6 +317,8 @@ def main():
     parser.add_argument('--not_broken_up', help='Do not provide multipoles broken up', dest='broken_up', action='store_false')   
     parser.add_argument('--grid_array', type=str, nargs='?', dest='grid_array',
                         help='Provide the grid array as a flattened string (e.g., "[1.0 2.0 3.0 ...]")')
+    parser.add_argument('--grid_file', type=str, nargs='?', dest='grid_file',
+                        help='Provide the grid array as a .npy file of angstrom coordinates, read memory mapped')
     parser.add_argument('--batched_grid', help='Batch grid or not', dest='batched_grid', action='store_true')
     parser.add_argument('--not_batched_grid', help='Do not batch grid', dest='batched_grid', action='store_false')
     parser.add_argument('--protein', help='Input is a protein PDB file', dest='protein_option', action='store_true')
@@ -326,7 +329,9 @@ def main():
 
     # Process grid array if provided.
     grid_array = None
-    if args.grid_array:
+    if args.grid_file:
+        grid_array = np.load(args.grid_file, mmap_mode='r').reshape(-1, 3)
+    elif args.grid_array:
         try:
             grid_list = args.grid_array.strip('[]').split()
             grid_array_flat = np.array([float(x) for x in grid_list])
@@ -375,7 +380,7 @@ def main():
                 grid=grid_array,
             ) 
             # ESSENTIAL TO PRINT THE CHARGES TO STDOUT ~~~
-            print(values, 'OO', esp_grid)
+            print(np.asarray(values).tolist(), 'OO', np.asarray(esp_grid).tolist())
         else:
             # Returns multipole, dipole, quadropole and grid.
             multipole, dipole, quadropole = rin_model(
@@ -0,0 +1,125 @@
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip('flask')
+
+from ChargeAPI.API_infrastructure.charge_request import api_class, module_version
+from ChargeAPI.API_infrastructure.results import ChargeResult, ESPResult, MoleculeError
+
+
+@pytest.fixture
+def client():
+    return api_class.app.test_client()
+
+
+@pytest.fixture
+def esp_module():
+    #the ESP request module needs openff-units
+    pytest.importorskip('openff.units')
+    return api_class._esp_module()
+
+
+class TestChargeServer:
+
+    def test_single_molecule(self, client, monkeypatch):
+        calls = []
+        def handle_charge_request(charge_model, conformer_mol, protein):
+            calls.append((charge_model, conformer_mol, protein))
+            return {'charge_result': '[0.1, -0.1]', 'error': ''}
+        monkeypatch.setattr(module_version, 'handle_charge_request', handle_charge_request)
+
+        response = client.post('/charge/EEM', json={'conformer_mol': 'molblock'})
+
+        assert response.status_code == 200
+        assert response.get_json() == {'charge_result': '[0.1, -0.1]', 'error': ''}
+        assert calls == [('EEM', 'molblock', False)]
+
+    def test_body_posted_as_json_string(self, client, monkeypatch):
+        monkeypatch.setattr(
+            module_version, 'handle_charge_request', lambda **kwargs: {'charge_result': kwargs['conformer_mol'], 'error': ''}
+        )
+
+        response = client.post('/charge/EEM', json=json.dumps({'conformer_mol': 'molblock'}))
+
+        assert response.get_json()['charge_result'] == 'molblock'
+
+    def test_batch(self, client, monkeypatch):
+        results = {
+            'a': ChargeResult(charges=np.array([0.5, -0.5])),
+            'b': ChargeResult(errors=[MoleculeError('b', 'no charges')]),
+        }
+        monkeypatch.setattr(module_version, 'handle_charge_batch', lambda charge_model, molecules: results)
+
+        response = client.post('/charge/EEM', json={'molecules': {'a': 'molblock', 'b': 'molblock'}})
+
+        assert response.get_json() == {'charges': {'a': [0.5, -0.5]}, 'errors': {'b': 'no charges'}}
+
+    def test_streamed_batch(self, client, monkeypatch):
+        def handle_charge_batch(charge_model, molecules, stream):
+            assert stream
+            return iter([(name, ChargeResult(charges=np.array([float(i)]))) for i, name in enumerate(molecules)])
+        monkeypatch.setattr(module_version, 'handle_charge_batch', handle_charge_batch)
+
+        response = client.post(
+            '/charge/EEM',
+            json={'molecules': {'a': 'molblock', 'b': 'molblock'}},
+            headers={'Accept': api_class.NDJSON},
+        )
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        assert response.mimetype == api_class.NDJSON
+        assert lines == [
+            {'molecule': 'a', 'charges': [0.0], 'error': ''},
+            {'molecule': 'b', 'charges': [1.0], 'error': ''},
+        ]
+
+    def test_unknown_model(self, client):
+        response = client.post('/charge/NOT_A_MODEL', json={'conformer_mol': 'molblock'})
+
+        assert response.status_code == 404
+
+    def test_missing_molecule(self, client):
+        response = client.post('/charge/EEM', json={'protein': False})
+
+        assert response.status_code == 400
+        assert 'conformer_mol' in response.get_json()['error']
+
+
+class TestESPServer:
+
+    def test_single_molecule(self, client, esp_module, monkeypatch):
+        from openff.units import unit
+        calls = []
+        def handle_esp_request(**kwargs):
+            calls.append(kwargs)
+            return ESPResult(esp=np.array([0.5]), grid=kwargs['grid'].m_as(unit.angstrom))
+        monkeypatch.setattr(esp_module, 'handle_esp_request', handle_esp_request)
+
+        response = client.post('/esp/RIN', json={'conformer_mol': 'molblock', 'grid': [[0.0, 0.0, 1.0]]})
+
+        assert response.get_json() == {'esp': [0.5], 'grid': [[0.0, 0.0, 1.0]], 'error': ''}
+        grid = calls[0]['grid']
+        assert isinstance(grid, unit.Quantity)
+        np.testing.assert_allclose(grid.m_as(unit.nanometer), [[0.0, 0.0, 0.1]])
+        assert calls[0]['typed']
+
+    def test_batch_options(self, client, esp_module, monkeypatch):
+        calls = []
+        def handle_esp_batch(esp_model, molecules, **options):
+            calls.append((esp_model, molecules, options))
+            return {'water': ESPResult(
+                monopoles=np.array([0.1, -0.1]),
+                coordinates=np.zeros((2, 3)),
+                elements=['O', 'H'],
+            )}
+        monkeypatch.setattr(esp_module, 'handle_esp_batch', handle_esp_batch)
+
+        response = client.post(
+            '/esp/RIN', json={'molecules': {'water': 'molblock'}, 'theta': 0.5, 'multipoles_only': True}
+        )
+
+        assert calls == [('RIN', {'water': 'molblock'}, {'broken_up': False, 'theta': 0.5, 'multipoles_only': True})]
+        water = response.get_json()['results']['water']
+        assert water['monopoles'] == [0.1, -0.1]
+        assert water['elements'] == ['O', 'H']
@@ -0,0 +1,31 @@
+from ChargeAPI.API_infrastructure.array_files import write_array, read_array, remove_array
+import numpy as np
+import os
+
+
+class TestArrayFiles:
+
+    def test_round_trip(self, tmp_path):
+        grid = np.arange(12, dtype=np.float32).reshape(4, 3)
+        file_path = write_array(grid, str(tmp_path))
+        array = read_array(file_path)
+
+        assert array.dtype == np.float64
+        assert not array.flags.writeable
+        np.testing.assert_array_equal(array, grid)
+
+    def test_remove_once_read(self, tmp_path):
+        file_path = write_array(np.ones(5), str(tmp_path))
+        array = read_array(file_path, remove=True)
+
+        assert not os.path.exists(file_path)
+        #still readable after the file is gone
+        assert array.sum() == 5
+
+    def test_remove_missing(self, tmp_path):
+        file_path = write_array(np.ones(1), str(tmp_path))
+        remove_array(file_path)
+        remove_array(file_path)
+        remove_array(None)
+
+        assert not os.path.exists(file_path)
@@ -0,0 +1,50 @@
+from ChargeAPI.benchmarks.dispatch import load_molecules, compare, _n_atoms, _reset_peak_rss, _peak_rss_mb
+import subprocess
+import copy
+import sys
+import os
+import pytest
+
+
+class TestBenchmarks:
+
+    def test_molecules_ordered_by_size(self):
+        molecules = load_molecules()
+        sizes = [_n_atoms(molblock) for molblock in molecules.values()]
+
+        assert list(molecules)[0] == 'water'
+        assert sizes == sorted(sizes)
+        assert 'saq-moved.pdb' in molecules
+
+    def test_compare_flags_regressions(self):
+        result = {'kind': 'charge', 'model': 'MBIS', 'case': 'batch/8', 'latency_p50_s': 1.0, 'molecules_per_s': 8.0}
+        baseline = {'results': [result]}
+        suite = copy.deepcopy(baseline)
+        suite['results'][0].update(latency_p50_s=1.05, molecules_per_s=6.0)
+
+        regressions = compare(suite, baseline, tolerance=0.1)
+        assert [regression['metric'] for regression in regressions] == ['molecules_per_s']
+
+    def test_compare_skips_unmeasured_rss(self):
+        baseline = {'results': [{'kind': 'charge', 'model': 'MBIS', 'case': 'batch/8', 'peak_rss_mb': 100.0}]}
+        suite = copy.deepcopy(baseline)
+        suite['results'][0]['peak_rss_mb'] = None
+
+        assert compare(suite, baseline) == []
+
+    @pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='reads /proc')
+    def test_peak_rss_of_worker(self):
+        #a worker which grows to about 200 MB and then frees it
+        worker = subprocess.Popen(
+            [sys.executable, '-c', 'import sys; x = bytearray(200 * 1024**2); del x; print(1, flush=True); sys.stdin.read()'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        try:
+            worker.stdout.readline()
+            assert _peak_rss_mb([worker.pid]) > 150
+            _reset_peak_rss([worker.pid])
+            assert _peak_rss_mb([worker.pid]) < 150
+        finally:
+            worker.stdin.close()
+            worker.wait()
@@ -0,0 +1,104 @@
+from ChargeAPI.charge_models.base_class import ExternalChargeModel
+from ChargeAPI.charge_models.nagl_batching import NaglBatchedModel
+from rdkit import Chem
+import numpy as np
+
+
+class ChunkedModel(ExternalChargeModel):
+    """Charges are the atomic numbers, assigned a chunk at a time"""
+    _name = 'chunked_test_model'
+    chunk_size = 2
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def convert_to_charge_format(self, conformer_mol: str):
+        return Chem.MolFromMolBlock(conformer_mol, removeHs=False)
+
+    def assign_charges(self, rdkit_conformer):
+        self.calls.append(1)
+        return [atom.GetAtomicNum() for atom in rdkit_conformer.GetAtoms()]
+
+    def assign_charges_chunk(self, rdkit_conformers):
+        self.calls.append(len(rdkit_conformers))
+        return [[atom.GetAtomicNum() for atom in mol.GetAtoms()] for mol in rdkit_conformers]
+
+
+class NaglOutputs:
+    """compute_properties of a Nagl model, with or without a dipole readout"""
+
+    def __init__(self, dipoles: bool):
+        self.dipoles = dipoles
+
+    def compute_properties(self, rdkit_conformer):
+        n_atoms = rdkit_conformer.GetNumAtoms()
+        properties = {'mbis-charges': np.full((n_atoms, 1), 0.1)}
+        if self.dipoles:
+            properties['mbis-dipoles'] = np.arange(3 * n_atoms, dtype=float)
+        return properties
+
+
+class NaglModel(NaglBatchedModel, ExternalChargeModel):
+    _name = 'nagl_test_model'
+
+    def __init__(self, dipoles: bool):
+        super().__init__()
+        self.charge_model = NaglOutputs(dipoles)
+
+
+class TestChunkedCharges:
+    water = '\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n   -0.7890   -0.1982   -0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n   -0.0061    0.3917   -0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n    0.7951   -0.1936    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n  1  2  1  0\n  2  3  1  0\nM  END\n'
+
+    def test_chunks_keep_input_order(self):
+        model = ChunkedModel()
+        batch = {f'water{i}': self.water for i in range(5)}
+
+        charges, errors = model.assign_charges_batched(batch)
+
+        assert list(charges) == list(batch)
+        assert all(molecule_charges == [1, 8, 1] for molecule_charges in charges.values())
+        assert errors == {}
+        assert model.calls == [2, 2, 1]
+
+    def test_failed_chunk_assigned_one_by_one(self):
+        model = ChunkedModel()
+        batch = {'water0': self.water, 'bad': 'not a molblock', 'water1': self.water}
+
+        charges, errors = model.assign_charges_batched(batch)
+
+        assert list(charges) == ['water0', 'bad', 'water1']
+        assert charges['water1'] == [1, 8, 1]
+        assert charges['bad'] == []
+        assert list(errors) == ['bad']
+        #the first chunk fails on the bad molecule and is retried per molecule, the last runs as a chunk
+        assert model.calls == [2, 1, 1, 1]
+
+    def test_conformers_share_topology_charges(self):
+        model = ChunkedModel()
+        model.conformer_independent = True
+        mol = Chem.AddHs(Chem.MolFromSmiles('FC(Cl)(Br)I'))
+        renumbered = Chem.RenumberAtoms(mol, [4, 2, 0, 3, 1])
+        batch = {
+            'first': Chem.MolToMolBlock(mol),
+            'renumbered': Chem.MolToMolBlock(renumbered),
+            'water': self.water,
+        }
+
+        charges, errors = model.assign_charges_batched(batch)
+
+        #only the first of the two conformers is run through the model
+        assert model.calls == [2]
+        assert list(charges) == list(batch)
+        assert charges['renumbered'] == [atom.GetAtomicNum() for atom in renumbered.GetAtoms()]
+        assert charges['first'] == [atom.GetAtomicNum() for atom in mol.GetAtoms()]
+        assert errors == {}
+
+    def test_nagl_properties_with_dipoles(self):
+        water = Chem.MolFromMolBlock(self.water, removeHs=False)
+
+        properties = NaglModel(dipoles=True).assign_properties(water)
+
+        assert properties['charges'] == [0.1, 0.1, 0.1]
+        assert properties['dipoles'] == [[0.0, 1.0, 2.0], [3.0, 4.0, 5.0], [6.0, 7.0, 8.0]]
+        assert 'dipoles' not in NaglModel(dipoles=False).assign_properties(water)
@@ -0,0 +1,66 @@
+from ChargeAPI.API_infrastructure.charge_files import (
+    write_charge_file,
+    read_charge_file,
+    write_grid_file,
+    write_esp_file,
+    read_esp_file,
+)
+import numpy as np
+import pytest
+
+
+class TestChargeFiles:
+    charges = {'water': [-0.8, 0.4, 0.4], 'empty': [], 'methane': [-0.4, 0.1, 0.1, 0.1, 0.1]}
+
+    def check_round_trip(self, file_path):
+        charge_file = read_charge_file(file_path)
+
+        assert list(charge_file) == ['water', 'empty', 'methane']
+        for name, charges in self.charges.items():
+            np.testing.assert_allclose(charge_file[name], charges)
+        np.testing.assert_allclose(charge_file.molecule(2), self.charges['methane'])
+
+    def test_json(self, tmp_path):
+        self.check_round_trip(write_charge_file(self.charges, str(tmp_path / 'batch_charges.json'), 'json'))
+
+    def test_npz_is_memory_mapped(self, tmp_path):
+        file_path = write_charge_file(self.charges, str(tmp_path / 'batch_charges.npz'), 'npz')
+        self.check_round_trip(file_path)
+
+        assert isinstance(read_charge_file(file_path).charges, np.memmap)
+
+    @pytest.mark.parametrize('file_type', ['parquet', 'arrow'])
+    def test_arrow_formats(self, tmp_path, file_type):
+        pytest.importorskip('pyarrow')
+        self.check_round_trip(write_charge_file(self.charges, str(tmp_path / f'batch_charges.{file_type}'), file_type))
+
+    def test_unknown_file_type(self, tmp_path):
+        with pytest.raises(ValueError):
+            write_charge_file(self.charges, str(tmp_path / 'batch_charges.csv'), 'csv')
+
+
+class TestESPFiles:
+    grids = {'water': np.arange(12.0).reshape(4, 3), 'empty': np.zeros((0, 3)), 'ion': np.ones((1, 3))}
+
+    def test_grid_file_round_trip(self, tmp_path):
+        grid_file = read_esp_file(write_grid_file(self.grids, str(tmp_path / 'grids.npz')))
+
+        assert list(grid_file) == ['water', 'empty', 'ion']
+        for name, grid in self.grids.items():
+            np.testing.assert_array_equal(grid_file[name]['grid'], grid)
+        assert isinstance(grid_file.arrays['grid'], np.memmap)
+
+    def test_esp_and_multipoles(self, tmp_path):
+        results = {
+            'water': {'esp': np.ones(4), 'grid': self.grids['water'], 'monopoles': np.zeros(3),
+                      'dipoles': np.zeros((3, 3)), 'elements': np.array(['O', 'H', 'H'])},
+            'ion': {'esp': np.ones(1), 'grid': self.grids['ion'], 'monopoles': np.ones(1),
+                    'dipoles': np.zeros((1, 3)), 'elements': np.array(['Na'])},
+        }
+        esp_file = read_esp_file(write_esp_file(results, str(tmp_path / 'batch_esp.npz')))
+
+        ion = esp_file['ion']
+        assert set(ion) == {'esp', 'grid', 'monopoles', 'dipoles', 'elements'}
+        assert ion['dipoles'].shape == (1, 3)
+        assert list(esp_file['water']['elements']) == ['O', 'H', 'H']
+        np.testing.assert_array_equal(esp_file.molecule(0)['grid'], self.grids['water'])
@@ -0,0 +1,87 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('requests')
+
+from werkzeug.serving import make_server
+from ChargeAPI.API_infrastructure.charge_request import api_class, module_version
+from ChargeAPI.API_infrastructure.client import ChargeAPI
+from ChargeAPI.API_infrastructure.results import ChargeResult, MoleculeError
+
+
+class FakeBatches:
+    """Charges of one per line of each molblock, counting the batches and how many run at once"""
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.running = 0
+        self.most_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, charge_model, molecules):
+        with self.lock:
+            self.batch_sizes.append(len(molecules))
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        return {
+            name: ChargeResult(errors=[MoleculeError(name, 'bad molecule')]) if molblock == 'bad'
+            else ChargeResult(charges=np.ones(len(molblock.splitlines())))
+            for name, molblock in molecules.items()
+        }
+
+
+@pytest.fixture
+def server_url():
+    server = make_server('127.0.0.1', 0, api_class.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+
+
+class TestChargeAPIClient:
+
+    def test_chunked_and_bounded(self, server_url, monkeypatch):
+        batches = FakeBatches()
+        monkeypatch.setattr(module_version, 'handle_charge_batch', batches)
+        molecules = {f'mol{i}': 'a\n' * (i % 3 + 1) for i in range(50)}
+
+        with ChargeAPI(server_url, batch_size=8, max_in_flight=2, dtype=np.float32) as client:
+            results = client.charges('EEM', molecules)
+
+        assert list(results) == list(molecules)
+        assert sorted(batches.batch_sizes) == [2] + [8] * 6
+        assert batches.most_running <= 2
+        assert results['mol4'].charges.dtype == np.float32
+        np.testing.assert_array_equal(results['mol4'].charges, [1, 1])
+
+    def test_failed_molecules(self, server_url, monkeypatch):
+        monkeypatch.setattr(module_version, 'handle_charge_batch', FakeBatches())
+
+        with ChargeAPI(server_url) as client:
+            results = client.charges('EEM', ['a', 'bad'])
+
+        assert results['0'].ok
+        assert not results['1'].ok
+        assert results['1'].errors[0].message == 'bad molecule'
+
+    def test_failed_batch(self, server_url, monkeypatch):
+        def handle_charge_batch(charge_model, molecules):
+            raise RuntimeError('worker died')
+        monkeypatch.setattr(module_version, 'handle_charge_batch', handle_charge_batch)
+
+        with ChargeAPI(server_url) as client:
+            result = client.charge('EEM', 'a')
+
+        assert not result.ok
+        assert '500' in result.errors[0].message
+
+    def test_unknown_model(self, server_url):
+        with ChargeAPI(server_url) as client:
+            with pytest.raises(NameError):
+                client.charges('NOT_A_MODEL', ['a'])
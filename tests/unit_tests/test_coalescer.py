@@ -0,0 +1,51 @@
+from ChargeAPI.API_infrastructure.coalescer import RequestCoalescer
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+
+
+class TestRequestCoalescer:
+
+    @pytest.fixture
+    def recorded_batches(self):
+        batches = []
+        lock = threading.Lock()
+
+        def _run_batch(model, molecules):
+            with lock:
+                batches.append((model, dict(molecules)))
+            return {request_id: {'charge_result': f'{model}:{molblock}', 'error': ''} for request_id, molblock in molecules.items()}
+        return batches, _run_batch
+
+    def test_requests_are_batched(self, recorded_batches):
+        batches, run_batch = recorded_batches
+        coalescer = RequestCoalescer(run_batch, window=0.2, max_batch_size=100)
+        with ThreadPoolExecutor(10) as executor:
+            futures = list(executor.map(lambda i: coalescer.submit('MBIS', f'mol{i}'), range(10)))
+        results = [future.result(timeout=5) for future in futures]
+        coalescer.close()
+
+        assert len(batches) == 1
+        assert results == [{'charge_result': f'MBIS:mol{i}', 'error': ''} for i in range(10)]
+
+    def test_max_batch_size_and_models(self, recorded_batches):
+        batches, run_batch = recorded_batches
+        coalescer = RequestCoalescer(run_batch, window=0.2, max_batch_size=3)
+        futures = [coalescer.submit('MBIS', f'mol{i}') for i in range(7)] + [coalescer.submit('EEM', 'water')]
+        results = [future.result(timeout=5) for future in futures]
+        coalescer.close()
+
+        assert sorted(len(molecules) for model, molecules in batches if model == 'MBIS') == [1, 3, 3]
+        assert [molecules for model, molecules in batches if model == 'EEM'] == [{'0': 'water'}]
+        assert results[-1] == {'charge_result': 'EEM:water', 'error': ''}
+
+    def test_batch_failure_is_raised_to_every_caller(self):
+        def _run_batch(model, molecules):
+            raise KeyError(model)
+
+        coalescer = RequestCoalescer(_run_batch, window=0.01)
+        futures = [coalescer.submit('INVALID MODEL', 'mol') for _ in range(3)]
+        for future in futures:
+            with pytest.raises(KeyError):
+                future.result(timeout=5)
+        coalescer.close()
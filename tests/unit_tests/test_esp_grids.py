@@ -0,0 +1,91 @@
+from ChargeAPI.API_infrastructure.esp_grids import (
+    GridCache,
+    connolly_sphere,
+    grid_settings_from_environment,
+    lattice_grid,
+    msk_grid,
+    vdw_radii,
+)
+from rdkit import Chem
+import numpy as np
+import pytest
+import os
+
+
+class TestGrids:
+    water = '\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n   -0.7890   -0.1982   -0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n   -0.0061    0.3917   -0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n    0.7951   -0.1936    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n  1  2  1  0\n  2  3  1  0\nM  END\n'
+    coordinates = np.array([[-0.7890, -0.1982, 0.0], [-0.0061, 0.3917, 0.0], [0.7951, -0.1936, 0.0]])
+    elements = ['H', 'O', 'H']
+
+    def distances(self, grid):
+        return np.linalg.norm(grid[:, None, :] - self.coordinates[None, :, :], axis=-1)
+
+    def test_connolly_sphere(self):
+        sphere = connolly_sphere(2.0, 1.0)
+
+        assert np.allclose(np.linalg.norm(sphere, axis=1), 2.0)
+        #about density points per angstrom**2, the latitudes are rounded down
+        assert 0.8 * 4 * np.pi * 2.0**2 < len(sphere) <= 4 * np.pi * 2.0**2
+
+    def test_msk_points_outside_inner_shell(self):
+        grid = msk_grid(self.coordinates, self.elements, density=1.0)
+        radii = vdw_radii(self.elements)
+
+        assert len(grid) > 0
+        assert np.all(self.distances(grid) >= 1.4 * radii[None, :] - 1e-9)
+        assert np.all(self.distances(grid).min(axis=1) <= 2.0 * radii.max() + 1e-9)
+
+    def test_lattice_between_shells(self):
+        grid = lattice_grid(self.coordinates, self.elements, spacing=0.5)
+        radii = vdw_radii(self.elements)
+        distances = self.distances(grid)
+
+        assert np.all(distances >= 1.4 * radii[None, :])
+        assert np.all(np.any(distances < 2.0 * radii[None, :], axis=1))
+
+    def test_unknown_element(self):
+        with pytest.raises(ValueError):
+            msk_grid(self.coordinates, ['H', 'Xx', 'H'])
+
+    def test_cache_by_conformer_and_settings(self):
+        cache = GridCache(max_entries=2)
+        grid = cache.grid(self.coordinates, self.elements, density=1.0)
+
+        assert cache.grid(self.coordinates + 1e-6, self.elements, density=1.0) is grid
+        assert cache.grid(self.coordinates, self.elements, density=2.0) is not grid
+        assert cache.grid(self.coordinates + 1.0, self.elements, density=1.0) is not grid
+        assert (cache.hits, cache.misses) == (1, 3)
+        assert not grid.flags.writeable
+
+    def test_settings_from_environment(self):
+        assert grid_settings_from_environment({}) == {'grid_type': 'msk', 'density': 1.0}
+        assert grid_settings_from_environment({'CHARGEAPI_GRID_DENSITY': '2'}) == {'grid_type': 'msk', 'density': 2.0}
+        assert grid_settings_from_environment({'CHARGEAPI_GRID_TYPE': 'lattice'}) == {'grid_type': 'lattice', 'spacing': 0.5}
+        with pytest.raises(ValueError):
+            grid_settings_from_environment({'CHARGEAPI_GRID_TYPE': 'cube'})
+
+
+class TestOpenFFGrids:
+    """The MSK grids match the grids openff-recharge builds, as RIN_model.build_openff_grid does"""
+
+    @pytest.mark.parametrize('density', [1.0, 2.0])
+    def test_msk_matches_openff_recharge(self, density):
+        grids = pytest.importorskip('openff.recharge.grids')
+        from openff.toolkit import Molecule
+        from openff.units import unit
+
+        data = f'{os.path.dirname(__file__)}/../data/batched_compounds.sdf'
+        molecules = [Chem.MolFromMolBlock(TestGrids.water, removeHs=False)]
+        molecules += [mol for mol in Chem.SDMolSupplier(data, removeHs=False) if mol is not None][:2]
+        for rdkit_mol in molecules:
+            openff_mol = Molecule.from_rdkit(rdkit_mol, allow_undefined_stereo=True)
+            settings = grids.MSKGridSettings(type='msk', density=density)
+            expected = grids.GridGenerator.generate(openff_mol, openff_mol.conformers[0], settings).m_as(unit.angstrom)
+
+            grid = msk_grid(
+                rdkit_mol.GetConformer().GetPositions(), [atom.GetSymbol() for atom in rdkit_mol.GetAtoms()], density
+            )
+
+            assert abs(len(grid) - len(expected)) <= 0.02 * len(expected)
+            np.testing.assert_allclose(grid.min(axis=0), expected.min(axis=0), atol=0.1)
+            np.testing.assert_allclose(grid.max(axis=0), expected.max(axis=0), atol=0.1)
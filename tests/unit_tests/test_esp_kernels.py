@@ -0,0 +1,70 @@
+from ChargeAPI.API_infrastructure.esp_kernels import multipole_esp, treecode_esp, BOHR_PER_ANGSTROM
+import numpy as np
+
+
+def reference_esp(grid, coordinates, monopoles, dipoles, quadrupoles):
+    """The multipole ESP over the full grid x atoms arrays, in atomic units, as RIN_model once evaluated it with pint"""
+    displacement = (grid[:, None, :] - coordinates[None, :, :]) * BOHR_PER_ANGSTROM
+    distance = np.linalg.norm(displacement, axis=-1)
+    dipoles = dipoles * BOHR_PER_ANGSTROM
+    quadrupoles = quadrupoles * BOHR_PER_ANGSTROM**2
+
+    monopole_esp = np.sum(monopoles[None, :] / distance, axis=1)
+    dipole_esp = np.sum(np.sum(displacement * dipoles[None, :, :], axis=-1) / distance**3, axis=1)
+    quadrupole_dot = np.sum(np.sum(quadrupoles[None, :, :] * displacement[:, :, None], axis=-1) * displacement, axis=-1)
+    quadrupole_esp = np.sum(3 * quadrupole_dot * (1 / 2 / distance**5), axis=-1)
+    return monopole_esp + dipole_esp + quadrupole_esp
+
+
+class TestMultipoleESP:
+    rng = np.random.default_rng(0)
+    coordinates = rng.normal(size=(12, 3)) * 2
+    grid = rng.normal(size=(500, 3)) * 6
+    monopoles = rng.normal(size=12)
+    dipoles = rng.normal(size=(12, 3)) * 0.2
+    quadrupoles = rng.normal(size=(12, 3, 3)) * 0.1
+
+    def test_point_charge(self):
+        #a unit charge 1 angstrom away, in hartree/e
+        esp = multipole_esp(np.array([[1.0, 0.0, 0.0]]), np.zeros((1, 3)), np.ones(1))
+        assert np.isclose(esp[0], 0.529177210903)
+
+    def test_matches_reference(self):
+        esp = multipole_esp(self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles)
+        reference = reference_esp(self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles)
+        assert np.allclose(esp, reference, rtol=1e-10, atol=1e-12)
+
+    def test_blocks_and_threads(self):
+        esp = multipole_esp(self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles)
+        blocked = multipole_esp(
+            self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles, block_size=37, n_threads=4
+        )
+        assert np.allclose(esp, blocked, rtol=1e-12, atol=1e-14)
+
+
+class TestTreecodeESP:
+    rng = np.random.default_rng(1)
+    coordinates = rng.uniform(-10, 10, size=(400, 3))
+    grid = rng.uniform(-14, 14, size=(300, 3))
+    monopoles = rng.normal(size=400) * 0.3
+    dipoles = rng.normal(size=(400, 3)) * 0.1
+    quadrupoles = rng.normal(size=(400, 3, 3)) * 0.05
+
+    def esp(self, **kwargs):
+        return treecode_esp(
+            self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles, leaf_size=8, **kwargs
+        )
+
+    def test_exact_without_far_field(self):
+        exact = multipole_esp(self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles)
+        assert np.allclose(self.esp(theta=0.0), exact, rtol=1e-10, atol=1e-12)
+
+    def test_error_falls_with_theta(self):
+        exact = multipole_esp(self.grid, self.coordinates, self.monopoles, self.dipoles, self.quadrupoles)
+        errors = [np.sqrt(np.mean((self.esp(theta=theta) - exact)**2)) for theta in (0.8, 0.5, 0.2)]
+
+        assert errors[0] > errors[1] > errors[2]
+        assert errors[1] < 1e-2 * np.sqrt(np.mean(exact**2))
+
+    def test_threads(self):
+        assert np.allclose(self.esp(theta=0.5, n_threads=3), self.esp(theta=0.5), rtol=1e-12, atol=1e-14)
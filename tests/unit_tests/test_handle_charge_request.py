@@ -1,6 +1,13 @@
-from ChargeAPI.API_infrastructure.module_version import handle_charge_request
+from ChargeAPI.API_infrastructure.charge_request.module_version import handle_charge_request, handle_charge_request_async
+from ChargeAPI.API_infrastructure.charge_request import module_version
+from ChargeAPI.API_infrastructure.protocol import encode_message
+from ChargeAPI.API_infrastructure import worker_pool
 import ChargeAPI
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+import subprocess
+import threading
+import asyncio
+import json
 import pytest
 import os
 
@@ -8,15 +15,19 @@ import os
 class TestHandleChargeRequest:
     mol  = '\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n   -0.7890   -0.1982   -0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n   -0.0061    0.3917   -0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n    0.7951   -0.1936    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n  1  2  1  0\n  2  3  1  0\nM  END\n'
 
+    @staticmethod
+    def worker_stdout(charges):
+        """stdout of a worker which loaded its model and answered one request"""
+        return encode_message({'ready': True, 'error': ''}) + encode_message({'id': 0, 'result': charges, 'error': ''})
+
     #this replaces the subprocess call
-    @patch('ChargeAPI.API_infrastructure.module_version.subprocess.run')
+    @patch('ChargeAPI.API_infrastructure.charge_request.module_version.subprocess.run')
     def test_handle_charge_request_with_EEM(self, mock_run):
 
         mock_stdout = MagicMock()
         
-        '[0.41073812213382016, -0.8164372902205344, 0.4056991680867142]'
         mock_stdout.configure_mock(
-            **{"stdout":b"[0.41073812213382016, -0.8164372902205344, 0.4056991680867142]",
+            **{"stdout":self.worker_stdout([0.41073812213382016, -0.8164372902205344, 0.4056991680867142]),
                "stderr":b""
             }
         )
@@ -30,13 +41,13 @@ class TestHandleChargeRequest:
         assert charge_request == expected_response
 
     #this replaces the subprocess call
-    @patch('ChargeAPI.API_infrastructure.module_version.subprocess.run')
+    @patch('ChargeAPI.API_infrastructure.charge_request.module_version.subprocess.run')
     def test_handle_charge_request_with_MBIS(self, mock_run):
 
         mock_stdout = MagicMock()
 
         mock_stdout.configure_mock(
-            **{"stdout":b"[0.4071686863899231, -0.8143373727798462, 0.4071686863899231]\n\n",
+            **{"stdout":self.worker_stdout([0.4071686863899231, -0.8143373727798462, 0.4071686863899231]),
                "stderr":b""
             }
         )
@@ -49,13 +60,13 @@ class TestHandleChargeRequest:
         assert charge_request == expected_response
     
     #this replaces the subprocess call
-    @patch('ChargeAPI.API_infrastructure.module_version.subprocess.run')
+    @patch('ChargeAPI.API_infrastructure.charge_request.module_version.subprocess.run')
     def test_handle_charge_request_with_MBIS_CHARGE(self, mock_run):
 
         mock_stdout = MagicMock()
 
         mock_stdout.configure_mock(
-            **{"stdout":b"[0.4147946834564209, -0.8295893669128418, 0.4147946834564209]\n\n",
+            **{"stdout":self.worker_stdout([0.4147946834564209, -0.8295893669128418, 0.4147946834564209]),
                "stderr":b""
             }
         )
@@ -67,9 +78,149 @@ class TestHandleChargeRequest:
         
         assert charge_request == expected_response
 
+    #this replaces the asyncio subprocess call
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.run_worker_request', new_callable=AsyncMock)
+    def test_handle_charge_request_async(self, mock_run):
+
+        charges = [0.4071686863899231, -0.8143373727798462, 0.4071686863899231]
+        mock_run.return_value = subprocess.CompletedProcess([], 0, self.worker_stdout(charges), b"")
+
+        async def _requests():
+            return await asyncio.gather(
+                *[handle_charge_request_async(charge_model = 'MBIS', conformer_mol = self.mol) for _ in range(3)]
+            )
+
+        expected_response = {'charge_result':'[0.4071686863899231, -0.8143373727798462, 0.4071686863899231]','error':''}
+        assert asyncio.run(_requests()) == [expected_response] * 3
+        env, _, payload = mock_run.call_args.args
+        assert env == 'naglmbis'
+        assert payload['conformer'] == self.mol
+
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.run_worker_request', new_callable=AsyncMock)
+    def test_handle_charge_request_async_pool(self, mock_run, monkeypatch):
+        pool = MagicMock()
+        def _request(model_key, env, script_path, payload):
+            charges = [0.5, -1.0, 0.5]
+            result = {'charges': charges} if payload.get('typed') else charges
+            return {'result': result, 'error': '', 'timings': {'predict': 0.1}}
+
+        pool.request.side_effect = _request
+        monkeypatch.setattr(module_version._DISPATCHER, 'pool', pool)
+        module_version.enable_cache()
+        timings = module_version.enable_timing()
+        try:
+            async def _requests():
+                first = await handle_charge_request_async(charge_model = 'MBIS', conformer_mol = self.mol)
+                second = await handle_charge_request_async(charge_model = 'MBIS', conformer_mol = self.mol)
+                typed = await handle_charge_request_async(charge_model = 'MBIS', conformer_mol = self.mol, typed = True)
+                return first, second, typed
+
+            first, second, typed = asyncio.run(_requests())
+            summary = timings.summary()
+        finally:
+            module_version.disable_cache()
+            module_version.disable_timing()
+
+        #the second request is answered from the cache, the typed one is not cached
+        assert first == second == {'charge_result': '[0.5, -1.0, 0.5]', 'error': ''}
+        assert list(typed.charges) == [0.5, -1.0, 0.5]
+        assert pool.request.call_count == 2
+        assert pool.request.call_args.args[3]['timing']
+        assert summary['MBIS']['predict']['count'] == 2
+        mock_run.assert_not_called()
+
+    def test_sharded_batched_request(self, tmp_path):
+        molecules = {f'mol_{i}': self.mol for i in range(10)}
+        batch_file = tmp_path / 'session.json'
+        batch_file.write_text(json.dumps(molecules))
+
+        def _fake_shard(charge_model, payload):
+            #each molecule gets a charge from its index so the merged order can be checked
+            shard = payload['molecules']
+            return {'result': {'charges': {name: [float(name.split('_')[1])] for name in shard}, 'errors': {}}, 'error': ''}
+
+        with patch.object(module_version._DISPATCHER, 'run_worker', side_effect=_fake_shard) as mock_worker:
+            charge_request = handle_charge_request(
+                charge_model = 'MBIS',
+                conformer_mol = str(batch_file),
+                batched = True,
+                n_workers = 3
+            )
+
+        assert mock_worker.call_count == 3
+        assert charge_request['error'] == ''
+        assert charge_request['charge_result'] == str(tmp_path / 'session_charges.json')
+        with open(charge_request['charge_result']) as infile:
+            charges = json.load(infile)
+        assert list(charges) == list(molecules)
+        assert list(charges.values()) == [[float(i)] for i in range(10)]
+
+    def test_sharded_batch_extends_pool(self, tmp_path, monkeypatch):
+        batch_file = tmp_path / 'molecules.json'
+        batch_file.write_text(json.dumps({f'mol_{i}': self.mol for i in range(6)}))
+        all_started = threading.Barrier(3, timeout=5)
+
+        class ShardWorker:
+            def __init__(self, env, script_path):
+                self.alive = True
+            def is_alive(self):
+                return self.alive
+            def request(self, payload):
+                #only returns once every shard is running at once
+                all_started.wait()
+                return {'result': {'charges': {name: [0.0] for name in payload['molecules']}, 'errors': {}}, 'error': ''}
+            def close(self):
+                self.alive = False
+
+        monkeypatch.setattr(worker_pool, 'ModelWorker', ShardWorker)
+        monkeypatch.setattr(module_version._DISPATCHER, 'pool', worker_pool.WorkerPool(workers_per_model=1))
+        try:
+            charge_request = handle_charge_request(
+                charge_model = 'MBIS',
+                conformer_mol = str(batch_file),
+                batched = True,
+                n_workers = 3
+            )
+            assert module_version._DISPATCHER.pool.stats() == {'MBIS': {'started': 1, 'idle': 1}}
+        finally:
+            module_version._DISPATCHER.pool.close()
+
+        assert os.path.exists(charge_request['charge_result'])
+
+    def test_batched_protein(self):
+        with pytest.raises(ValueError):
+            handle_charge_request(charge_model = 'MBIS', conformer_mol = 'batch.json', batched = True, protein = True)
+
     def test_incorrect_flag(self):
         charge_model = 'INVALID MODEL'  #incorrect flag
         conformer_mol = self.mol
         with pytest.raises(NameError):
             handle_charge_request(charge_model = charge_model, conformer_mol = conformer_mol, batched = False)
-            
+
+    def test_key_error_not_renamed(self):
+        #only an unknown model is a NameError, a KeyError from running the request is left as it is
+        with patch.object(module_version._DISPATCHER, 'run_worker', side_effect=KeyError('charges')):
+            with pytest.raises(KeyError):
+                handle_charge_request(charge_model = 'MBIS', conformer_mol = self.mol)
+
+
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.stream_request')
+    def test_streamed_batch(self, mock_stream):
+        responses = [
+            {'id': 0, 'molecule': 'water', 'result': {'charges': [-0.8, 0.4, 0.4]}, 'error': ''},
+            {'id': 0, 'molecule': 'broken', 'result': None, 'error': 'Traceback\n'},
+            {'id': 0, 'done': True, 'error': ''},
+        ]
+        mock_stream.return_value = (response for response in responses)
+        results = dict(handle_charge_request(charge_model = 'MBIS', conformer_mol = 'batch.json', batched = True, stream = True))
+
+        assert mock_stream.call_args.args[2] == {'conformer': 'batch.json'}
+        assert results['water'].charges.tolist() == [-0.8, 0.4, 0.4]
+        assert results['broken'].errors[0].molecule == 'broken'
+
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.stream_request')
+    def test_streamed_batch_failure(self, mock_stream):
+        mock_stream.return_value = (response for response in [{'id': 0, 'done': True, 'error': 'FileNotFoundError\n'}])
+
+        with pytest.raises(RuntimeError):
+            list(handle_charge_request(charge_model = 'MBIS', conformer_mol = 'batch.json', batched = True, stream = True))
@@ -0,0 +1,61 @@
+from unittest.mock import patch
+import numpy as np
+import pytest
+
+pytest.importorskip('openff.units')
+from ChargeAPI.API_infrastructure.esp_request.module_version_esp import handle_esp_request, handle_esp_batch
+
+
+class TestHandleESPRequest:
+
+    def test_stream_batched_grid(self):
+        with pytest.raises(ValueError):
+            handle_esp_request('RIN', 'batch.json', batched=True, stream=True, batched_grid=True)
+
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.stream_request')
+    def test_stream_grid_file(self, mock_stream, tmp_path):
+        responses = [
+            {'id': 0, 'molecule': 'water', 'result': {'esp_values': [0.1, 0.2], 'grid': [[0, 0, 1], [0, 0, 2]]}, 'error': ''},
+            {'id': 0, 'done': True, 'error': ''},
+        ]
+        mock_stream.return_value = (response for response in responses)
+        grid_file = str(tmp_path / 'grids.npz')
+
+        results = dict(handle_esp_request('RIN', 'batch.json', batched=True, stream=True, grid_file=grid_file))
+
+        _, _, payload = mock_stream.call_args.args
+        assert payload['batch_grid_file'] == grid_file
+        np.testing.assert_allclose(results['water'].esp, [0.1, 0.2])
+
+    @patch('ChargeAPI.API_infrastructure.esp_request.module_version_esp._DISPATCHER.run_worker')
+    def test_batch_runs_on_the_worker(self, mock_run):
+        mock_run.return_value = {'result': {
+            'water': {'esp_values': [[0.1, -0.1], [0.0] * 6, [0.0] * 18], 'coordinates': [[0, 0, 0], [0, 0, 1]], 'elements': ['O', 'H']},
+        }, 'error': ''}
+
+        results = handle_esp_batch('RIN', {'water': 'molblock'}, theta=0.5, multipoles_only=True)
+
+        _, payload = mock_run.call_args.args
+        assert payload == {'molecules': {'water': ['molblock', None]}, 'broken_up': True, 'theta': 0.5, 'multipoles_only': True}
+        np.testing.assert_allclose(results['water'].monopoles, [0.1, -0.1])
+        assert results['water'].elements == ['O', 'H']
+
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.stream_request')
+    @patch('ChargeAPI.API_infrastructure.esp_request.module_version_esp._DISPATCHER.run_worker')
+    def test_failed_batch_run_per_molecule(self, mock_run, mock_stream):
+        mock_run.return_value = {'result': None, 'error': 'Traceback\n'}
+        responses = [
+            {'id': 0, 'molecule': 'water', 'result': {'esp_values': [0.1], 'grid': [[0, 0, 1]]}, 'error': ''},
+            {'id': 0, 'molecule': 'bad', 'result': None, 'error': 'bad molblock'},
+            {'id': 0, 'done': True, 'error': ''},
+        ]
+        mock_stream.return_value = (response for response in responses)
+
+        results = handle_esp_batch('RIN', {'water': 'molblock', 'bad': 'not a molblock'})
+
+        assert results['water'].ok
+        assert results['bad'].errors[0].message == 'bad molblock'
+
+    def test_incorrect_flag(self):
+        with pytest.raises(NameError):
+            handle_esp_request('INVALID MODEL', 'mol')
@@ -0,0 +1,50 @@
+from ChargeAPI.API_infrastructure.instrumentation import LatencyHistogram, TimingRecorder
+from ChargeAPI.API_infrastructure.charge_request import module_version
+from ChargeAPI.API_infrastructure.protocol import encode_message
+from unittest.mock import patch, MagicMock
+import json
+import pytest
+
+
+class TestInstrumentation:
+
+    def test_histogram_percentiles(self):
+        histogram = LatencyHistogram()
+        for i in range(1, 101):
+            histogram.record(i / 1000)
+
+        summary = histogram.summary()
+        assert summary['count'] == 100
+        assert summary['mean'] == pytest.approx(0.0505)
+        assert summary['p50'] == pytest.approx(0.050, rel=0.13)
+        assert summary['p99'] == pytest.approx(0.099, rel=0.13)
+        assert summary['max'] == 0.1
+
+    def test_process_overhead(self):
+        recorder = TimingRecorder()
+        recorder.record_response('MBIS', {'import': 1.0, 'load_model': 0.5, 'request': 0.2, 'assign_charges': 0.1}, total=2.0)
+        recorder.record_response('MBIS', None, total=2.0)
+
+        summary = recorder.summary()['MBIS']
+        assert summary['total']['count'] == 1
+        assert summary['process_overhead']['mean'] == pytest.approx(0.3)
+
+    @patch('ChargeAPI.API_infrastructure.charge_request.module_version.subprocess.run')
+    def test_timed_request(self, mock_run, tmp_path):
+        mock_run.return_value = MagicMock(
+            stdout=encode_message({'ready': True, 'error': '', 'timings': {'import': 2.0, 'load_model': 1.0}})
+            + encode_message({'id': 0, 'result': [0.4, -0.8, 0.4], 'error': '', 'timings': {'request': 0.1, 'serialize': 0.01}}),
+            stderr=b'',
+        )
+        module_version.enable_timing()
+        try:
+            charge_request = module_version.handle_charge_request(charge_model = 'MBIS', conformer_mol = 'molblock')
+            module_version.dump_timings(str(tmp_path / 'timings.json'))
+            stages = module_version.timing_summary()['MBIS']
+        finally:
+            module_version.disable_timing()
+
+        assert charge_request == {'charge_result': '[0.4, -0.8, 0.4]', 'error': ''}
+        assert json.loads(mock_run.call_args.kwargs['input'][4:])['timing']
+        assert set(stages) == {'import', 'load_model', 'request', 'serialize', 'total', 'process_overhead'}
+        assert 'buckets' in json.load(open(tmp_path / 'timings.json'))['MBIS']['total']
@@ -0,0 +1,132 @@
+import contextlib
+import json
+import socket
+import threading
+import numpy as np
+import pytest
+
+pytest.importorskip('requests')
+
+from ChargeAPI.API_infrastructure.microservices.model_microservice import ModelServer
+from ChargeAPI.API_infrastructure.microservices.router import MicroserviceRouter
+from ChargeAPI.API_infrastructure.worker_pool import WorkerError
+from ChargeAPI.API_infrastructure.array_files import write_array
+
+
+class CountingModel:
+    """Charges of one per line of the molblock"""
+
+    def __call__(self, conformer_mol, batched):
+        return [1.0] * len(conformer_mol.splitlines())
+
+    def timed(self, stage):
+        return contextlib.nullcontext()
+
+    def convert_to_charge_format(self, conformer_mol):
+        return conformer_mol.splitlines()
+
+    def assign_properties(self, lines):
+        return {'charges': [1.0] * len(lines)}
+
+
+@pytest.fixture
+def microservices():
+    servers = [ModelServer(('127.0.0.1', 0), {'COUNT': CountingModel()}) for _ in range(2)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield [f'http://127.0.0.1:{server.server_address[1]}' for server in servers]
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def closed_port_url():
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{unused.getsockname()[1]}'
+
+
+class TestMicroserviceRouter:
+
+    def test_request(self, microservices):
+        router = MicroserviceRouter(microservices)
+        try:
+            response = router.request('COUNT', 'env', 'script.py', {'conformer': 'a\nb\nc'})
+        finally:
+            router.close()
+
+        assert response['result'] == [1.0, 1.0, 1.0]
+        assert response['error'] == ''
+
+    def test_stream(self, microservices):
+        router = MicroserviceRouter(microservices)
+        try:
+            responses = list(router.stream('COUNT', 'env', 'script.py', {'molecules': {'x': 'a', 'y': 'a\nb'}}))
+        finally:
+            router.close()
+
+        assert [(response['molecule'], response['result']) for response in responses[:-1]] == [
+            ('x', {'charges': [1.0]}),
+            ('y', {'charges': [1.0, 1.0]}),
+        ]
+        assert responses[-1]['done']
+
+    def test_least_loaded(self, microservices):
+        router = MicroserviceRouter(microservices)
+        try:
+            busy = router._acquire('COUNT', set())
+            assert router._acquire('COUNT', set()) is not busy
+        finally:
+            router.close()
+
+    def test_down_microservice_skipped(self, microservices):
+        router = MicroserviceRouter([closed_port_url(), microservices[0]], startup_timeout=0)
+        try:
+            assert router.stats() == {'COUNT': {'started': 1, 'idle': 1}}
+            #marked healthy again, the request moves on once it cannot connect
+            router.services[0].healthy = True
+            router.services[0].models = {'COUNT'}
+            for _ in range(3):
+                assert router.request('COUNT', 'env', 'script.py', {'conformer': 'a'})['result'] == [1.0]
+            assert not router.services[0].healthy
+        finally:
+            router.close()
+
+    def test_model_not_served(self, microservices):
+        router = MicroserviceRouter(microservices)
+        try:
+            with pytest.raises(WorkerError):
+                router.request('OTHER', 'env', 'script.py', {'conformer': 'a'})
+        finally:
+            router.close()
+
+    def test_waits_for_microservice_to_load(self):
+        url = closed_port_url()
+        server = ModelServer(('127.0.0.1', int(url.rsplit(':', 1)[1])), {'COUNT': CountingModel()})
+        #serves a moment after the router is created, as a microservice does once its models are loaded
+        threading.Timer(0.5, server.serve_forever).start()
+        try:
+            router = MicroserviceRouter([url], startup_timeout=10)
+            try:
+                assert router.request('COUNT', 'env', 'script.py', {'conformer': 'a'})['result'] == [1.0]
+            finally:
+                router.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_files_sent_in_requests(self, microservices, tmp_path):
+        batch_file = tmp_path / 'batch.json'
+        batch_file.write_text(json.dumps({'x': 'a\nb'}))
+        grid_file = write_array(np.ones((2, 3)), str(tmp_path))
+        router = MicroserviceRouter(microservices)
+        try:
+            portable = router._portable({'conformer': 'a', 'grid_file': grid_file})
+            responses = list(router.stream('COUNT', 'env', 'script.py', {'conformer': str(batch_file)}))
+            with pytest.raises(ValueError):
+                router.request('COUNT', 'env', 'script.py', {'conformer': str(batch_file), 'batched': True})
+        finally:
+            router.close()
+
+        assert portable == {'conformer': 'a', 'grid': [[1.0] * 3] * 2}
+        assert responses[0]['result'] == {'charges': [1.0, 1.0]}
@@ -0,0 +1,44 @@
+from ChargeAPI.API_infrastructure.model_dispatch import ModelDispatcher, decode_worker_output
+from ChargeAPI.API_infrastructure.protocol import encode_message
+from unittest.mock import patch, MagicMock
+import subprocess
+import pytest
+
+
+@pytest.fixture
+def dispatcher():
+    return ModelDispatcher({'EEM': ['openbabel', '/charge_models/eem_model.py']}, 'charge model')
+
+
+class TestModelDispatcher:
+
+    def test_unknown_model(self, dispatcher):
+        with pytest.raises(NameError, match='charge model does not exist'):
+            dispatcher.model_paths('OTHER')
+
+    @patch('ChargeAPI.API_infrastructure.model_dispatch.subprocess.run')
+    def test_one_off_worker(self, mock_run, dispatcher):
+        stdout = encode_message({'ready': True, 'error': '', 'timings': {'import': 0.5}}) + encode_message(
+            {'id': 0, 'result': [0.1], 'error': '', 'timings': {'assign_charges': 0.1}}
+        )
+        mock_run.return_value = subprocess.CompletedProcess([], 0, stdout, b'warning\n')
+        timings = dispatcher.enable_timing()
+
+        response = dispatcher.run_worker('EEM', {'conformer': 'mol'})
+
+        assert response == {'error': 'warning\n', 'result': [0.1], 'timings': {'import': 0.5, 'assign_charges': 0.1}}
+        assert set(timings.summary()['EEM']) >= {'import', 'assign_charges'}
+
+    def test_pool_worker(self, dispatcher):
+        dispatcher.pool = MagicMock()
+        dispatcher.pool.request.return_value = {'result': [0.1], 'error': ''}
+
+        assert dispatcher.run_worker('EEM', {'conformer': 'mol'}) == {'result': [0.1], 'error': ''}
+        model_key, env, script_path, payload = dispatcher.pool.request.call_args.args
+        assert (model_key, env, payload) == ('EEM', 'openbabel', {'conformer': 'mol'})
+        assert script_path.endswith('/charge_models/eem_model.py')
+
+    def test_worker_failed_to_start(self):
+        response = decode_worker_output(subprocess.CompletedProcess([], 1, encode_message({'ready': False, 'error': 'no model\n'}), b''))
+
+        assert response == {'error': 'no model\n'}
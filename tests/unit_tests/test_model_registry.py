@@ -0,0 +1,67 @@
+from ChargeAPI.API_infrastructure import environments
+from ChargeAPI.API_infrastructure.model_registry import ModelRegistry
+from unittest.mock import patch, MagicMock
+import ChargeAPI.charge_models
+import pytest
+
+CONDA_ENVS = b'# conda environments:\n#\nbase                  /opt/conda\nnaglmbis              /opt/conda/envs/naglmbis\n'
+
+
+@pytest.fixture
+def env_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv(environments.ENV_CACHE_VARIABLE, str(tmp_path / 'conda_envs.json'))
+    monkeypatch.setattr(environments, '_environments', None)
+    monkeypatch.setattr(environments, '_env_directories', lambda: [str(tmp_path / 'envs')])
+    return tmp_path
+
+
+class TestCondaEnvironments:
+
+    @patch('ChargeAPI.API_infrastructure.environments.subprocess.run')
+    def test_listed_once_per_process(self, mock_run, env_cache):
+        mock_run.return_value = MagicMock(stdout=CONDA_ENVS)
+
+        assert environments.conda_environments() == ['base', 'naglmbis']
+        assert environments.is_env_available('naglmbis')
+        assert not environments.is_env_available('openbabel')
+        mock_run.assert_called_once()
+
+    @patch('ChargeAPI.API_infrastructure.environments.subprocess.run')
+    def test_disk_cache_shared_between_processes(self, mock_run, env_cache, monkeypatch):
+        mock_run.return_value = MagicMock(stdout=CONDA_ENVS)
+        environments.conda_environments()
+        #a new process starts without the listing in memory
+        monkeypatch.setattr(environments, '_environments', None)
+
+        assert environments.conda_environments() == ['base', 'naglmbis']
+        mock_run.assert_called_once()
+
+    @patch('ChargeAPI.API_infrastructure.environments.subprocess.run')
+    def test_disk_cache_invalidated(self, mock_run, env_cache, monkeypatch):
+        mock_run.return_value = MagicMock(stdout=CONDA_ENVS)
+        environments.conda_environments()
+
+        #creating an environment changes the environment directory
+        (env_cache / 'envs').mkdir()
+        monkeypatch.setattr(environments, '_environments', None)
+        environments.conda_environments()
+        assert mock_run.call_count == 2
+
+        #and an old listing is not trusted
+        monkeypatch.setattr(environments, '_environments', None)
+        environments.conda_environments(ttl=-1)
+        assert mock_run.call_count == 3
+
+
+class TestModelRegistry:
+
+    @patch('ChargeAPI.API_infrastructure.model_registry.conda_environments')
+    def test_populated_on_first_query(self, mock_environments):
+        mock_environments.return_value = ['base', 'naglmbis']
+        registry = ModelRegistry(ChargeAPI.charge_models.__name__, ChargeAPI.charge_models.__path__)
+        mock_environments.assert_not_called()
+
+        assert registry == {'MBIS_Model': 'naglmbis', 'MBIS_Model_charge': 'naglmbis'}
+        assert 'EEM_model' not in registry
+        registry['MBIS_Model']
+        mock_environments.assert_called_once()
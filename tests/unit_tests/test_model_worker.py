@@ -0,0 +1,80 @@
+import os
+import sys
+import contextlib
+import numpy as np
+import pytest
+import ChargeAPI
+from ChargeAPI.API_infrastructure.charge_files import write_grid_file
+
+
+@pytest.fixture(scope='module')
+def model_worker():
+    #the worker imports ChargeAPI's infrastructure as siblings, as in a model's conda environment
+    sys.path.insert(0, f'{os.path.dirname(ChargeAPI.__file__)}/API_infrastructure')
+    import model_worker
+    return model_worker
+
+
+class GridESPModel:
+    """ESP of one per grid point, so the grid each molecule is given can be checked"""
+    theta = None
+    multipoles_only = False
+    batch_grid_file = None
+
+    def build_grid(self, conformer_mol, charge_format=None):
+        return np.zeros((1, 3))
+
+    def timed(self, stage):
+        return contextlib.nullcontext()
+
+    def __call__(self, conformer_mol, batched, broken_up, batched_grid, grid):
+        if grid is None:
+            grid = self.build_grid(conformer_mol)
+        return np.ones(len(grid)), grid
+
+
+class TestStreamRequest:
+
+    def test_molblock_only_entries_use_grid_file(self, model_worker, tmp_path):
+        grid_file = write_grid_file({'a': np.ones((4, 3)), 'b': np.ones((2, 3))}, str(tmp_path / 'grids.npz'))
+        request = {
+            'molecules': {'a': 'molblock a', 'b': ['molblock b', None], 'c': ['molblock c', [0.0, 0.0, 1.0] * 3]},
+            'batch_grid_file': grid_file,
+        }
+
+        results = {name: (result, error) for name, result, error in model_worker.stream_request(GridESPModel(), request)}
+
+        assert [len(result['esp_values']) for result, _ in results.values()] == [4, 2, 3]
+        assert all(error == '' for _, error in results.values())
+
+
+class TestESPBatch:
+
+    def test_molecules_run_in_chunks(self, model_worker):
+        pytest.importorskip('openff.units')
+        from ChargeAPI.esp_models.base_class import ExternalESPModel
+
+        class ChunkedESPModel(ExternalESPModel):
+            """Monopoles are the number of atoms, predicted a chunk at a time"""
+            _name = 'chunked_esp_test_model'
+            chunk_size = 2
+
+            def __init__(self):
+                super().__init__()
+                self.chunks = []
+
+            def convert_to_charge_format(self, conformer_mol):
+                return np.zeros((len(conformer_mol), 3)), ['H'] * len(conformer_mol)
+
+            def assign_esp_chunk(self, charge_formats, grids, broken_up):
+                self.chunks.append(len(charge_formats))
+                return [([len(elements)], [[0.0] * 3], [[0.0] * 9]) for _, elements in charge_formats]
+
+        model = ChunkedESPModel()
+        request = {'molecules': {'a': 'a', 'b': 'bb', 'c': 'ccc'}, 'broken_up': True, 'multipoles_only': True}
+
+        result = model_worker.handle_request(model, request)
+
+        assert model.chunks == [2, 1]
+        assert [values['esp_values'][0] for values in result.values()] == [[1], [2], [3]]
+        assert result['c']['elements'] == ['H', 'H', 'H']
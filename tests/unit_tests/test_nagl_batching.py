@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import pytest
+import ChargeAPI
+
+pytest.importorskip('naglmbis')
+pytest.importorskip('openff.nagl')
+from rdkit import Chem
+
+
+@pytest.fixture(scope='module')
+def model():
+    #the model script imports its base class and the batching mixin as siblings, as in the model worker
+    sys.path.insert(0, f'{os.path.dirname(ChargeAPI.__file__)}/charge_models')
+    from mbis_model import MBIS_Model
+    return MBIS_Model()
+
+
+@pytest.fixture(scope='module')
+def molecules():
+    data = f'{os.path.dirname(__file__)}/../data/batched_compounds.sdf'
+    mols = sorted(
+        (mol for mol in Chem.SDMolSupplier(data, removeHs=False) if mol is not None), key=lambda mol: mol.GetNumAtoms()
+    )
+    #the smallest, a middle sized and the largest molecule, plus water
+    water = Chem.AddHs(Chem.MolFromSmiles('O'))
+    return [Chem.MolToMolBlock(mol) for mol in (water, mols[0], mols[len(mols) // 2], mols[-1])]
+
+
+class TestNaglBatching:
+
+    def test_chunk_matches_single(self, model, molecules):
+        rdkit_conformers = [model.convert_to_charge_format(molblock) for molblock in molecules]
+
+        chunk = model.assign_charges_chunk(rdkit_conformers)
+
+        assert [len(charges) for charges in chunk] == [mol.GetNumAtoms() for mol in rdkit_conformers]
+        for rdkit_conformer, charges in zip(rdkit_conformers, chunk):
+            single = model.charge_model.compute_properties(rdkit_conformer)[model.charge_property].flatten()
+            np.testing.assert_allclose(charges, single, rtol=1e-5, atol=1e-6)
+
+    def test_batch_matches_single(self, model, molecules):
+        batch = {f'molecule{i}': molblock for i, molblock in enumerate(molecules)}
+
+        charges, errors = model.assign_charges_batched(batch)
+
+        assert errors == {}
+        for name, molblock in batch.items():
+            np.testing.assert_allclose(
+                charges[name], model.assign_charges(model.convert_to_charge_format(molblock)), rtol=1e-5, atol=1e-6
+            )
@@ -0,0 +1,35 @@
+from ChargeAPI.API_infrastructure.protocol import (
+    encode_message,
+    write_message,
+    read_message,
+    decode_messages,
+    ProtocolError,
+)
+import io
+import pytest
+
+
+class TestProtocol:
+    mol  = '\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n   -0.7890   -0.1982   -0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n   -0.0061    0.3917   -0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n    0.7951   -0.1936    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n  1  2  1  0\n  2  3  1  0\nM  END\n'
+
+    def test_round_trip(self):
+        stream = io.BytesIO()
+        write_message(stream, {'conformer': self.mol, 'batched': False})
+        write_message(stream, {'result': [0.41073812213382016, -0.8164372902205344, 0.4056991680867142]})
+        stream.seek(0)
+
+        assert read_message(stream) == {'conformer': self.mol, 'batched': False}
+        #floats come back exactly as they were sent
+        assert read_message(stream)['result'] == [0.41073812213382016, -0.8164372902205344, 0.4056991680867142]
+        assert read_message(stream) is None
+
+    def test_decode_messages(self):
+        data = encode_message({'ready': True}) + encode_message({'id': 0, 'result': [1.0]})
+        assert decode_messages(data) == [{'ready': True}, {'id': 0, 'result': [1.0]}]
+
+    def test_truncated_message(self):
+        data = encode_message({'result': [1.0, 2.0]})
+        with pytest.raises(ProtocolError):
+            decode_messages(data[:-2])
+        with pytest.raises(ProtocolError):
+            read_message(io.BytesIO(data[:-2]))
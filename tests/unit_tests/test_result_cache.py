@@ -0,0 +1,108 @@
+from ChargeAPI.API_infrastructure.result_cache import (
+    ResultCache,
+    MemoryCache,
+    DiskCache,
+    canonical_molecule_hash,
+    cache_key,
+)
+from ChargeAPI.API_infrastructure.charge_request import module_version
+from ChargeAPI.API_infrastructure.protocol import encode_message
+from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
+import sys
+import pytest
+
+
+class TestResultCache:
+    mol  = '\n     RDKit          3D\n\n  3  2  0  0  0  0  0  0  0  0999 V2000\n   -0.7890   -0.1982   -0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n   -0.0061    0.3917   -0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0\n    0.7951   -0.1936    0.0000 H   0  0  0  0  0  0  0  0  0  0  0  0\n  1  2  1  0\n  2  3  1  0\nM  END\n'
+
+    def test_hash_ignores_header_and_formatting(self):
+        renamed = 'water\n     RDKit          3D\n' + self.mol.split('\n', 2)[2]
+        reformatted = self.mol.replace('-0.0000', ' 0.0000').replace('0.3917', '0.39170')
+        moved = self.mol.replace('0.7951', '0.7952')
+
+        assert canonical_molecule_hash(renamed) == canonical_molecule_hash(self.mol)
+        assert canonical_molecule_hash(reformatted) == canonical_molecule_hash(self.mol)
+        assert canonical_molecule_hash(moved) != canonical_molecule_hash(self.mol)
+
+    def test_key_depends_on_model_and_grid(self):
+        key = cache_key('esp', 'RIN', 'v1', self.mol, {}, [[0.0, 0.0, 1.0]])
+        assert key == cache_key('esp', 'RIN', 'v1', self.mol, {}, [[0.0, 0.0, 1.0]])
+        assert key != cache_key('esp', 'RIN', 'v2', self.mol, {}, [[0.0, 0.0, 1.0]])
+        assert key != cache_key('esp', 'RIN', 'v1', self.mol, {}, [[0.0, 0.0, 2.0]])
+
+    def test_memory_lru_eviction(self):
+        cache = MemoryCache(max_entries=2)
+        cache.put('a', {'value': 1})
+        cache.put('b', {'value': 2})
+        cache.get('a')
+        cache.put('c', {'value': 3})
+
+        assert cache.get('b') is None
+        assert cache.get('a') == {'value': 1}
+        assert cache.get('c') == {'value': 3}
+
+    def test_disk_size_eviction(self, tmp_path):
+        cache = DiskCache(str(tmp_path / 'cache.sqlite'), max_bytes=60)
+        cache.put('a', {'value': 'x' * 20})
+        cache.put('b', {'value': 'y' * 20})
+
+        assert cache.get('a') is None
+        assert cache.get('b') == {'value': 'y' * 20}
+
+    def test_tiers_and_stats(self, tmp_path):
+        disk_path = str(tmp_path / 'cache.sqlite')
+        ResultCache(disk_path=disk_path).put('a', {'charge_result': '[1.0]', 'error': ''})
+
+        #a new process only has the disk tier
+        cache = ResultCache(disk_path=disk_path)
+        assert cache.get('a') == {'charge_result': '[1.0]', 'error': ''}
+        assert cache.get('a') == {'charge_result': '[1.0]', 'error': ''}
+        assert cache.get('b') is None
+        assert cache.stats() == {
+            'memory_hits': 1, 'disk_hits': 1, 'misses': 1, 'memory_entries': 1, 'disk_entries': 1
+        }
+
+    def test_stats_from_threads(self):
+        #switch threads as often as possible so unguarded counts would be lost
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        cache = ResultCache()
+        cache.put('a', {'charge_result': '[1.0]', 'error': ''})
+
+        def lookups(_):
+            for _ in range(2000):
+                cache.get('a')
+                cache.get('b')
+
+        try:
+            with ThreadPoolExecutor(8) as executor:
+                list(executor.map(lookups, range(8)))
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        stats = cache.stats()
+        assert stats['memory_hits'] == stats['misses'] == 8 * 2000
+
+    @patch('ChargeAPI.API_infrastructure.charge_request.module_version.subprocess.run')
+    def test_cached_request_skips_worker(self, mock_run):
+        mock_stdout = MagicMock()
+        mock_stdout.configure_mock(
+            **{"stdout":encode_message({'ready': True, 'error': ''}) + encode_message({'id': 0, 'result': [0.4, -0.8, 0.4], 'error': ''}),
+               "stderr":b""
+            }
+        )
+        mock_run.return_value = mock_stdout
+
+        module_version.enable_cache()
+        try:
+            first = module_version.handle_charge_request(charge_model = 'MBIS', conformer_mol = self.mol)
+            second = module_version.handle_charge_request(charge_model = 'MBIS', conformer_mol = self.mol)
+            stats = module_version.cache_stats()
+        finally:
+            module_version.disable_cache()
+
+        assert first == second == {'charge_result': '[0.4, -0.8, 0.4]', 'error': ''}
+        assert mock_run.call_count == 1
+        assert stats['memory_hits'] == 1
+        assert stats['misses'] == 1
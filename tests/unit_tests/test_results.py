@@ -0,0 +1,111 @@
+from ChargeAPI.API_infrastructure.results import (
+    charge_result_from_response,
+    batch_charge_results_from_response,
+    esp_result_from_response,
+    batch_esp_results_from_file,
+)
+from ChargeAPI.API_infrastructure.charge_files import write_esp_file
+from ChargeAPI.API_infrastructure.charge_request import module_version
+from ChargeAPI.API_infrastructure.protocol import encode_message
+from unittest.mock import patch, MagicMock
+import numpy as np
+import json
+
+
+class TestResults:
+
+    def test_charge_result_arrays(self):
+        result = charge_result_from_response({'result': {'charges': [-0.8, 0.4, 0.4]}, 'error': ''}, np.float32)
+
+        assert result.ok
+        assert result.charges.dtype == np.float32
+        np.testing.assert_allclose(result.charges, [-0.8, 0.4, 0.4], rtol=1e-6)
+
+    def test_charge_result_dipoles(self):
+        response = {'result': {'charges': [-0.8, 0.4, 0.4], 'dipoles': [[0.0, 0.0, 0.1]] * 3}, 'error': ''}
+        result = charge_result_from_response(response)
+
+        assert result.dipoles.shape == (3, 3)
+        assert charge_result_from_response({'result': {'charges': [0.0]}, 'error': ''}).dipoles is None
+
+    def test_failed_charge_result(self):
+        result = charge_result_from_response({'error': 'Traceback\n'}, molecule='water')
+
+        assert not result.ok
+        assert result.charges is None
+        assert result.errors[0].molecule == 'water'
+
+    def test_batch_keeps_per_molecule_errors(self):
+        response = {'result': {'charges': {'a': [0.1, -0.1]}, 'errors': {'b': 'charges failed'}}, 'error': ''}
+        results = batch_charge_results_from_response(response, ['a', 'b'])
+
+        assert list(results) == ['a', 'b']
+        assert results['a'].ok
+        assert results['b'].errors[0].message == 'charges failed'
+
+    def test_esp_result_shapes(self):
+        response = {'result': {'monopole': [0.1, -0.1], 'dipole': [0.0] * 6, 'quadrupole': [0.0] * 18}, 'error': ''}
+        result = esp_result_from_response(response)
+
+        assert result.ok
+        assert result.dipoles.shape == (2, 3)
+        assert result.quadrupoles.shape == (2, 3, 3)
+
+    def test_batch_esp_file(self, tmp_path):
+        esp_file = tmp_path / 'batch_esp.json'
+        esp_file.write_text(json.dumps({'m0': {'esp_values': [0.1, 0.2], 'esp_grid': [[0, 0, 1], [0, 0, 2]]}}))
+        results = batch_esp_results_from_file(str(esp_file), broken_up=False)
+
+        np.testing.assert_allclose(results['m0'].esp, [0.1, 0.2])
+        assert results['m0'].grid.shape == (2, 3)
+
+    def test_batch_esp_npz_file(self, tmp_path):
+        esp_file = write_esp_file(
+            {'m0': {'esp': [0.1, 0.2], 'grid': [[0, 0, 1], [0, 0, 2]]}, 'm1': {'esp': [0.3], 'grid': [[1, 0, 0]]}},
+            str(tmp_path / 'batch_esp.npz'),
+        )
+        results = batch_esp_results_from_file(esp_file, broken_up=False)
+
+        np.testing.assert_allclose(results['m0'].esp, [0.1, 0.2])
+        assert results['m1'].grid.shape == (1, 3)
+
+    def test_evaluate_esp_of_multipoles(self):
+        response = {'result': {
+            'monopole': [0.5, -0.5],
+            'dipole': [0.0] * 6,
+            'quadrupole': [0.0] * 18,
+            'coordinates': [[0.0, 0.0, 0.0], [0.0, 0.0, 1.0]],
+            'elements': ['H', 'Cl'],
+        }, 'error': ''}
+        result = esp_result_from_response(response)
+        grid = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, 3.0]])
+
+        #two point charges, in hartree/e
+        expected = 0.529177210903 * np.array([0.5 - 0.5 / np.sqrt(2), 0.5 / 3 - 0.5 / 2])
+        np.testing.assert_allclose(result.evaluate_esp(grid), expected)
+        np.testing.assert_allclose(result.evaluate_esp(grid, theta=0.0), expected)
+        assert result.elements == ['H', 'Cl']
+
+    def test_batch_multipole_only_file(self, tmp_path):
+        esp_file = tmp_path / 'batch_esp.json'
+        esp_file.write_text(json.dumps({'m0': {
+            'esp_values': [[1.0], [0.0] * 3, [0.0] * 9],
+            'coordinates': [[0.0, 0.0, 0.0]],
+            'elements': ['Na'],
+        }}))
+        result = batch_esp_results_from_file(str(esp_file), broken_up=True)['m0']
+
+        assert result.grid is None
+        np.testing.assert_allclose(result.evaluate_esp(np.array([[2.0, 0.0, 0.0]])), [0.529177210903 / 2])
+
+    @patch('ChargeAPI.API_infrastructure.charge_request.module_version.subprocess.run')
+    def test_typed_charge_request(self, mock_run):
+        mock_run.return_value = MagicMock(
+            stdout=encode_message({'ready': True}) + encode_message({'result': {'charges': [-0.8, 0.4, 0.4]}, 'error': ''}),
+            stderr=b'',
+        )
+        result = module_version.handle_charge_request('MBIS', 'molblock', typed=True)
+
+        assert mock_run.call_args.kwargs['input'] == encode_message({'conformer': 'molblock', 'protein': False, 'typed': True})
+        assert result.charges.dtype == np.float64
+        assert result.charges.shape == (3,)
@@ -0,0 +1,58 @@
+import os
+import sys
+import numpy as np
+import pytest
+import ChargeAPI
+
+pytest.importorskip('MultipoleNet')
+pytest.importorskip('openff.recharge')
+from rdkit import Chem
+
+
+@pytest.fixture(scope='module')
+def model():
+    #the model script imports its base class and ChargeAPI's infrastructure as siblings, as in the model worker
+    root = os.path.dirname(ChargeAPI.__file__)
+    sys.path[:0] = [f'{root}/esp_models', f'{root}/API_infrastructure']
+    from riniker_model import RIN_model
+    return RIN_model()
+
+
+@pytest.fixture(scope='module')
+def molecules():
+    data = f'{os.path.dirname(__file__)}/../data/batched_compounds.sdf'
+    return [Chem.MolToMolBlock(mol) for mol in Chem.SDMolSupplier(data, removeHs=False) if mol is not None][:8]
+
+
+class TestBatchedPrediction:
+
+    def test_batched_matches_single(self, model, molecules):
+        charge_formats = [model.convert_to_charge_format(molblock) for molblock in molecules]
+        batched = model.predict_batched(charge_formats)
+
+        assert len(batched) == len(molecules)
+        for charge_format, batched_multipoles in zip(charge_formats, batched):
+            single = [multipole.numpy() for multipole in model.esp_model.predict(*charge_format)]
+            for batched_multipole, single_multipole in zip(batched_multipoles, single):
+                assert np.allclose(batched_multipole.reshape(-1), single_multipole.reshape(-1), rtol=1e-4, atol=1e-5)
+
+    def test_chunk_esp_matches_single(self, model, molecules):
+        charge_formats = [model.convert_to_charge_format(molblock) for molblock in molecules]
+        grids = [model.build_grid(molblock, charge_format) for molblock, charge_format in zip(molecules, charge_formats)]
+        chunk = model.assign_esp_chunk(charge_formats, grids, broken_up=False)
+
+        for charge_format, grid, esp in zip(charge_formats, grids, chunk):
+            single, _ = model.assign_esp(charge_format, grid)
+            assert np.allclose(esp, single, rtol=1e-4, atol=1e-6)
+
+    def test_chunk_checked_against_predict(self, model, molecules, monkeypatch):
+        charge_formats = [model.convert_to_charge_format(molblock) for molblock in molecules]
+        predict = model.esp_model.predict
+        monkeypatch.setattr(model, 'batched_prediction', None)
+        #single predictions post-processed differently from the batched pass
+        monkeypatch.setattr(
+            model.esp_model, 'predict', lambda *args: [multipole * 2 + 1 for multipole in predict(*args)]
+        )
+
+        assert model.assign_esp_chunk(charge_formats, [None] * len(charge_formats), broken_up=True) is None
+        assert model.batched_prediction is False
@@ -0,0 +1,81 @@
+import threading
+import pytest
+from ChargeAPI.API_infrastructure import worker_pool
+from ChargeAPI.API_infrastructure.worker_pool import WorkerPool, WorkerError
+
+
+class FakeWorker:
+    """Stands in for a model worker process, the first one dies in the middle of its request once released"""
+    started = []
+
+    def __init__(self, env, script_path):
+        self.alive = True
+        self.busy = threading.Event()
+        self.release = threading.Event()
+        self.first = not FakeWorker.started
+        FakeWorker.started.append(self)
+
+    def is_alive(self):
+        return self.alive
+
+    def request(self, payload):
+        self.busy.set()
+        if self.first:
+            self.release.wait(5)
+            self.alive = False
+            raise WorkerError('worker died')
+        return {'result': payload['conformer'], 'error': ''}
+
+    def close(self):
+        self.alive = False
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    FakeWorker.started = []
+    monkeypatch.setattr(worker_pool, 'ModelWorker', FakeWorker)
+    pool = WorkerPool(workers_per_model=1)
+    yield pool
+    pool.close()
+
+
+def run(target, *args):
+    outcome = {}
+    def wrapped():
+        try:
+            outcome['result'] = target(*args)
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=wrapped, daemon=True)
+    thread.start()
+    return thread, outcome
+
+
+class TestWorkerPool:
+
+    def test_waiting_request_replaces_dead_worker(self, pool):
+        first, first_outcome = run(pool.request, 'EEM', 'env', 'script.py', {'conformer': 'a'})
+        assert FakeWorker.started and FakeWorker.started[0].busy.wait(5)
+        second, second_outcome = run(pool.request, 'EEM', 'env', 'script.py', {'conformer': 'b'})
+
+        FakeWorker.started[0].release.set()
+        first.join(5)
+        second.join(5)
+
+        assert isinstance(first_outcome['error'], WorkerError)
+        assert second_outcome['result']['result'] == 'b'
+        assert len(FakeWorker.started) == 2
+        assert pool.stats() == {'EEM': {'started': 1, 'idle': 1}}
+
+    def test_close_wakes_waiting_request(self, pool):
+        first, _ = run(pool.request, 'EEM', 'env', 'script.py', {'conformer': 'a'})
+        assert FakeWorker.started and FakeWorker.started[0].busy.wait(5)
+        second, second_outcome = run(pool.request, 'EEM', 'env', 'script.py', {'conformer': 'b'})
+
+        pool.close()
+        second.join(5)
+        FakeWorker.started[0].release.set()
+        first.join(5)
+
+        assert not second.is_alive()
+        assert isinstance(second_outcome['error'], WorkerError)